@@ -0,0 +1,525 @@
+#!/usr/bin/env python
+#
+# benchmark_ani.py
+#
+# This script measures the throughput of the main stages of calculate_ani.py
+# on synthetic data, so that performance regressions can be detected:
+#
+# tetra:    calc_org_tetra on synthetic genomes (bases/s)
+# fragment: fragment_input_files on synthetic genomes (bases/s)
+# fragment_sample: fragment_input_files with --sample_fragments, as for
+#           fragment
+# pack:     pack_input_files into a --genome_cache, as for fragment
+# fragment_cached: fragment_input_files reading the genomes from a
+#           --genome_cache packed beforehand, as for fragment
+# delta:    parse_delta on a synthetic NUCmer .delta file (alignments/s)
+# delta1:   parse_delta with the one-to-one filter, as for delta
+# blast:    parse_blast on a synthetic BLASTN .blast_tab file (hits/s)
+# table:    write_matrix_table on a random square matrix (cells/s)
+#
+# Each benchmark is run at several scales, each in a fresh Python process, so
+# that the peak memory (maximum resident set size) of each can be measured.
+# Results can be saved as a baseline, and later runs compared against it.
+#
+# The synthetic genome generator can also be used on its own (--generate):
+# it mutates a seed genome (random, or read from a FASTA file) to a set of
+# target ANIs by making exactly the corresponding number of random base
+# substitutions, giving inputs of known ANI for checking the ANI methods.
+#
+# USAGE
+# =====
+#
+# benchmark_ani.py [--scales 1,4,16] [--baseline bench.json]
+#                  [--save_baseline bench.json]
+# benchmark_ani.py --generate outdir [--seed_genome seed.fna]
+#                  [--target_ani 0.99,0.95,0.9]
+#
+# DEPENDENCIES
+# ============
+#
+# o calculate_ani.py, and its dependencies, in the same directory
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#=============
+# IMPORTS
+
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import calculate_ani
+
+#=============
+# GLOBALS
+
+# Size of each benchmark at scale 1; larger scales multiply the number of
+# records (for the table benchmark, the number of cells)
+BENCHMARKS = {'tetra': {'genomes': 4, 'length': 250000},
+              'fragment': {'genomes': 4, 'length': 250000},
+              'fragment_sample': {'genomes': 4, 'length': 250000},
+              'pack': {'genomes': 4, 'length': 250000},
+              'fragment_cached': {'genomes': 4, 'length': 250000},
+              'delta': {'records': 50000},
+              'delta1': {'records': 50000},
+              'blast': {'records': 50000},
+              'table': {'cells': 250000}}
+
+# Record units, for reporting
+UNITS = {'tetra': 'bases', 'fragment': 'bases', 'fragment_sample': 'bases',
+         'pack': 'bases', 'fragment_cached': 'bases',
+         'delta': 'alignments', 'delta1': 'alignments', 'blast': 'hits',
+         'table': 'cells'}
+
+# Benchmarks run on synthetic genomes
+GENOME_BENCHMARKS = ('tetra', 'fragment', 'fragment_sample', 'pack',
+                     'fragment_cached')
+
+# calculate_ani options for benchmarks of optional code paths; the genome
+# cache location is relative to the benchmark's scratch directory
+OPTIONS = {'fragment_sample': {'sample_fragments': 100},
+           'pack': {'genome_cache': 'cache'},
+           'fragment_cached': {'genome_cache': 'cache'}}
+
+#=============
+# FUNCTIONS
+
+# Make a random genome sequence
+def random_genome(length, rng, gc=0.5):
+    """ Returns a uint8 array of 2-bit base codes (A=0, C=1, G=2, T=3), as
+        used by calculate_ani.encode_sequence, for a random genome of the
+        passed length and GC content.
+
+        - length is the genome length
+
+        - rng is a numpy.random.Generator
+
+        - gc is the GC fraction
+    """
+    at, cg = (1 - gc) / 2, gc / 2
+    return rng.choice(4, size=length, p=[at, cg, cg, at]).astype(np.uint8)
+
+# Mutate a genome to a target ANI
+def mutate_genome(codes, target_ani, rng):
+    """ Returns a copy of the passed 2-bit encoded genome, with exactly
+        round(len(codes) * (1 - target_ani)) positions, chosen at random
+        without replacement, substituted by a different base. Without
+        indels or rearrangements, the identity of the aligned genomes is
+        target_ani. Ambiguity codes (4) are left in place, but may be
+        chosen, so the realised ANI is slightly higher for genomes with many
+        ambiguous bases.
+
+        - codes is a uint8 array of base codes
+
+        - target_ani is the ANI of the mutant to the original, from 0 to 1
+
+        - rng is a numpy.random.Generator
+    """
+    mutant = codes.copy()
+    nsubs = int(round(len(codes) * (1 - target_ani)))
+    sites = rng.choice(len(codes), size=nsubs, replace=False)
+    sites = sites[mutant[sites] < 4]
+    mutant[sites] = (mutant[sites] + rng.integers(1, 4, size=len(sites))) % 4
+    return mutant
+
+# Read a genome from FASTA as 2-bit base codes
+def read_genome(filename):
+    """ Returns the concatenated sequences of the passed FASTA file as a
+        uint8 array of base codes (see calculate_ani.encode_sequence).
+
+        - filename is the location of the FASTA file
+    """
+    with open(filename) as fh:
+        return np.concatenate([calculate_ani.encode_sequence(seq) for \
+                   title, seq in calculate_ani.SimpleFastaParser(fh)])
+
+# Write a 2-bit encoded genome as FASTA
+def write_genome(filename, codes, name, width=80):
+    """ Writes the passed 2-bit encoded genome to a FASTA file as a single
+        sequence, with ambiguity codes written as N.
+
+        - filename is the location of the output file
+
+        - codes is a uint8 array of base codes
+
+        - name is the sequence identifier
+
+        - width is the line length of the sequence
+    """
+    seq = np.frombuffer(b'ACGTN', dtype=np.uint8)[codes].tobytes().decode()
+    with open(filename, 'w') as fh:
+        print(">%s" % name, file=fh)
+        for start in range(0, len(seq), width):
+            print(seq[start:start + width], file=fh)
+
+# Write a set of genomes at known ANIs to a seed genome
+def generate_genomes(outdir, seed, target_anis, rng):
+    """ Writes the seed genome, and one mutant of it (see mutate_genome) for
+        each target ANI, to FASTA files in outdir, and returns the list of
+        files written. Files are named seed.fna and ani_<target>.fna.
+
+        - outdir is the output directory
+
+        - seed is a uint8 array of base codes
+
+        - target_anis is a list of target ANIs
+
+        - rng is a numpy.random.Generator
+    """
+    os.makedirs(outdir, exist_ok=True)
+    filenames = [os.path.join(outdir, 'seed.fna')]
+    write_genome(filenames[0], seed, 'seed')
+    for ani in target_anis:
+        filenames.append(os.path.join(outdir, 'ani_%s.fna' % ani))
+        write_genome(filenames[-1], mutate_genome(seed, ani, rng),
+                     'ani_%s' % ani)
+    return filenames
+
+# Write a synthetic NUCmer .delta file
+def write_synthetic_delta(filename, nrecords, rng, per_header=50):
+    """ Writes a NUCmer-format .delta file with nrecords alignments, in
+        groups of per_header under each sequence pair header, each followed
+        by a few indel positions and the terminating zero, and returns the
+        number of alignments.
+
+        - filename is the location of the output file
+
+        - nrecords is the number of alignments
+
+        - rng is a numpy.random.Generator
+
+        - per_header is the number of alignments for each sequence pair
+    """
+    starts = rng.integers(1, 5000000, size=nrecords)
+    lengths = rng.integers(500, 20000, size=nrecords)
+    errors = rng.integers(0, 200, size=nrecords)
+    with open(filename, 'w') as fh:
+        fh.write("/data/query.fna /data/subject.fna\nNUCMER\n")
+        lines = []
+        for idx in range(nrecords):
+            if idx % per_header == 0:
+                lines.append(">q%d s%d 5000000 5000000" % (idx, idx))
+            s, l, e = starts[idx], lengths[idx], errors[idx]
+            lines.append("%d %d %d %d %d %d 0" % (s, s + l, s + 7, s + l + 7,
+                                                  e, e))
+            lines.extend(["%d" % (1 + idx % 97), "-%d" % (3 + idx % 89),
+                          "0"])
+        fh.write('\n'.join(lines) + '\n')
+    return nrecords
+
+# Write a synthetic BLASTN tabular output file
+def write_synthetic_blast_tab(filename, nrecords, rng, fragsize=1020):
+    """ Writes a BLASTN tabular output file in the column format requested
+        by calculate_ani.BLASTN_ARGS, with nrecords hits from consecutive
+        fragment queries (one to three hits each), and returns the number
+        of hits. Hit lengths and identities are spread so that some hits
+        fail the Goris et al. coverage and identity filters.
+
+        - filename is the location of the output file
+
+        - nrecords is the number of hits
+
+        - rng is a numpy.random.Generator
+
+        - fragsize is the query fragment length
+    """
+    nhits = rng.integers(1, 4, size=nrecords)
+    queries = np.repeat(np.arange(nrecords), nhits)[:nrecords]
+    lengths = rng.integers(fragsize // 2, fragsize + 1, size=nrecords)
+    mismatches = rng.integers(0, fragsize // 5, size=nrecords)
+    gaps = rng.integers(0, 10, size=nrecords)
+    with open(filename, 'w') as fh:
+        lines = []
+        for idx in range(nrecords):
+            length, mm, gap = lengths[idx], mismatches[idx], gaps[idx]
+            nident = length - mm - gap
+            lines.append('\t'.join(map(str, [
+                "frag%05d" % queries[idx], "subject_%d" % (idx % 50),
+                length, mm, "%.2f" % (100. * nident / length), nident,
+                fragsize, 5000000, 1, length, 1000 + idx, 1000 + idx + length,
+                nident, "%.2f" % (100. * nident / length), gap])))
+        fh.write('\n'.join(lines) + '\n')
+    return nrecords
+
+# Make the calculate_ani configuration for calling its functions directly
+def make_benchmark_config(name, outdir):
+    """ Returns the calculate_ani configuration (see calculate_ani.make_config)
+        to run its functions for the named benchmark in the passed output
+        directory with a single thread, with the benchmark's own OPTIONS.
+
+        - name is a key of BENCHMARKS
+
+        - outdir is the output directory
+    """
+    kwargs = dict(OPTIONS.get(name, {}))
+    if 'genome_cache' in kwargs:
+        kwargs['genome_cache'] = os.path.join(outdir, kwargs['genome_cache'])
+    return calculate_ani.make_config(outdirname=outdir, threads=1,
+                                     fragsize=1020, **kwargs)
+
+# Write the synthetic input for one benchmark
+def prepare_benchmark(name, scale, workdir, seed=1):
+    """ Writes the synthetic input for the named benchmark at the passed
+        scale to workdir, and returns the number of records (bases,
+        alignments, hits or cells) that the benchmark will process.
+
+        - name is a key of BENCHMARKS
+
+        - scale is the size multiplier
+
+        - workdir is a scratch directory
+
+        - seed seeds the random number generator
+    """
+    rng = np.random.default_rng(seed)
+    params = BENCHMARKS[name]
+    if name in GENOME_BENCHMARKS:
+        length = params['length'] * scale
+        infiles = generate_genomes(os.path.join(workdir, 'genomes'),
+                                   random_genome(length, rng),
+                                   [0.99, 0.95, 0.9][:params['genomes'] - 1],
+                                   rng)
+        if name == 'fragment_cached':
+            with calculate_ani.use_config(make_benchmark_config(name,
+                                                                workdir)):
+                calculate_ani.pack_input_files(infiles)
+        return length * len(infiles)
+    elif name in ('delta', 'delta1'):
+        return write_synthetic_delta(os.path.join(workdir, 'synthetic.delta'),
+                                     params['records'] * scale, rng)
+    elif name == 'blast':
+        return write_synthetic_blast_tab(os.path.join(workdir,
+                                                      'a_vs_b.blast_tab'),
+                                         params['records'] * scale, rng)
+    elif name == 'table':
+        size = int(round((params['cells'] * scale) ** 0.5))
+        np.save(os.path.join(workdir, 'synthetic.npy'),
+                rng.random((size, size)))
+        return size * size
+
+# Run one benchmark on its prepared input, in this process
+def run_benchmark(name, workdir):
+    """ Times the benchmarked calculate_ani function on the input written
+        by prepare_benchmark to workdir, and returns the time taken, in
+        seconds.
+
+        - name is a key of BENCHMARKS
+
+        - workdir is the scratch directory holding the input
+    """
+    config = make_benchmark_config(name, workdir)
+    if name in GENOME_BENCHMARKS:
+        gendir = os.path.join(workdir, 'genomes')
+        infiles = [os.path.join(gendir, fn) for fn in \
+                       sorted(os.listdir(gendir))]
+        if name == 'tetra':
+            func = lambda: calculate_ani.calc_org_tetra(infiles)
+        elif name == 'pack':
+            func = lambda: calculate_ani.pack_input_files(infiles)
+        else:
+            func = lambda: calculate_ani.fragment_input_files(infiles)
+    elif name in ('delta', 'delta1'):
+        filename = os.path.join(workdir, 'synthetic.delta')
+        func = lambda: calculate_ani.parse_delta(filename, name == 'delta1')
+    elif name == 'blast':
+        filename = os.path.join(workdir, 'a_vs_b.blast_tab')
+        func = lambda: calculate_ani.parse_blast(filename)
+    elif name == 'table':
+        matrix = np.load(os.path.join(workdir, 'synthetic.npy'))
+        names = ["genome_%06d" % idx for idx in range(len(matrix))]
+        func = lambda: calculate_ani.write_matrix_table('synthetic.tab',
+                                                        names, names, matrix)
+    with calculate_ani.use_config(config):
+        started = time.time()
+        func()
+        return time.time() - started
+
+# Run one benchmark at one scale in a fresh process, measuring peak memory
+def run_isolated(name, scale, seed=1):
+    """ Prepares the input for the named benchmark at the passed scale (see
+        prepare_benchmark), then runs it (see run_benchmark), each in a new
+        Python process, so that neither input generation nor earlier
+        benchmarks affect its memory use. Returns a dictionary of the number
+        of records processed, the time taken in seconds, and the peak
+        resident set size of the benchmark process, in kilobytes.
+
+        - name is a key of BENCHMARKS
+
+        - scale is the size multiplier
+
+        - seed seeds the random number generator
+    """
+    # Input is prepared in its own process too: the peak memory recorded
+    # for a process is inherited across exec, so the parent must stay small
+    with tempfile.TemporaryDirectory() as workdir:
+        outfile = os.path.join(workdir, 'result.json')
+        script = [sys.executable, os.path.abspath(__file__)]
+        try:
+            subprocess.check_call(script + ['--prepare_one', name, str(scale),
+                                            workdir, outfile,
+                                            '--seed', str(seed)])
+            with open(outfile) as fh:
+                records = json.load(fh)
+            proc = subprocess.Popen(script + ['--run_one', name, workdir,
+                                              outfile])
+            pid, status, rusage = os.wait4(proc.pid, 0)
+            if os.waitstatus_to_exitcode(status):
+                raise subprocess.CalledProcessError(status, proc.args)
+        except subprocess.CalledProcessError:
+            logger.error("Benchmark %s at scale %d failed (exiting)" % \
+                             (name, scale))
+            sys.exit(1)
+        with open(outfile) as fh:
+            seconds = json.load(fh)
+    return {'records': records, 'seconds': seconds,
+            'maxrss_kb': rusage.ru_maxrss}
+
+# Report benchmark results, with changes from a baseline
+def report(results, baseline=None, tolerance=0.2):
+    """ Prints a table of the passed benchmark results: records, time,
+        throughput and peak memory for each benchmark and scale, with the
+        percentage change in throughput and memory from the baseline where
+        it has the same benchmark and scale. Returns the list of
+        (benchmark, scale) results whose throughput fell by more than
+        tolerance.
+
+        - results is a dictionary of result dictionaries keyed by
+              "<benchmark>@<scale>"
+
+        - baseline is an optional dictionary of results, as for results
+
+        - tolerance is the largest acceptable fractional fall in throughput
+    """
+    regressions = []
+    print('\t'.join(['benchmark', 'scale', 'records', 'seconds',
+                     'records/s', 'peak MB', 'd(records/s)', 'd(peak MB)']))
+    for key, result in results.items():
+        name, scale = key.split('@')
+        rate = result['records'] / max(result['seconds'], 1e-9)
+        row = [name, scale, "%d %s" % (result['records'], UNITS[name]),
+               "%.3f" % result['seconds'], "%.4g" % rate,
+               "%.1f" % (result['maxrss_kb'] / 1024.)]
+        if baseline is not None and key in baseline:
+            base = baseline[key]
+            base_rate = base['records'] / max(base['seconds'], 1e-9)
+            change = rate / base_rate - 1
+            mem_change = result['maxrss_kb'] / float(base['maxrss_kb']) - 1
+            row.append("%+.1f%%" % (100 * change))
+            row.append("%+.1f%%" % (100 * mem_change))
+            if change < -tolerance:
+                regressions.append(key)
+        print('\t'.join(row))
+    return regressions
+
+
+#=============
+# SCRIPT
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(\
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--benchmarks", dest="benchmarks",
+                        default=','.join(sorted(BENCHMARKS)),
+                        help="Comma-separated benchmarks to run")
+    parser.add_argument("--scales", dest="scales", default="1,4,16",
+                        help="Comma-separated size multipliers")
+    parser.add_argument("--baseline", dest="baseline", default=None,
+                        help="JSON file of baseline results to compare with")
+    parser.add_argument("--save_baseline", dest="save_baseline",
+                        default=None,
+                        help="Write the results to this JSON file")
+    parser.add_argument("--tolerance", dest="tolerance", type=float,
+                        default=0.2,
+                        help="Exit with an error if throughput falls by " +\
+                            "more than this fraction of the baseline")
+    parser.add_argument("--generate", dest="generate", default=None,
+                        help="Write synthetic genomes to this directory, " +\
+                            "instead of running benchmarks")
+    parser.add_argument("--seed_genome", dest="seed_genome", default=None,
+                        help="With --generate, FASTA file of the genome " +\
+                            "to mutate (default: a random genome)")
+    parser.add_argument("--genome_length", dest="genome_length", type=int,
+                        default=1000000,
+                        help="With --generate, length of the random seed " +\
+                            "genome")
+    parser.add_argument("--target_ani", dest="target_ani",
+                        default="0.99,0.95,0.9,0.85,0.8",
+                        help="With --generate, comma-separated ANIs of " +\
+                            "the mutants to the seed genome")
+    parser.add_argument("--seed", dest="seed", type=int, default=1,
+                        help="Random number seed")
+    parser.add_argument("--run_one", dest="run_one", nargs=3, default=None,
+                        help=argparse.SUPPRESS)
+    parser.add_argument("--prepare_one", dest="prepare_one", nargs=4,
+                        default=None, help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s: %(message)s')
+    logger = logging.getLogger('benchmark_ani.py')
+
+    # Internal: prepare or run a single benchmark, for run_isolated
+    if options.prepare_one is not None:
+        name, scale, workdir, outfile = options.prepare_one
+        with open(outfile, 'w') as fh:
+            json.dump(prepare_benchmark(name, int(scale), workdir,
+                                        options.seed), fh)
+        sys.exit(0)
+    if options.run_one is not None:
+        name, workdir, outfile = options.run_one
+        with open(outfile, 'w') as fh:
+            json.dump(run_benchmark(name, workdir), fh)
+        sys.exit(0)
+
+    if options.generate is not None:
+        rng = np.random.default_rng(options.seed)
+        if options.seed_genome is not None:
+            seed = read_genome(options.seed_genome)
+        else:
+            seed = random_genome(options.genome_length, rng)
+        for filename in generate_genomes(
+                options.generate, seed,
+                [float(ani) for ani in options.target_ani.split(',')], rng):
+            print(filename)
+        sys.exit(0)
+
+    names = options.benchmarks.split(',')
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark %s" % name)
+    results = {}
+    for name in names:
+        for scale in [int(s) for s in options.scales.split(',')]:
+            results["%s@%d" % (name, scale)] = run_isolated(name, scale,
+                                                         options.seed)
+    baseline = None
+    if options.baseline is not None:
+        with open(options.baseline) as fh:
+            baseline = json.load(fh)
+    regressions = report(results, baseline, options.tolerance)
+    if options.save_baseline is not None:
+        with open(options.save_baseline, 'w') as fh:
+            json.dump(results, fh, indent=1)
+    if regressions:
+        logger.error("Throughput fell by more than %d%% for: %s" % \
+                         (100 * options.tolerance, ', '.join(regressions)))
+        sys.exit(1)
@@ -31,6 +31,8 @@
 #
 # ANIm: uses MUMmer (NUCmer) to align the input sequences.
 # ANIb: uses BLASTN to align 1000nt fragments of the input sequences
+# ANIk: estimates ANI without an aligner, by mapping 3000nt fragments of the
+#       input sequences with shared k-mer minimizers, as in FastANI
 # TETRA: calculates tetranucleotide frequencies of each input sequence
 #
 # This script takes as input a directory containing a set of
@@ -52,16 +54,51 @@
 #       pairwise comparison of input sequences. There are potentially a lot of
 #       intermediate files.
 #
+# ANIk: NumPy .npz minimizer indexes - one for each input sequence; and
+#       the same tables as ANIm and ANIb.
+#
 # TETRA: Tab-separated text file describing the Z-scores for each
 #        tetranucleotide in each input sequence.
 #
-# In addition, all methods produce a table of output percentage identity (ANIm
-# and ANIb) or correlation (TETRA), between each sequence.
+# In addition, all methods produce a table of output percentage identity (ANIm,
+# ANIb and ANIk) or correlation (TETRA), between each sequence.
+#
+# With --genome_cache, each input genome is read once into a packed 2-bit
+# copy, shared between runs, from which later stages and runs read it
+# instead of parsing the FASTA file; genome_stats.tab in the output
+# directory then lists the length, GC, contig count and N50 of each genome.
+#
+# For large numbers of genomes, --sparse_output keeps only the pairs above
+# an ANI threshold, written as an edge list (or CSR arrays) in place of the
+# NxN tables, and clusters the genomes into species over that graph.
 #
 # If graphical output is chosen, the output directory will also contain PDF
 # files representing the similarity between sequences as a heatmap with
 # row and column dendrograms.
 #
+# LIBRARY USE
+# ===========
+#
+# The methods, calc_org_tetra and the aligner output parsers (parse_delta,
+# parse_blast) can also be called from Python. A configuration takes the
+# place of the command-line options (see make_config), and is passed to each
+# call or applied with use_config:
+#
+#   import calculate_ani
+#   config = calculate_ani.make_config(outdirname='out', threads=8)
+#   perc_id, perc_aln, names = calculate_ani.calculate_anim(infiles,
+#                                                           config=config)
+#
+# With --export_alignments, the alignments of each comparison are kept in a
+# columnar file beside the aligner output, and can be summarised by contig
+# without parsing that output again:
+#
+#   summary = calculate_ani.contig_ani('out/genome1_vs_genome2.delta')
+#
+# Values calculated from each input genome (lengths, sequence hashes and
+# tetranucleotide Z-scores), and any --store result store, are kept between
+# calls, so a long-running process does not repeat that work.
+#
 # DEPENDENCIES
 # ============
 #
@@ -113,15 +150,28 @@
 # IMPORTS
 
 
+import atexit
 import collections
+import contextlib
+import csv
+import functools
+import gzip
+import hashlib
+import heapq
+import itertools
+import json
 import logging
 import logging.handlers
-import math
 import multiprocessing
 import os
+import resource
 import shutil
+import socket
+import sqlite3
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 import traceback
 import argparse
@@ -130,10 +180,167 @@ import numpy as np
 
 try:
     from Bio import SeqIO
+    from Bio.SeqIO.FastaIO import SimpleFastaParser
 except ImportError:
     print("Biopython required for script, but not found (exiting)")
     sys.exit(1)
 
+#=============
+# GLOBALS
+
+# Run configuration (the parsed command-line options, or a configuration
+# from make_config when used as a library; see use_config), and the logger
+options = None
+logger = logging.getLogger('calculate_ani.py')
+logger.addHandler(logging.NullHandler())
+
+# Library use: configurations are applied one at a time, as they replace
+# the module-level options; result stores opened for configurations, kept
+# open between calls and keyed by location; and values calculated from
+# each input genome, keyed by (path, size, modification time) so that they
+# are recalculated if the file changes
+config_lock = threading.RLock()
+config_stores = {}
+genome_cache = {}
+
+# Layout version of the packed genomes in the --genome_cache directory (see
+# pack_genome); it is part of each genome's cache key, so that genomes packed
+# in an older layout are packed again
+GENOME_CACHE_VERSION = 1
+
+# Persistent pairwise result store (an sqlite3 connection), if one was
+# requested with --store
+store = None
+
+# ANI methods whose pairwise results do not depend on which organism is the
+# query (NUCmer alignments); result keys for other methods are directional
+# (see make_result_key)
+SYMMETRIC_METHODS = ('ANIm', 'AAIm')
+
+# Aligner options that affect pairwise results; these are included in the
+# result store keys
+NUCMER_ARGS = "-mum"
+BLASTN_ARGS = "-xdrop_gap_final 150 -penalty -1 -dust no " +\
+    "-max_target_seqs 1 -outfmt '6 qseqid sseqid length mismatch " +\
+    "pident nident qlen slen qstart qend sstart send positive " +\
+    "ppos gaps' " +\
+    "-gapopen 0 -gapextend 2"
+
+# With --one_to_one, NUCmer alignments that overlap on the reference or on
+# the query are resolved in favour of the better one (see sweep_overlaps);
+# overlaps of up to this fraction of the shorter alignment, as where
+# neighbouring alignments are extended into each other, are tolerated
+ONE_TO_ONE_MAX_OVERLAP = 0.1
+
+# Confidence level of the bootstrap intervals reported for ANIb with
+# --sample_fragments
+BOOTSTRAP_LEVEL = 0.95
+
+# With a combined BLAST database (--blast_batch), each fragment needs a
+# match in every genome, rather than just the best match overall, so we ask
+# BLASTN for this many target sequences per genome in the database. The cap
+# is shared by all genomes, so a fragment matching many sequences in some
+# genomes can still crowd out the best match in others
+BATCH_TARGETS_PER_GENOME = 5
+
+# Aligner options giving the number of threads a job may use. NUCmer only
+# accepts --threads from MUMmer 4 onwards, so it is used only on request
+# (--nucmer_threads)
+NUCMER_THREADS_ARG = "--threads %d"
+BLASTN_THREADS_ARG = "-num_threads %d"
+
+# An external job: its command line, the summed length of the sequences it
+# processes (used to run the largest jobs first), a format string for the
+# aligner's thread count option (None if it cannot use extra threads),
+# optionally a function that is passed the job's standard output stream to
+# consume while the job runs, optionally the output file it produces,
+# which the command line writes under a temporary name (see
+# make_partial_filename) and which is renamed when the job succeeds
+# (see finish_output), and optionally a (function, arguments) tuple with
+# which to parse the output file as soon as the job succeeds (see
+# parse_job_output)
+Job = collections.namedtuple('Job',
+                             'cmdline size threads_arg consumer outfile ' +\
+                                 'parser',
+                             defaults=(None, None, None))
+
+# Record, in the output directory, of the aligner output files that were
+# completed, with their sizes; used to validate outputs with --resume
+COMPLETED_OUTPUTS = 'completed_outputs.tab'
+
+# Shared-filesystem job queue (--queue, --worker): how often coordinator and
+# workers look for changes, how often a worker marks a running job as still
+# alive, and how long a running job can go unmarked before the coordinator
+# assumes its worker has died and puts it back in the queue, in seconds
+QUEUE_POLL = 1
+QUEUE_HEARTBEAT = 10
+QUEUE_STALE = 120
+
+# Resource use of the run, for the run report (see write_run_report):
+# cumulative wall and CPU time for each timed stage (see timed_stage), keyed
+# by stage name, and a record of each external job attempt
+run_report = {'started': time.time(), 'stages': collections.OrderedDict(),
+              'jobs': []}
+
+# Parsed results of aligner output obtained while jobs run: consumed
+# directly from the aligner's standard output (--blast_stream), or parsed
+# from the output file as soon as its job completes (--pipeline), keyed by
+# the output file name
+stream_results = {}
+
+# A single pairwise comparison: the organism names, the result store key,
+# and the aligner output file holding its result (None if the result is
+# already in the store)
+Comparison = collections.namedtuple('Comparison',
+                                    'qname sname key outfile')
+
+# Pairwise comparison results, as dense arrays with a row for each query
+# organism and a column for each subject organism (see new_pairwise_results).
+# rows and cols map organism names to array indices, in sorted name order,
+# and are the same dictionary when every organism is compared with every
+# other. The arrays hold total aligned lengths, similarity errors,
+# percentage identity, and the percentage of the row organism aligned
+PairwiseResults = collections.namedtuple('PairwiseResults',
+    'rows cols lengths sim_errors perc_ids perc_aln')
+
+# Pairwise comparison results with --sparse_output: rows and cols as for
+# PairwiseResults, the minimum percentage identity of the comparisons kept,
+# and a list of the kept comparisons, as tuples of SPARSE_EDGE_DTYPE fields:
+# row and column indices, total aligned length, similarity errors,
+# percentage identity, and the percentage of the row and of the column
+# organism aligned
+SparseResults = collections.namedtuple('SparseResults',
+                                       'rows cols min_ani edges')
+SPARSE_EDGE_DTYPE = np.dtype([('query', np.int64), ('subject', np.int64),
+                              ('aln_lengths', np.int64),
+                              ('sim_errors', np.int64),
+                              ('perc_ids', float), ('perc_aln', float),
+                              ('perc_aln_ref', float)])
+
+# k-mer length for the MinHash sketches used by the --prefilter stage, as
+# used by Mash; canonical k-mers of up to 32 bases fit in a 64-bit integer
+SKETCH_KMER = 21
+
+# Parameters of the aligner-free ANIk method, after FastANI (Jain et al.
+# 2018): the k-mer length, the minimizer window (in k-mers), the length of
+# the query fragments mapped to the reference, and the minimum estimated
+# identity for a fragment to count as mapped
+ANIK_KMER = 16
+ANIK_WINDOW = 24
+ANIK_FRAGSIZE = 3000
+ANIK_MIN_IDENTITY = 0.8
+
+# Heatmaps of more organisms than this are drawn with make_large_heatmap,
+# unless another mode is chosen with --heatmap_mode; and no more than this
+# many row or column names are labelled on each heatmap image
+HEATMAP_LARGE_SIZE = 200
+HEATMAP_MAX_LABELS = 100
+
+# Colormaps for the percentage identity (lower) and alignment (upper)
+# triangles, shared by make_heatmap and make_large_heatmap
+HEATMAP_IDENTITY_CMAP = 'Purples'
+HEATMAP_ALIGNMENT_CMAP = 'Blues'
+
 #=============
 # FUNCTIONS
 
@@ -146,15 +353,135 @@ def last_exception():
     return ''.join(traceback.format_exception(exc_type, exc_value,
                                               exc_traceback))
 
-def calculate_aaim(infiles):
-    return calculate_anim(infiles, prog=options.promer_exe)
+# Time a stage of the run for the run report
+@contextlib.contextmanager
+def timed_stage(name):
+    """ Context manager (also usable as a function decorator) that adds the
+        wall and CPU time spent in its body to the named stage of the run
+        report. A stage entered several times accumulates its times and
+        number of calls; a stage entered within another counts towards
+        both.
+
+        - name is the stage name
+    """
+    wall, cpu = time.time(), time.process_time()
+    try:
+        yield
+    finally:
+        stage = run_report['stages'].setdefault(
+            name, collections.OrderedDict([('calls', 0), ('wall', 0.),
+                                           ('cpu', 0.)]))
+        stage['calls'] += 1
+        stage['wall'] += time.time() - wall
+        stage['cpu'] += time.process_time() - cpu
+
+# Make a configuration for calling this module as a library
+def make_config(**kwargs):
+    """ Returns an argparse.Namespace of the command-line option defaults
+        (see make_parser), updated with the passed keyword arguments. Options
+        are named by their destination, e.g. outdirname for -o/--outdir.
+        Raises ValueError for an unknown option name.
+
+        The configuration can be passed to the library functions (those
+        that accept a config argument), or applied with use_config.
+    """
+    config = make_parser().parse_args([])
+    for name, value in kwargs.items():
+        if not hasattr(config, name):
+            raise ValueError("Unknown calculate_ani.py option: %s" % name)
+        setattr(config, name, value)
+    return config
+
+# Run with a configuration in place of the command-line options
+@contextlib.contextmanager
+def use_config(config):
+    """ Context manager that sets the module-level options to the passed
+        configuration (see make_config), and restores them on exit. The
+        output directory, if any, is created, and the result store, if
+        any, is opened and kept open for later calls. The run report and
+        the aligner output parsed while jobs ran (stream_results) are
+        reset, so that they cover only this call.
+
+        Functions that would stop the command-line script with an error
+        raise RuntimeError instead, after logging the error, so that a
+        long-running process can carry on.
+
+        Configurations are applied one at a time: a thread entering
+        use_config waits for any other thread to leave it.
+
+        - config is a configuration, as returned by make_config
+    """
+    global options, store
+    with config_lock:
+        saved = options, store
+        options = config
+        store = None
+        if config.store is not None:
+            if config.store not in config_stores:
+                config_stores[config.store] = open_result_store(config.store)
+            store = config_stores[config.store]
+        if config.outdirname is not None:
+            os.makedirs(config.outdirname, exist_ok=True)
+        run_report.update(started=time.time(),
+                          stages=collections.OrderedDict(), jobs=[])
+        stream_results.clear()
+        try:
+            yield config
+        except SystemExit as exc:
+            raise RuntimeError("calculate_ani.py stopped with an error " +\
+                                   "(see log)") from exc
+        finally:
+            options, store = saved
+
+# Allow a function to be called with an explicit configuration
+def accepts_config(func):
+    """ Function decorator adding an optional config keyword argument to
+        the decorated function. If a configuration is passed, the function
+        is run with it (see use_config). Otherwise, it runs with the current
+        options: the command-line options, an enclosing use_config, or, if
+        neither has been set, the default configuration.
+
+        - func is the function to decorate
+    """
+    @functools.wraps(func)
+    def wrapper(*args, config=None, **kwargs):
+        if config is None and options is not None:
+            return func(*args, **kwargs)
+        with use_config(config or make_config()):
+            return func(*args, **kwargs)
+    return wrapper
+
+# Get a value calculated from an input file, calculating it if not cached
+def cached_genome_value(filename, name, func):
+    """ Returns func(filename), reusing the result of any earlier call with
+        the same file and name (see genome_cache) unless the file has since
+        changed.
+
+        - filename is the location of the input file
+
+        - name identifies the value calculated, e.g. 'length'
+
+        - func is a function of the file location that calculates the value
+    """
+    stat = os.stat(filename)
+    key = (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+    values = genome_cache.setdefault(key, {})
+    if name not in values:
+        values[name] = func(filename)
+    return values[name]
+
+@accepts_config
+def calculate_aaim(infiles, references=None):
+    return calculate_anim(infiles, prog=options.promer_exe, method='AAIm',
+                          references=references)
 
 
 # METHOD: ANIm
 # This method uses NUCmer to calculate pairwise alignments for the input
 # organisms, without chopping sequences into fragments. We follow the method
 # of Richter et al. (2009)
-def calculate_anim(infiles, prog='nucmer'):
+@accepts_config
+def calculate_anim(infiles, prog='nucmer', method='ANIm', references=None):
     """ Calculate ANI by the ANIm method, as described in Richter et al (2009)
         Proc Natl Acad Sci USA 106: 19126-19131 doi:10.1073/pnas.0906412106.
 
@@ -168,33 +495,44 @@ def calculate_anim(infiles, prog='nucmer'):
         comparison.
 
         The matrices are written to file in a plain text tab-separated format.
+
+        If references is given, infiles are treated as query sequences and
+        only query-versus-reference comparisons are made, giving rectangular
+        matrices (see write_pairwise_tables).
+
+        With options.prefilter, pairs whose ANI estimated from MinHash
+        sketches falls below the threshold are not aligned; the estimate is
+        reported as their percentage identity (see prefilter_pairs).
+
+        With options.one_to_one, overlapping alignments are filtered out as
+        the .delta files are parsed (see one_to_one_mask).
     """
     logger.info("Running ANIm method")
-    org_lengths = get_org_lengths(infiles)
-    pairwise_nucmer(infiles, prog=prog)
-    lengths, sim_errors, perc_ids, perc_aln = process_delta(org_lengths)
+    allfiles = list(infiles) + [fn for fn in references or [] \
+                                    if fn not in infiles]
+    pack_input_files(allfiles)
+    org_lengths = get_org_lengths(allfiles)
+    org_hashes = get_org_hashes(allfiles)
+    skipped = prefilter_pairs(infiles, references)
+    comparisons = pairwise_nucmer(infiles, org_hashes, org_lengths,
+                                  prog=prog, method=method,
+                                  references=references, exclude=skipped)
+    results = process_delta(org_lengths, comparisons,
+                            new_pairwise_results(infiles, references))
+    add_prefilter_estimates(skipped, org_lengths, results)
     # Sanity check print for organisms of same species
     #for k, v in sorted(perc_ids.items()):
     #    if v > 0.95:
     #        print k, v
     # Write output to file
-    write_table('aln_lengths.tab', org_lengths.keys(), lengths,
-                "Aligment lengths")
-    write_table('sim_errors.tab', org_lengths.keys(), sim_errors,
-                "Similarity errors")
-
-    perc_ids, names = write_table('perc_ids.tab', org_lengths.keys(), perc_ids,
-                           "ANIm")
-    perc_aln, _ = write_table('perc_aln.tab', org_lengths.keys(), perc_aln,
-                           "Minimum % aligned nt")
-
-    return perc_ids, perc_aln, names
+    return write_pairwise_tables(org_lengths, results, method)
 
 # METHOD: ANIb
 # This method uses BLAST to calculate pairwise alignments for input organisms,
 # fragmented into consecutive 1020bp fragments, as described in Goris et al.
 # (2007).
-def calculate_anib(infiles):
+@accepts_config
+def calculate_anib(infiles, references=None):
     """ Calculate ANI by the ANIb method, as described in Goris et al. (2007)
         Int J Syst Evol Micr 57: 81-91. doi:10.1099/ijs.0.64483-0.
 
@@ -218,33 +556,306 @@ def calculate_anib(infiles):
         (perc_ids.tab), and minimum aligned percentage (perc_aln.tab) of
         each genome, for each pairwise comparison. These are written to the
         output directory in plain text tab-separated format.
+
+        If references is given, infiles are treated as query sequences: only
+        the queries are fragmented, BLAST databases are only built for the
+        references, and only query-versus-reference comparisons are made,
+        giving rectangular matrices (see write_pairwise_tables).
+
+        With options.blast_batch, a single BLAST database is built from all
+        (reference) sequences, and each fragment file is BLASTed against it
+        once; the hits are then split by subject genome (see batch_blast).
+
+        With options.prefilter, distant pairs are skipped as for ANIm.
+
+        With options.sample_fragments, only a random subset of each query's
+        fragments is BLASTed (see fragment_input_files). Aligned lengths and
+        similarity errors are scaled up by the query's total number of
+        fragments over the number sampled, to estimate whole-genome values,
+        and bootstrap confidence intervals for each ANI are written
+        alongside perc_ids.tab (see bootstrap_ani_intervals).
     """
     logger.info("Running ANIb method")
-    fragment_input_files(infiles)
-    org_lengths = get_org_lengths(infiles)
-    make_blast_dbs(infiles)
-    pairwise_blast(get_input_files(options.outdirname, '.fasta'))
-    lengths, sim_errors, perc_ids, perc_aln = process_blast(org_lengths)
+    if references is None:
+        queries = references = infiles
+    else:
+        queries = infiles
+    allfiles = list(infiles) + [fn for fn in references if fn not in infiles]
+    pack_input_files(allfiles)
+    frag_counts = fragment_input_files(queries)
+    org_lengths = get_org_lengths(allfiles)
+    org_hashes = get_org_hashes(allfiles)
+    skipped = prefilter_pairs(queries, None if queries is references \
+                                  else references)
+    if options.sample_fragments is not None:
+        fragfiles = [make_sample_filename(fn) for fn in queries]
+        reffiles = None if queries is references else \
+            [make_fragment_filename(fn) for fn in references]
+        sampled = dict((org, min(count, options.sample_fragments)) for \
+                           org, count in frag_counts.items())
+        scales = dict((org, frag_counts[org] / float(sampled[org] or 1)) \
+                          for org in frag_counts)
+    else:
+        fragfiles = [make_fragment_filename(fn) for fn in queries]
+        reffiles = None if queries is references else \
+            [make_fragment_filename(fn) for fn in references]
+    results = new_pairwise_results(queries, None if queries is references \
+                                                else references)
+    if options.blast_batch:
+        blastdb, genome_index = make_combined_blast_db(references)
+        comparisons = batch_blast(fragfiles, org_hashes, org_lengths,
+                                  blastdb, len(genome_index),
+                                  references=reffiles, exclude=skipped)
+        parser = make_batch_blast_parser(genome_index)
+        if options.sample_fragments is not None:
+            parser = make_scaled_parser(parser, scales)
+        process_comparisons(org_lengths, comparisons, parser, results)
+    else:
+        make_blast_dbs(references)
+        comparisons = pairwise_blast(fragfiles, org_hashes, org_lengths,
+                                     references=reffiles, exclude=skipped)
+        process_blast(org_lengths, comparisons, results,
+                      scales if options.sample_fragments is not None \
+                          else None)
+    add_prefilter_estimates(skipped, org_lengths, results)
+    if isinstance(results, SparseResults):
+        if options.sample_fragments is not None:
+            logger.warning("Bootstrap intervals are not written with " +\
+                               "--sparse_output")
+        return write_pairwise_tables(org_lengths, results, "ANIb")
+    if options.sample_fragments is not None:
+        rows, cols = list(results.rows), list(results.cols)
+        ci_low, ci_high = bootstrap_ani_intervals(comparisons, sampled,
+                                                  results)
+        write_matrix('perc_ids_ci_low', rows, cols, ci_low,
+                     "ANIb %d%% bootstrap interval, lower bound" % \
+                         (100 * BOOTSTRAP_LEVEL))
+        write_matrix('perc_ids_ci_high', rows, cols, ci_high,
+                     "ANIb %d%% bootstrap interval, upper bound" % \
+                         (100 * BOOTSTRAP_LEVEL))
     # Sanity check print for organisms of same species
-    for k, v in sorted(perc_ids.items()):
-        if v > 0.95:
-            print(k, v)
+    rows, cols = list(results.rows), list(results.cols)
+    for idx, jdx in np.argwhere(results.perc_ids > 0.95):
+        if results.rows is not results.cols or idx < jdx:
+            print((rows[idx], cols[jdx]), results.perc_ids[idx, jdx])
     # Write output to file
-    write_table('aln_lengths.tab', org_lengths.keys(), lengths,
-                "Aligment lengths")
-    write_table('sim_errors.tab', org_lengths.keys(), sim_errors,
-                "Similarity errors")
-    perc_ids, names = write_table('perc_ids.tab', org_lengths.keys(), perc_ids,
-                           "ANIb")
-    perc_aln, _ = write_table('perc_aln.tab', org_lengths.keys(), perc_aln,
-                           "Minimum % aligned nt")
+    return write_pairwise_tables(org_lengths, results, "ANIb")
+
+# Write the pairwise comparison results to the output directory
+def write_pairwise_tables(org_lengths, results, label):
+    """ Writes the aligned length, similarity error, percentage identity and
+        percentage aligned tables for a set of pairwise comparisons (see
+        write_matrix), and returns a tuple of (perc_ids, perc_aln, names)
+        for plotting.
+
+        If the results are rectangular, with a row for each query and a
+        column for each reference, perc_aln.tab holds the percentage of each
+        query that is aligned, and perc_aln_ref.tab that of each reference.
+        The heatmap needs square matrices, so perc_aln is then returned as
+        None.
+
+        - org_lengths is a dictionary of total sequence lengths for each
+              input sequence
+
+        A SparseResults is written as a graph instead (see
+        write_sparse_tables).
+
+        - results is a PairwiseResults, as returned by process_comparisons
+
+        - label describes the ANI method, for the perc_ids.tab header
+    """
+    if isinstance(results, SparseResults):
+        return write_sparse_tables(results, label)
+    rows, cols = list(results.rows), list(results.cols)
+    write_matrix('aln_lengths', rows, cols, results.lengths,
+                 "Aligment lengths")
+    write_matrix('sim_errors', rows, cols, results.sim_errors,
+                 "Similarity errors")
+    write_matrix('perc_ids', rows, cols, results.perc_ids, label)
+    if results.rows is results.cols:
+        write_matrix('perc_aln', rows, cols, results.perc_aln,
+                     "Minimum % aligned nt")
+        return results.perc_ids, results.perc_aln, rows
+    write_matrix('perc_aln', rows, cols, results.perc_aln,
+                 "% of query aligned nt")
+    ref_lengths = np.array([org_lengths[name] for name in cols], dtype=float)
+    write_matrix('perc_aln_ref', rows, cols, results.lengths / ref_lengths,
+                 "% of reference aligned nt")
+    return results.perc_ids, None, rows
+
+# Write sparse pairwise comparison results, and the species clusters they give
+def write_sparse_tables(results, label):
+    """ Writes the comparisons kept in a SparseResults as a graph (see
+        write_sparse_graph), then clusters the organisms into species over
+        that graph (see cluster_species) and writes the clusters to
+        species_clusters.tab. Returns a tuple of (None, None, names), as
+        there are no matrices to plot.
+
+        - results is a SparseResults, as returned by process_comparisons
+
+        - label describes the ANI method, for the output file headers
+    """
+    rows, cols = list(results.rows), list(results.cols)
+    edges = np.array(results.edges, dtype=SPARSE_EDGE_DTYPE)
+    edges.sort(order=['query', 'subject'])
+    logger.info("%d pairs with ANI of at least %s" % (len(edges),
+                                                       results.min_ani))
+    write_sparse_graph('ani_graph', rows, cols, edges,
+                       "%s, pairs with ANI >= %s" % (label, results.min_ani))
+    names = sorted(set(rows) | set(cols))
+    node_index = dict((name, idx) for idx, name in enumerate(names))
+    qnodes = np.array([node_index[name] for name in rows], dtype=np.int64)
+    snodes = np.array([node_index[name] for name in cols], dtype=np.int64)
+    clusters = cluster_species(len(names), qnodes[edges['query']],
+                               snodes[edges['subject']], edges['perc_ids'],
+                               results.min_ani)
+    write_species_clusters('species_clusters.tab', names, clusters,
+                           "%s species clusters, %s linkage at ANI >= %s" % \
+                               (label, options.species_linkage,
+                                options.species_threshold))
+    return None, None, rows
+
+# Write a sparse graph of pairwise results to the output directory
+@timed_stage('write_matrix')
+def write_sparse_graph(name, rows, cols, edges, comment=''):
+    """ Writes the passed graph of pairwise results to the output directory
+        in the format chosen with options.matrix_format:
+
+        - tab: as the tab-separated plain text edge list ani_edges.tab, with
+              a line for each pair giving the query and subject names and
+              each result field
+
+        - npy: as compressed sparse row (CSR) arrays in name.npz: indptr and
+              indices, and an array of values for each result field, with
+              the row and column names in row_names.npy and col_names.npy
+              (see write_name_arrays)
+
+        - hdf5: as the same CSR arrays in the group name of results.h5, with
+              the comment as its 'comment' attribute, and the row and column
+              names in the row_names and col_names datasets. This needs
+              h5py.
+
+        When every organism is compared with every other, each pair appears
+        once.
+
+        - name is the name of the graph
+
+        - rows, cols are lists of the row and column names, in index order
+
+        - edges is a SPARSE_EDGE_DTYPE array, sorted by query and subject
+
+        - comment is an optional comment string for the output file
+    """
+    fields = SPARSE_EDGE_DTYPE.names[2:]
+    if options.matrix_format == 'tab':
+        write_edge_table('ani_edges.tab', rows, cols, edges, comment)
+        return
+    counts = np.bincount(edges['query'], minlength=len(rows))
+    arrays = {'indptr': np.concatenate(([0], np.cumsum(counts))),
+              'indices': edges['subject'],
+              'shape': np.array([len(rows), len(cols)])}
+    for field in fields:
+        arrays[field] = edges[field]
+    if options.matrix_format == 'npy':
+        fname = os.path.join(options.outdirname, name + '.npz')
+        logger.info("Writing %s" % fname)
+        np.savez(fname, **arrays)
+        write_name_arrays(rows, cols)
+        return
+    try:
+        import h5py
+    except ImportError:
+        logger.error("HDF5 output requires h5py, but it was not found " +\
+                         "(exiting)")
+        sys.exit(1)
+    fname = os.path.join(options.outdirname, 'results.h5')
+    logger.info("Writing %s to %s" % (name, fname))
+    with h5py.File(fname, 'a') as h5:
+        for key, names in (('row_names', rows), ('col_names', cols)):
+            if key in h5:
+                del h5[key]
+            h5.create_dataset(key, data=names, dtype=h5py.string_dtype())
+        if name in h5:
+            del h5[name]
+        group = h5.create_group(name)
+        for key, data in arrays.items():
+            group.create_dataset(key, data=data)
+        group.attrs['comment'] = comment
+
+# Write a sparse graph of pairwise results as a tab-separated edge list
+def write_edge_table(filename, rows, cols, edges, comment=''):
+    """ Writes a tab-separated plain text file with a line for each edge of
+        the passed graph: the query and subject names, then each result
+        field, with a header line naming the columns.
+
+        - filename is the name of the output file in the output directory
 
-    return perc_ids, perc_aln, names
+        - rows, cols are lists of the row and column names, in index order
+
+        - edges is a SPARSE_EDGE_DTYPE array
+
+        - comment is an optional comment string for the output file
+    """
+    fname = os.path.join(options.outdirname, filename)
+    try:
+        logger.info("Opening %s for writing" % fname)
+        fh = open(fname, 'w')
+        print( "# calculate_ani.py %s" % time.asctime(), file=fh)
+        if len(comment):
+            print( "# %s" % comment, file=fh)
+    except:
+        logger.error("Could not open file %s for output (exiting)" % fname)
+        logger.error(last_exception())
+        sys.exit(1)
+    print( '\t'.join(('query', 'subject') + SPARSE_EDGE_DTYPE.names[2:]),
+           file=fh)
+    for start in range(0, len(edges), 1 << 16):
+        block = edges[start:start + (1 << 16)].tolist()
+        fh.write(''.join('\t'.join([rows[edge[0]], cols[edge[1]]] + \
+                                       list(map(str, edge[2:]))) + '\n' \
+                             for edge in block))
+    fh.close()
+    logger.info("Wrote data to %s" % fname)
+
+# Write species cluster assignments to a plain text tab-separated table
+def write_species_clusters(filename, names, clusters, comment=''):
+    """ Writes a tab-separated plain text file giving the species cluster
+        of each organism, and the size of that cluster.
+
+        - filename is the name of the output file in the output directory
+
+        - names is a list of organism names
+
+        - clusters is an array of cluster numbers, in names order, as
+              returned by cluster_species
+
+        - comment is an optional comment string for the output file
+    """
+    fname = os.path.join(options.outdirname, filename)
+    sizes = np.bincount(clusters)
+    try:
+        logger.info("Opening %s for writing" % fname)
+        fh = open(fname, 'w')
+        print( "# calculate_ani.py %s" % time.asctime(), file=fh)
+        if len(comment):
+            print( "# %s" % comment, file=fh)
+        print( "organism\tcluster\tcluster_size", file=fh)
+        for name, cluster in zip(names, clusters.tolist()):
+            print( "%s\t%d\t%d" % (name, cluster + 1, sizes[cluster]),
+                   file=fh)
+        fh.close()
+    except:
+        logger.error("Could not write species clusters to %s (exiting)" % \
+                         fname)
+        logger.error(last_exception())
+        sys.exit(1)
+    logger.info("Wrote %d species clusters to %s" % (len(sizes), fname))
 
 # METHOD: TETRA
 # This method calculates tetranucleotide frequencies for the input organisms,
 # as used by JSpecies, and described in Richter et al (2009) and Teeling et
 # al. (2004) and Teeling et al. (2004)
+@accepts_config
 def calculate_tetra(infiles):
     """ Calculate tetranucleotide frequencies for each input sequence, and
         their Pearson correlation, as described in Teeling et al. (2004a)
@@ -260,13 +871,100 @@ def calculate_tetra(infiles):
         tetra_z_scores.tab). The Pearson correlation between Z-scores for
         input sequences is then used as a measure of sequence similarity and
         written to tetra_corr.tab.
+
+        If the NxN correlation matrix would use more than half of the
+        available memory, it is instead written to tetra_corr.npy as a
+        memory-mapped array, and the plain text table is not written.
+
+        There is no alignment coverage for this method, so None is returned
+        in place of the percentage aligned matrix.
     """
     logger.info("Running TETRA method")
+    pack_input_files(infiles)
     tetra_z = calc_org_tetra(infiles)   # Calculate Z-scores for tetranucleotides
     write_tetraz('tetra_z_scores.tab', tetra_z)
-    corr_z = calc_tetra_corr(tetra_z) # Calculate Pearson correlation
-    write_table('tetra_corr.tab', tetra_z.keys(), corr_z,
-                "TETRA")
+    # Calculate Pearson correlation, spilling to disk if it won't fit
+    matrix_bytes = 4 * len(tetra_z) ** 2
+    avail = available_memory()
+    if avail is not None and matrix_bytes > avail / 2:
+        corr_z, names = calc_tetra_corr_matrix(tetra_z,
+            outfile=os.path.join(options.outdirname, 'tetra_corr.npy'))
+        write_name_arrays(names, names)
+        logger.warning("TETRA correlation matrix too large for memory; " +\
+                           "not writing tetra_corr.tab")
+    else:
+        corr_z, names = calc_tetra_corr_matrix(tetra_z)
+        write_matrix('tetra_corr', names, names, corr_z, "TETRA")
+
+    return corr_z, None, names
+
+# METHOD: ANIk
+# This method estimates ANI without an external aligner, by mapping fixed
+# length fragments of each query genome onto the reference genome using
+# shared minimizers, in the manner of FastANI
+@accepts_config
+def calculate_anik(infiles, references=None):
+    """ Calculate ANI by an aligner-free approximation of the FastANI method
+        of Jain et al. (2018) Nat Commun 9: 5114.
+        doi:10.1038/s41467-018-07641-9.
+
+        A minimizer index of each input file is written to the output
+        directory (see kmer_index_file). For each pairwise comparison, each
+        complete ANIK_FRAGSIZE fragment of the query genome is mapped to
+        the window of the reference genome that shares the most of its
+        minimizers, and the fragment's identity is estimated from the
+        fraction of its minimizers shared (see kmer_ani). Fragments with an
+        estimated identity of at least ANIK_MIN_IDENTITY, keeping only the
+        best fragment mapped to each reference window, count as aligned.
+
+        As for ANIm and ANIb, the results are written as matrices of aligned
+        length (the total length of mapped fragments), similarity errors,
+        ANI (the mean identity of mapped fragments), and minimum percentage
+        aligned, to the output directory. Results are added to, and reused
+        from, the result store (--store).
+
+        No external programs are needed, and each genome is indexed only
+        once, so this method is suited to a first pass over large numbers
+        of genomes. Comparisons are run in parallel, using up to
+        options.threads processes.
+
+        If references is given, infiles are treated as query sequences and
+        only query-versus-reference comparisons are made, giving rectangular
+        matrices (see write_pairwise_tables).
+
+        With options.prefilter, distant pairs are skipped as for ANIm.
+    """
+    logger.info("Running ANIk method")
+    allfiles = list(infiles) + [fn for fn in references or [] \
+                                    if fn not in infiles]
+    pack_input_files(allfiles)
+    org_lengths = get_org_lengths(allfiles)
+    org_hashes = get_org_hashes(allfiles)
+    skipped = prefilter_pairs(infiles, references)
+    index_input_files(allfiles)
+    params = "k=%d w=%d fragsize=%d minid=%s" % \
+        (ANIK_KMER, ANIK_WINDOW, ANIK_FRAGSIZE, ANIK_MIN_IDENTITY)
+    # Identical sequences under different names are compared only once, as
+    # in schedule_comparisons
+    comparisons, pending = [], collections.OrderedDict()
+    for f1, f2 in make_file_pairs(infiles, references, skipped):
+        qname = os.path.splitext(os.path.split(f1)[-1])[0]
+        sname = os.path.splitext(os.path.split(f2)[-1])[0]
+        key = make_result_key(org_hashes[qname], org_hashes[sname],
+                              'ANIk', params)
+        outfile = None
+        if key in pending or fetch_result(key) is None:
+            outfile = make_kmer_index_filename(f1)
+            pending.setdefault(key, (f1, f2))
+        comparisons.append(Comparison(qname, sname, key, outfile))
+    logger.info("%d comparisons, %d to run" % (len(comparisons),
+                                                len(pending)))
+    totals = run_kmer_comparisons(pending)
+    results = process_comparisons(org_lengths, comparisons,
+                                  lambda comparison: totals[comparison.key],
+                                  new_pairwise_results(infiles, references))
+    add_prefilter_estimates(skipped, org_lengths, results)
+    return write_pairwise_tables(org_lengths, results, "ANIk")
 
 
 # SUPPORT FUNCTIONS
@@ -290,7 +988,7 @@ def write_tetraz(filename, tetra_z):
         logger.error("Could not open %s for writing (exiting)")
         sys.exit(1)
     orgs = sorted(tetra_z.keys())
-    tets = sorted(tetra_z.values()[0].keys())
+    tets = sorted(next(iter(tetra_z.values())).keys())
     # Write headers
     print( "# calculate_ani.py %s" % time.asctime(), file=fh)
     print( "# tetranucleotide frequency Z-scores", file=fh)
@@ -300,458 +998,3534 @@ def write_tetraz(filename, tetra_z):
         print( '\t'.join(outstr), file=fh)
     fh.close()
 
-# Calculate Pearson's correlation coefficient from the Z-scores for each
-# tetranucleotide. If we're forcing rpy2, might as well use that, though...
-def calc_tetra_corr(tetra_z):
-    """ Calculate Pearson correlation coefficient from Z scores for each
-        tetranucleotide. This is done longhand here, which is fast enough,
-        but for robustness we might want to just hand this over to R,
-        as it is a dependency for this method anyway (TODO).
+# Calculate Pearson's correlation coefficient from the Z-scores for each
+# tetranucleotide, as a dictionary keyed by organism pair
+def calc_tetra_corr(tetra_z):
+    """ Calculate Pearson correlation coefficient from Z scores for each
+        tetranucleotide, returning a dictionary keyed by (org1, org2) tuples
+        for each unique pair of input sequences.
+
+        Note that we report a correlation by this method, rather than a
+        percentage identity.
+
+        - tetra_z is a dictionary of tetranucleotide Z-scores, for each
+              input sequence
+    """
+    corr, orgs = calc_tetra_corr_matrix(tetra_z)
+    corrs = {}
+    for idx, o1 in enumerate(orgs[:-1]):
+        for jdx in range(idx + 1, len(orgs)):
+            corrs[(o1, orgs[jdx])] = float(corr[idx, jdx])
+    return corrs
+
+# Calculate the full matrix of Pearson's correlation coefficients between
+# tetranucleotide Z-score vectors, using blocked matrix multiplication
+@timed_stage('calc_tetra_corr_matrix')
+def calc_tetra_corr_matrix(tetra_z, outfile=None, blocksize=None):
+    """ Returns a tuple of (matrix, names), where matrix is an NxN float32
+        array of Pearson correlation coefficients between the Z-score vectors
+        of each input sequence, and names is the sorted list of organisms
+        giving the row and column order.
+
+        The Z-score vectors are stacked into a single Nx256 matrix, and each
+        row is centred and scaled to unit length, so that the correlation
+        matrix is the product of this matrix with its own transpose. This
+        product is calculated in blocks of rows, so that the working memory
+        is bounded by the block size rather than by N*N.
+
+        - tetra_z is a dictionary of tetranucleotide Z-scores, for each
+              input sequence
+
+        - outfile, if given, is the location of a .npy file that the result
+              is written to as a memory-mapped array, for results that do not
+              fit in RAM
+
+        - blocksize is the number of rows calculated at a time; by default
+              this is chosen to keep each block at about 64MB
+    """
+    orgs = sorted(tetra_z.keys())
+    tets = sorted(tetra_z[orgs[0]].keys())
+    zmat = np.array([[tetra_z[org][tet] for tet in tets] for org in orgs],
+                    dtype=np.float32)
+    zmat -= zmat.mean(axis=1)[:, np.newaxis]
+    norms = np.sqrt((zmat * zmat).sum(axis=1))
+    # Sequences with constant Z-scores have no defined correlation; leaving
+    # their rows as zero reports a correlation of zero with every sequence
+    norms[norms == 0] = 1
+    zmat /= norms[:, np.newaxis]
+    norgs = len(orgs)
+    if outfile is None:
+        corr = np.empty((norgs, norgs), dtype=np.float32)
+    else:
+        logger.info("Writing memory-mapped TETRA correlations to %s" % \
+                        outfile)
+        corr = np.lib.format.open_memmap(outfile, mode='w+',
+                                         dtype=np.float32,
+                                         shape=(norgs, norgs))
+    if blocksize is None:
+        blocksize = max(1, (64 * 1024 * 1024) // (4 * norgs))
+    for start in range(0, norgs, blocksize):
+        block = np.dot(zmat[start:start + blocksize], zmat.T)
+        corr[start:start + blocksize] = np.clip(block, -1, 1)
+    if outfile is not None:
+        corr.flush()
+    return corr, orgs
+
+# Return the amount of physical memory currently available, in bytes
+def available_memory():
+    """ Returns the number of bytes of physical memory currently available,
+        or None if this cannot be determined on this platform.
+    """
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+# Calculate tetranucleotide values for each input sequence
+@accepts_config
+@timed_stage('calc_org_tetra')
+def calc_org_tetra(infiles):
+    """ We calculate the mono-, di-, tri- and tetranucleotide frequencies
+        for each sequence, on each strand, and follow Teeling et al. (2004)
+        in calculating a corresponding Z-score for each observed
+        tetranucleotide frequency, dependent on the mono-, di- and tri-
+        nucleotide frequencies for that input sequence.
+
+        Sequences are 2-bit encoded as NumPy arrays and k-mers are counted
+        with np.bincount over rolling k-mer indices (see count_kmers). Counts
+        for the reverse strand are obtained by permuting the forward strand
+        counts, rather than by building the reverse complement.
+
+        Returns a dictionary, keyed by organism, of dictionaries of Z-scores
+        keyed by tetranucleotide. All 256 tetranucleotides are present for
+        every organism.
+    """
+    org_tetraz = {}
+    for fn in infiles:
+        org = os.path.splitext(os.path.split(fn)[-1])[0]
+        org_tetraz[org] = dict(zip(kmer_labels(4),
+            cached_genome_value(fn, 'tetra_z', calc_file_tetra).tolist()))
+    return org_tetraz
+
+# Calculate tetranucleotide Z-scores for one input sequence file
+def calc_file_tetra(fn):
+    """ Returns an array of tetranucleotide Z-scores for the sequences in
+        the passed FASTA file, indexed by 2-bit encoded tetranucleotide (see
+        calc_org_tetra).
+
+        - fn is the location of the FASTA file
+    """
+    logger.info("Calculating tetranucleotide frequencies for %s" % fn)
+    # For the Teeling et al. method, the Z-scores require us to count
+    # mono, di, tri and tetranucleotide sequences. Each array is indexed
+    # by the 2-bit encoded k-mer (A=0, C=1, G=2, T=3).
+    counts = [np.zeros(4 ** k, dtype=np.int64) for k in range(1, 5)]
+    for codes in iter_genome_codes(genome_source(fn)):
+        for k in range(1, 5):
+            counts[k - 1] += count_kmers(codes, k)
+    # The Teeling et al. algorithm requires us to consider both strand
+    # orientations; k-mer counts on the reverse strand are the forward
+    # counts of each k-mer's reverse complement
+    monocnt, dicnt, tricnt, tetracnt = \
+        [cnt + cnt[revcomp_kmer_index(k)] for k, cnt in \
+             enumerate(counts, 1)]
+    logger.info("%d mono, %d di, %d tri, %d tetranucleotides found" %\
+                    tuple(np.count_nonzero(c) for c in
+                          (monocnt, dicnt, tricnt, tetracnt)))
+    return tetra_zscores(dicnt, tricnt, tetracnt)
+
+# Calculate Teeling et al. (2004) Z-scores from di-, tri- and tetranucleotide
+# count arrays
+def tetra_zscores(dicnt, tricnt, tetracnt):
+    """ Returns an array of Z-scores, indexed by 2-bit encoded
+        tetranucleotide, following Teeling et al. (2004).
+
+        For tetranucleotide t = t1t2t3t4 the expected count is
+        N(t1t2t3) * N(t2t3t4) / N(t2t3), and the variance is approximated
+        from the same counts. Where the variance estimate is zero we fall
+        back to 1 / N(t2t3)^2, and to zero where N(t2t3) is itself zero.
+
+        - dicnt, tricnt, tetracnt are count arrays of length 16, 64 and 256,
+              as returned by count_kmers
+    """
+    idx = np.arange(256)
+    den = dicnt[(idx >> 2) & 15].astype(np.float64)
+    pre = tricnt[idx >> 2].astype(np.float64)
+    suf = tricnt[idx & 63].astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Following Teeling (2004), we calculate expected frequencies for
+        # each tetranucleotide; we ignore ambiguity symbols
+        tetra_exp = np.where(den > 0, pre * suf / den, 0.)
+        # Following Teeling (2004) we approximate the std dev of each
+        # tetranucleotide
+        tetra_sd = np.sqrt(np.clip(tetra_exp * (den - pre) * (den - suf),
+                                   0, None) / (den * den))
+        tetra_z = (tetracnt - tetra_exp) / tetra_sd
+        zero_var = ~(tetra_sd > 0)
+        tetra_z[zero_var] = np.where(den[zero_var] > 0,
+                                     1. / (den[zero_var] * den[zero_var]), 0.)
+    if zero_var.any():
+        labels = kmer_labels(4)
+        logger.warning("Zero variance for tetranucleotides %s" %\
+                           [labels[i] for i in np.flatnonzero(zero_var)])
+    return tetra_z
+
+# Lookup table mapping ASCII nucleotide symbols to 2-bit codes; every other
+# symbol (including IUPAC ambiguity codes) maps to 4
+NT_CODES = np.full(256, 4, dtype=np.uint8)
+for _code, _nts in enumerate(('Aa', 'Cc', 'Gg', 'Tt')):
+    for _nt in _nts:
+        NT_CODES[ord(_nt)] = _code
+
+# 2-bit encode a nucleotide sequence
+def encode_sequence(seq):
+    """ Returns a uint8 NumPy array encoding the passed sequence string as
+        A=0, C=1, G=2, T=3. Ambiguity symbols are encoded as 4, and any k-mer
+        containing one is ignored by count_kmers.
+
+        - seq is a nucleotide sequence string
+    """
+    return NT_CODES[np.frombuffer(seq.encode('ascii'), dtype=np.uint8)]
+
+# Count all k-mers in a 2-bit encoded sequence
+def count_kmers(codes, k):
+    """ Returns an array of length 4**k, giving the number of occurrences of
+        each k-mer in the passed encoded sequence, indexed by the 2-bit
+        encoding of the k-mer. Windows containing ambiguity symbols are not
+        counted.
+
+        - codes is a uint8 array, as returned by encode_sequence
+
+        - k is the k-mer length
+    """
+    nwin = len(codes) - k + 1
+    if nwin <= 0:
+        return np.zeros(4 ** k, dtype=np.int64)
+    # Build the rolling k-mer index one base at a time, so that memory use
+    # is a small multiple of the sequence length whatever the value of k
+    kmers = np.zeros(nwin, dtype=np.intp)
+    ambiguous = np.zeros(nwin, dtype=bool)
+    for offset in range(k):
+        window = codes[offset:offset + nwin]
+        kmers <<= 2
+        kmers |= window & 3
+        ambiguous |= window > 3
+    return np.bincount(kmers[~ambiguous], minlength=4 ** k)
+
+# Return the permutation that maps each k-mer index to that of its reverse
+# complement
+def revcomp_kmer_index(k):
+    """ Returns an integer array rc such that rc[i] is the 2-bit encoded index
+        of the reverse complement of the k-mer with index i. With the A=0,
+        C=1, G=2, T=3 encoding the complement of a base b is 3 - b.
+
+        - k is the k-mer length
+    """
+    idx = np.arange(4 ** k)
+    rc = np.zeros_like(idx)
+    for pos in range(k):
+        base = (idx >> (2 * pos)) & 3
+        rc = (rc << 2) | (3 - base)
+    return rc
+
+# Return k-mer strings in 2-bit encoded index order
+def kmer_labels(k):
+    """ Returns a list of the 4**k k-mer strings, in the order of their 2-bit
+        encoded index (which is also lexicographic order).
+
+        - k is the k-mer length
+    """
+    return [''.join(kmer) for kmer in itertools.product('ACGT', repeat=k)]
+
+# Hash 64-bit integers with the MurmurHash3 finaliser
+def hash64(values):
+    """ Returns a uint64 array of well-mixed hashes of the passed uint64
+        array, using the 64-bit finaliser of MurmurHash3. Multiplication
+        wraps around modulo 2**64, as intended.
+
+        - values is a uint64 NumPy array
+    """
+    values = values ^ (values >> np.uint64(33))
+    values *= np.uint64(0xff51afd7ed558ccd)
+    values ^= values >> np.uint64(33)
+    values *= np.uint64(0xc4ceb9fe1a85ec53)
+    values ^= values >> np.uint64(33)
+    return values
+
+# Hash the canonical k-mers of a 2-bit encoded sequence
+def canonical_kmer_hashes(codes, k=SKETCH_KMER, keep_ambiguous=False):
+    """ Returns a uint64 array of the hashes (see hash64) of each canonical
+        k-mer in the passed encoded sequence, in sequence order. The
+        canonical k-mer is the lesser of the 2-bit encodings of the k-mer and
+        its reverse complement, so that both strands give the same hashes.
+        Windows containing ambiguity symbols are skipped or, if
+        keep_ambiguous is True, given the largest possible hash, so that
+        the array index is the k-mer's position in the sequence.
+
+        - codes is a uint8 array, as returned by encode_sequence
+
+        - k is the k-mer length, no more than 32
+    """
+    nwin = len(codes) - k + 1
+    if nwin <= 0:
+        return np.zeros(0, dtype=np.uint64)
+    # As for count_kmers, build the forward and reverse complement k-mers
+    # one base at a time
+    fwd = np.zeros(nwin, dtype=np.uint64)
+    rev = np.zeros(nwin, dtype=np.uint64)
+    ambiguous = np.zeros(nwin, dtype=bool)
+    for offset in range(k):
+        window = codes[offset:offset + nwin]
+        base = (window & 3).astype(np.uint64)
+        fwd <<= np.uint64(2)
+        fwd |= base
+        rev |= (np.uint64(3) - base) << np.uint64(2 * offset)
+        ambiguous |= window > 3
+    if keep_ambiguous:
+        hashes = hash64(np.minimum(fwd, rev))
+        hashes[ambiguous] = np.iinfo(np.uint64).max
+        return hashes
+    return hash64(np.minimum(fwd, rev)[~ambiguous])
+
+# Build a bottom-k MinHash sketch of one FASTA file
+def sketch_file(filename, size, k=SKETCH_KMER, chunksize=1 << 20):
+    """ Returns a sorted uint64 array holding the size smallest distinct
+        canonical k-mer hashes in the passed FASTA file (fewer, if the file
+        holds fewer distinct k-mers).
+
+        Sequences are read one at a time, and hashed in overlapping
+        windows of chunksize bases, so that memory use does not depend on
+        the length of the longest sequence.
+
+        - filename is the location of the input FASTA file, or of its
+              packed copy (see genome_source)
+
+        - size is the number of hashes to keep
+
+        - k is the k-mer length
+    """
+    sketch = np.zeros(0, dtype=np.uint64)
+    for codes in iter_genome_codes(filename):
+        for start in range(0, max(len(codes) - k + 1, 1), chunksize):
+            hashes = np.unique(canonical_kmer_hashes(
+                codes[start:start + chunksize + k - 1], k))
+            sketch = np.union1d(sketch, hashes[:size])[:size]
+    return sketch
+
+# Build MinHash sketches for each input file
+def sketch_input_files(infiles, size):
+    """ Returns a dictionary of bottom-k MinHash sketches (see sketch_file)
+        keyed by organism name, one for each input file. Files are sketched
+        in parallel, using up to options.threads processes.
+
+        - infiles is a list of input FASTA files
+
+        - size is the number of hashes in each sketch
+    """
+    logger.info("Sketching %d input files" % len(infiles))
+    args = [(genome_source(fn), size) for fn in infiles]
+    nprocs = min(options.threads, len(args))
+    if nprocs > 1:
+        pool = multiprocessing.Pool(nprocs)
+        sketches = pool.starmap(sketch_file, args)
+        pool.close()
+        pool.join()
+    else:
+        sketches = [sketch_file(*arg) for arg in args]
+    return dict((os.path.splitext(os.path.split(fn)[-1])[0], sketch) \
+                    for fn, sketch in zip(infiles, sketches))
+
+# Estimate ANI from MinHash sketches for each pair of organisms
+def estimate_mash_ani(qsketches, rsketches, k=SKETCH_KMER):
+    """ Returns an array with one row for each query sketch and one column
+        for each reference sketch, holding the ANI estimated from the Mash
+        distance between the two (Ondov et al. (2016) Genome Biol 17: 132.
+        doi:10.1186/s13059-016-0997-x).
+
+        For each pair, the Jaccard index j is estimated as the fraction of
+        the bottom-k sketch of the union of both sketches that is found in
+        both, and the Mash distance is D = -ln(2j / (1 + j)) / k. The ANI
+        estimate is 1 - D, or zero where no hashes are shared. Each query
+        is compared against all references at once.
+
+        - qsketches, rsketches are lists of sorted sketches, as returned by
+              sketch_file
+
+        - k is the k-mer length used to build the sketches
+    """
+    size = max([len(s) for s in list(qsketches) + list(rsketches)] + [1])
+    hash_max = np.iinfo(np.uint64).max
+    # Pad the reference sketches into a single array; the padding value
+    # sorts after every hash, and is never counted
+    refs = np.full((len(rsketches), size), hash_max, dtype=np.uint64)
+    for idx, sketch in enumerate(rsketches):
+        refs[idx, :len(sketch)] = sketch
+    ani = np.zeros((len(qsketches), len(rsketches)))
+    for idx, sketch in enumerate(qsketches):
+        if not len(sketch) or not len(rsketches):
+            continue
+        pos = np.minimum(np.searchsorted(sketch, refs), len(sketch) - 1)
+        shared = (sketch[pos] == refs) & (refs != hash_max)
+        # The union of the two sketches holds no duplicates once the shared
+        # hashes are removed from one of them; its size-th smallest hash
+        # bounds the bottom-k sketch of the union
+        query = np.full(size, hash_max, dtype=np.uint64)
+        query[:len(sketch)] = sketch
+        union = np.concatenate([np.broadcast_to(query, refs.shape),
+                                np.where(shared, hash_max, refs)], axis=1)
+        union.partition(size - 1, axis=1)
+        bound = union[:, size - 1:size]
+        nunion = np.minimum((union != hash_max).sum(axis=1), size)
+        nshared = (shared & (refs <= bound)).sum(axis=1)
+        jaccard = nshared / np.maximum(nunion, 1)
+        with np.errstate(divide='ignore'):
+            dist = -np.log(2 * jaccard / (1 + jaccard)) / k
+        ani[idx] = np.clip(1 - dist, 0, 1)
+    return ani
+
+# Identify pairwise comparisons that the MinHash prefilter lets us skip
+@timed_stage('prefilter_pairs')
+def prefilter_pairs(infiles, references=None):
+    """ Returns a dictionary, keyed by (query, subject) organism tuple, of the
+        estimated ANI (see estimate_mash_ani) of each pairwise comparison
+        whose estimate is below options.prefilter. These comparisons need
+        not be aligned. The dictionary is empty if options.prefilter is
+        not set.
+
+        - infiles is a list of input (or query) FASTA files
+
+        - references is an optional list of reference FASTA files, as for
+              make_file_pairs
+    """
+    if options.prefilter is None:
+        return {}
+    logger.info("Estimating ANI from MinHash sketches")
+    allfiles = list(infiles) + [fn for fn in references or [] \
+                                    if fn not in infiles]
+    sketches = sketch_input_files(allfiles, options.sketch_size)
+    qnames = [os.path.splitext(os.path.split(fn)[-1])[0] for fn in infiles]
+    rnames = [os.path.splitext(os.path.split(fn)[-1])[0] \
+                  for fn in references or infiles]
+    ani = estimate_mash_ani([sketches[n] for n in qnames],
+                            [sketches[n] for n in rnames])
+    qindex = dict((name, idx) for idx, name in enumerate(qnames))
+    rindex = dict((name, idx) for idx, name in enumerate(rnames))
+    skipped = {}
+    for f1, f2 in make_file_pairs(infiles, references):
+        qname = os.path.splitext(os.path.split(f1)[-1])[0]
+        sname = os.path.splitext(os.path.split(f2)[-1])[0]
+        estimate = ani[qindex[qname], rindex[sname]]
+        if estimate < options.prefilter:
+            skipped[(qname, sname)] = float(estimate)
+    logger.info("Prefilter skips %d comparisons with estimated ANI " % \
+                    len(skipped) + "below %s" % options.prefilter)
+    return skipped
+
+# Add the estimates for comparisons skipped by the prefilter to the results
+def add_prefilter_estimates(skipped, org_lengths, results):
+    """ Fills in the results (see process_comparisons) for each comparison
+        skipped by the prefilter: the percentage identity is the MinHash ANI
+        estimate, and the aligned length, similarity errors and percentage
+        aligned are zero, as no alignment was made.
+
+        - skipped is a dictionary of ANI estimates, as returned by
+              prefilter_pairs
+
+        - org_lengths is a dictionary of total sequence lengths for each
+              input sequence
+
+        - results is a PairwiseResults
+    """
+    for (qname, sname), estimate in skipped.items():
+        set_pairwise_result(results, org_lengths, qname, sname, 0, 0,
+                            estimate)
+
+# Cluster organisms into species over a sparse graph of ANI values
+@timed_stage('cluster_species')
+def cluster_species(nnodes, qnodes, snodes, anis, min_ani):
+    """ Returns an array giving the species cluster of each organism,
+        numbered from zero in order of decreasing cluster size, from the
+        ANI values of the pairs in a sparse graph. Organisms are clustered
+        at options.species_threshold, by options.species_linkage:
+
+        - single: organisms joined by a chain of pairs at or above the
+              threshold share a cluster (see single_linkage_clusters)
+
+        - average: clusters are merged while the mean ANI over all pairs
+              between them is at or above the threshold (see
+              average_linkage_clusters)
+
+        Where a pair was compared in both directions, the mean of the two
+        values is used.
+
+        - nnodes is the number of organisms
+
+        - qnodes, snodes are arrays of the organism indices of each pair
+
+        - anis is an array of the ANI of each pair
+
+        - min_ani is the minimum ANI of the pairs in the graph; any pair
+              not in the graph is taken to have this ANI, at most
+    """
+    # Each unordered pair once, with the mean ANI of its directions
+    lower, upper = np.minimum(qnodes, snodes), np.maximum(qnodes, snodes)
+    keep = lower != upper
+    pair_ids, inverse = np.unique(lower[keep] * nnodes + upper[keep],
+                                  return_inverse=True)
+    pair_anis = np.bincount(inverse, weights=anis[keep]) / \
+        np.bincount(inverse)
+    pairs = np.column_stack((pair_ids // nnodes, pair_ids % nnodes))
+    if options.species_linkage == 'average':
+        roots = average_linkage_clusters(nnodes, pairs, pair_anis,
+                                         options.species_threshold, min_ani)
+    else:
+        close = pair_anis >= options.species_threshold
+        roots = single_linkage_clusters(nnodes, pairs[close])
+    # Renumber clusters by decreasing size, then by first member
+    labels, first, clusters, sizes = np.unique(roots, return_index=True,
+                                               return_inverse=True,
+                                               return_counts=True)
+    order = np.lexsort((first, -sizes))
+    ranks = np.empty(len(order), dtype=np.int64)
+    ranks[order] = np.arange(len(order))
+    return ranks[clusters.ravel()]
+
+# Find the connected components of a graph, with a union-find forest
+def single_linkage_clusters(nnodes, pairs):
+    """ Returns a list giving a representative node for the connected
+        component of each node, so that nodes share a representative only
+        if they are joined by a chain of pairs. This is single linkage
+        clustering, with each pair a link.
+
+        - nnodes is the number of nodes
+
+        - pairs is an Nx2 array of the node indices of each link
+    """
+    parent = list(range(nnodes))
+    def find(node):
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+    for node1, node2 in pairs.tolist():
+        root1, root2 = find(node1), find(node2)
+        if root1 != root2:
+            parent[max(root1, root2)] = min(root1, root2)
+    return [find(node) for node in range(nnodes)]
+
+# Cluster the nodes of a sparse graph by average linkage
+def average_linkage_clusters(nnodes, pairs, values, threshold, missing):
+    """ Returns a list giving a representative node for the cluster of each
+        node, from average linkage (UPGMA) clustering stopped at the passed
+        threshold: the two clusters with the highest mean value over all of
+        the pairs of nodes between them are merged, for as long as that mean
+        is at least the threshold.
+
+        Only the pairs in the graph are stored; every other pair is taken to
+        have the missing value. Clusters not joined by any pair can then
+        never be merged, so the work depends on the number of pairs in the
+        graph rather than the square of the number of nodes.
+
+        - nnodes is the number of nodes
+
+        - pairs is an Nx2 array of the node indices of each pair
+
+        - values is an array of the value of each pair
+
+        - threshold is the lowest mean value at which clusters are merged
+
+        - missing is the value taken for pairs not in the graph
+    """
+    # For each cluster, keyed by its representative node: the summed value
+    # and the number of the pairs in the graph to each neighbouring cluster
+    links = [{} for node in range(nnodes)]
+    for (node1, node2), value in zip(pairs.tolist(), values.tolist()):
+        links[node1][node2] = links[node2][node1] = [value, 1]
+    sizes = [1] * nnodes
+    parent = list(range(nnodes))
+    def mean(node1, node2):
+        total, count = links[node1][node2]
+        npairs = sizes[node1] * sizes[node2]
+        return (total + (npairs - count) * missing) / npairs
+    # Stale heap entries are skipped when their mean no longer matches
+    heap = [(-value, node1, node2) for (node1, node2), value in \
+                zip(pairs.tolist(), values.tolist()) if value >= threshold]
+    heapq.heapify(heap)
+    while heap:
+        value, node1, node2 = heapq.heappop(heap)
+        if parent[node1] != node1 or parent[node2] != node2 or \
+                node2 not in links[node1] or -value != mean(node1, node2):
+            continue
+        # Merge the cluster with fewer neighbours into the other
+        if len(links[node1]) < len(links[node2]):
+            node1, node2 = node2, node1
+        parent[node2] = node1
+        del links[node1][node2]
+        for other, (total, count) in links[node2].items():
+            if other == node1:
+                continue
+            del links[other][node2]
+            link = links[node1].setdefault(other, [0., 0])
+            link[0] += total
+            link[1] += count
+            links[other][node1] = link
+        links[node2] = {}
+        sizes[node1] += sizes[node2]
+        for other in links[node1]:
+            value = mean(node1, other)
+            if value >= threshold:
+                heapq.heappush(heap, (-value, min(node1, other),
+                                      max(node1, other)))
+    def find(node):
+        while parent[node] != node:
+            node = parent[node]
+        return node
+    return [find(node) for node in range(nnodes)]
+
+# Build the ANIk minimizer index of each input file in the output directory
+@timed_stage('index_input_files')
+def index_input_files(infiles):
+    """ Writes the minimizer index of each input file (see kmer_index_file)
+        to the output directory, in parallel, using up to options.threads
+        processes.
+
+        - infiles is a list of input FASTA files
+    """
+    logger.info("Indexing input FASTA files")
+    args = [(genome_source(fn), make_kmer_index_filename(fn)) \
+                for fn in infiles]
+    nprocs = min(options.threads, len(args))
+    if nprocs > 1:
+        pool = multiprocessing.Pool(nprocs)
+        counts = pool.starmap(kmer_index_file, args)
+        pool.close()
+        pool.join()
+    else:
+        counts = [kmer_index_file(*arg) for arg in args]
+    for fn, (source, ofn), count in zip(infiles, args, counts):
+        logger.info("Wrote %d minimizers of %s to %s" % (count, fn, ofn))
+
+# Return the location of the ANIk minimizer index of an input file
+def make_kmer_index_filename(filename):
+    """ Returns the location in the output directory of the minimizer index
+        of the passed input file.
+
+        - filename is the location of the input FASTA file
+    """
+    stem = os.path.splitext(os.path.split(filename)[-1])[0]
+    return os.path.join(options.outdirname, stem + '.kmer_index.npz')
+
+# Write the minimizer index of one FASTA file
+def kmer_index_file(filename, outfile, k=ANIK_KMER, w=ANIK_WINDOW,
+                    fragsize=ANIK_FRAGSIZE):
+    """ Writes the minimizers of each sequence in the passed FASTA file to
+        outfile as a NumPy .npz archive, and returns the number of
+        minimizers.
+
+        A minimizer is the canonical k-mer with the smallest hash (see
+        canonical_kmer_hashes) in a window of w consecutive k-mers; each is
+        recorded once, however many windows it is selected in. Sequences are
+        divided into consecutive bins of fragsize bases, numbered across
+        all sequences, and the archive holds:
+
+        - hashes, bins: the hash and bin of each minimizer, in sequence
+              order, used when the file is a query (see kmer_ani)
+
+        - complete: whether each bin is a full fragsize bases long
+
+        - ref_hashes, ref_bins: the hashes found only once in the file,
+              sorted, and their bins, used when the file is a reference
+
+        - filename is the location of the input FASTA file, or of its
+              packed copy (see genome_source)
+
+        - outfile is the location of the output index
+
+        - k, w, fragsize are the k-mer length, minimizer window and bin
+              length
+    """
+    hash_max = np.iinfo(np.uint64).max
+    all_hashes, all_bins, complete = [], [], []
+    for codes in iter_genome_codes(filename):
+        hashes = canonical_kmer_hashes(codes, k, keep_ambiguous=True)
+        if len(hashes) >= w:
+            windows = np.lib.stride_tricks.sliding_window_view(hashes, w)
+            positions = np.unique(windows.argmin(axis=1) + \
+                                      np.arange(len(windows)))
+        else:
+            positions = np.arange(len(hashes))
+        positions = positions[hashes[positions] != hash_max]
+        all_hashes.append(hashes[positions])
+        all_bins.append(positions // fragsize + len(complete))
+        nbins = -(-len(codes) // fragsize)
+        complete.extend([True] * (len(codes) // fragsize))
+        complete.extend([False] * (nbins - len(codes) // fragsize))
+    hashes = np.concatenate(all_hashes or [np.zeros(0, dtype=np.uint64)])
+    bins = np.concatenate(all_bins or [np.zeros(0, dtype=np.intp)])
+    uniq, first, counts = np.unique(hashes, return_index=True,
+                                    return_counts=True)
+    with open(outfile, 'wb') as fh:
+        np.savez(fh, hashes=hashes, bins=bins,
+                 complete=np.array(complete, dtype=bool),
+                 ref_hashes=uniq[counts == 1],
+                 ref_bins=bins[first[counts == 1]])
+    return len(hashes)
+
+# Estimate ANI by mapping query fragments onto a reference using minimizers
+def kmer_ani(query, reference, k=ANIK_KMER, fragsize=ANIK_FRAGSIZE,
+             min_identity=ANIK_MIN_IDENTITY):
+    """ Returns a tuple of (aln_length, sim_errors) for the passed query
+        and reference minimizer indexes (see kmer_index_file), as would be
+        obtained from an alignment.
+
+        Each complete query fragment is mapped to the pair of adjacent
+        reference bins that shares the most of its minimizers. Its
+        identity is estimated as C ** (1 / k), where C is the fraction of
+        the fragment's minimizers found in the mapped bins, since a k-mer
+        is conserved with probability identity ** k. Of the fragments with
+        at least min_identity, only the best one mapped to each reference
+        window is kept. The aligned length is fragsize for each kept
+        fragment, and the similarity errors are fragsize * (1 - identity),
+        summed over kept fragments, so that the ANI is their mean
+        identity.
+
+        - query, reference are loaded minimizer index archives
+
+        - k is the k-mer length used to build the indexes
+
+        - fragsize is the bin length used to build the indexes
+
+        - min_identity is the lowest estimated identity of a mapped fragment
+    """
+    qhashes, qbins = query['hashes'], query['bins']
+    usable = query['complete'][qbins]
+    qhashes, qbins = qhashes[usable], qbins[usable]
+    ref_hashes, ref_bins = reference['ref_hashes'], reference['ref_bins']
+    if not len(qhashes) or not len(ref_hashes):
+        return 0, 0
+    pos = np.minimum(np.searchsorted(ref_hashes, qhashes),
+                     len(ref_hashes) - 1)
+    hit = ref_hashes[pos] == qhashes
+    if not hit.any():
+        return 0, 0
+    # Count shared minimizers for each (query fragment, reference bin)
+    # pair, then score each window of two adjacent bins
+    nrbins = len(reference['complete']) + 1
+    pairs, counts = np.unique(qbins[hit] * nrbins + ref_bins[pos[hit]],
+                              return_counts=True)
+    following = np.minimum(np.searchsorted(pairs, pairs + 1),
+                           len(pairs) - 1)
+    scores = counts + np.where(pairs[following] == pairs + 1,
+                               counts[following], 0)
+    frags, windows = pairs // nrbins, pairs % nrbins
+    # Best window for each fragment
+    order = np.lexsort((-scores, frags))
+    best = order[np.r_[True, frags[order][1:] != frags[order][:-1]]]
+    nminimizers = np.bincount(qbins)
+    identity = (scores[best] / nminimizers[frags[best]]) ** (1. / k)
+    mapped = identity >= min_identity
+    identity, windows = identity[mapped], windows[best][mapped]
+    # Best fragment for each reference window
+    order = np.lexsort((-identity, windows))
+    keep = order[np.r_[True, windows[order][1:] != windows[order][:-1]]] \
+        if len(order) else order
+    identity = identity[keep]
+    return (len(identity) * fragsize,
+            int(round(fragsize * (1 - identity).sum())))
+
+# Run kmer_ani for each of the comparisons of one query genome
+def kmer_ani_query(queryfile, referencefiles):
+    """ Returns a list of (aln_length, sim_errors) tuples (see kmer_ani) for
+        the passed query minimizer index against each reference index.
+
+        - queryfile is the location of the query index
+
+        - referencefiles is a list of locations of reference indexes
+    """
+    with np.load(queryfile) as query:
+        query = dict(query)
+    results = []
+    for filename in referencefiles:
+        with np.load(filename) as reference:
+            results.append(kmer_ani(query, reference))
+    return results
+
+# Run the ANIk comparisons that are not already in the result store
+@timed_stage('run_kmer_comparisons')
+def run_kmer_comparisons(pending):
+    """ Returns a dictionary of (aln_length, sim_errors) tuples keyed by
+        result store key, for each of the passed comparisons. Comparisons
+        are grouped by query genome, so that each query index is loaded
+        once, and the groups run in parallel using up to options.threads
+        processes.
+
+        - pending is a dictionary of (query, reference) input FASTA file
+              tuples, keyed by result store key
+    """
+    groups = collections.OrderedDict()
+    for key, (f1, f2) in pending.items():
+        groups.setdefault(f1, []).append((key, f2))
+    args = [(make_kmer_index_filename(f1),
+             [make_kmer_index_filename(f2) for key, f2 in group]) \
+                for f1, group in groups.items()]
+    nprocs = min(options.threads, len(args))
+    if nprocs > 1:
+        pool = multiprocessing.Pool(nprocs)
+        outputs = pool.starmap(kmer_ani_query, args)
+        pool.close()
+        pool.join()
+    else:
+        outputs = [kmer_ani_query(*arg) for arg in args]
+    results = {}
+    for group, output in zip(groups.values(), outputs):
+        for (key, f2), result in zip(group, output):
+            results[key] = result
+    return results
+
+
+# Divide the input FASTA sequences into fragments, and place multiple sequence
+# FASTA files into the output directory
+@accepts_config
+@timed_stage('fragment_input_files')
+def fragment_input_files(infiles):
+    """ Takes every sequence from every FASTA file in the input directory,
+        splits them into consecutive fragments of length options.fragsize,
+        (with any trailing sequences being included, even if shorter), and
+        writes the resulting set of sequences to a file with the same name
+        in the output directory. All fragments are named consecutively and
+        uniquely as fragNNNNN. Returns a dictionary of the number of
+        fragments of each organism.
+
+        With options.sample_fragments, a random subset of that many
+        fragments of each file is also written to a file of the same name
+        in the sampled/ subdirectory of the output directory (see
+        make_sample_filename). The subset depends only on
+        options.sample_seed and the sequence (see get_org_hashes), so it is
+        the same in every run with the same seed.
+
+        With options.export_alignments, the contig and position of each
+        fragment are also written to a fragment map (see
+        make_fragment_map_filename), used to place BLASTN matches on the
+        input contigs.
+
+        Input files are fragmented in parallel, using up to options.threads
+        processes (see fragment_file).
+    """
+    logger.info("Fragmenting input FASTA files")
+    args = [(genome_source(fn), make_fragment_filename(fn),
+             options.fragsize) for fn in infiles]
+    if options.sample_fragments is not None:
+        os.makedirs(os.path.join(options.outdirname, 'sampled'),
+                    exist_ok=True)
+        org_hashes = get_org_hashes(infiles)
+        for idx, fn in enumerate(infiles):
+            org = os.path.splitext(os.path.split(fn)[-1])[0]
+            args[idx] += (options.sample_fragments, make_sample_filename(fn),
+                          [options.sample_seed, int(org_hashes[org][:8], 16)])
+    if options.export_alignments:
+        for idx, fn in enumerate(infiles):
+            args[idx] += (None,) * (6 - len(args[idx])) + \
+                (make_fragment_map_filename(fn),)
+    nprocs = min(options.threads, len(args))
+    if nprocs > 1:
+        pool = multiprocessing.Pool(nprocs)
+        counts = pool.starmap(fragment_file, args)
+        pool.close()
+        pool.join()
+    else:
+        counts = [fragment_file(*arg) for arg in args]
+    frag_counts = {}
+    for fn, arg, count in zip(infiles, args, counts):
+        ofn = arg[1]
+        logger.info("Wrote %d fragments of %s to %s" % (count, fn, ofn))
+        frag_counts[os.path.splitext(os.path.split(fn)[-1])[0]] = count
+    return frag_counts
+
+# Write the fragments of one FASTA file as they are read
+def fragment_file(filename, outfile, fragsize, sample=None, samplefile=None,
+                  seed=None, mapfile=None):
+    """ Splits each sequence in the passed FASTA file into consecutive
+        fragments of length fragsize, writing each fragment to outfile as
+        soon as its sequence is read, and returns the number of fragments.
+        Only one input sequence is held in memory at a time.
+
+        - filename is the location of the input FASTA file, or of its
+              packed copy (see genome_source)
+
+        - outfile is the location of the output FASTA file
+
+        - fragsize is the fragment length
+
+        - sample, if given, is the number of fragments to choose at random
+              (by reservoir sampling, so only the chosen fragments are held
+              in memory) and write to samplefile, in their original order
+              and with their original names
+
+        - seed seeds the random number generator for sampling
+
+        - mapfile, if given, is the location of a NumPy archive to which the
+              input contig names (contigs) and lengths (lengths), and the
+              contig (fragment_contigs) and zero-based start position
+              (fragment_starts) of each fragment, in fragment order, are
+              written
+    """
+    count, reservoir = 0, []
+    contigs, lengths, frag_contigs, frag_starts = [], [], [], []
+    rng = np.random.default_rng(seed)
+    with open(outfile, 'w') as outfh:
+        for title, seq in iter_genome_sequences(filename):
+            if mapfile is not None:
+                frag_contigs.extend([len(contigs)] * \
+                                        len(range(0, len(seq), fragsize)))
+                frag_starts.extend(range(0, len(seq), fragsize))
+                contigs.append(title.split(None, 1)[0] if title else '')
+                lengths.append(len(seq))
+            for i in range(0, len(seq), fragsize):
+                count += 1
+                frag = ">frag%05d\n%s\n" % (count, seq[i:i+fragsize])
+                outfh.write(frag)
+                if sample is None:
+                    continue
+                if len(reservoir) < sample:
+                    reservoir.append((count, frag))
+                else:
+                    idx = rng.integers(count)
+                    if idx < sample:
+                        reservoir[idx] = (count, frag)
+    if sample is not None:
+        with open(samplefile, 'w') as outfh:
+            outfh.writelines([frag for idx, frag in sorted(reservoir)])
+    if mapfile is not None:
+        with open(mapfile, 'wb') as fh:
+            np.savez(fh, contigs=np.array(contigs, dtype=str),
+                     lengths=np.array(lengths, dtype=np.int64),
+                     fragment_contigs=np.array(frag_contigs, dtype=np.int64),
+                     fragment_starts=np.array(frag_starts, dtype=np.int64))
+    return count
+
+# Return the location of the fragment map of an input file
+def make_fragment_map_filename(filename):
+    """ Returns the location in the output directory of the map from the
+        fragments of the passed input FASTA file to its contigs, written
+        with options.export_alignments (see fragment_file).
+
+        - filename is the location of an input FASTA file
+    """
+    ostem = os.path.splitext(os.path.split(filename)[-1])[0]
+    return os.path.join(options.outdirname, ostem) + '.fragments.npz'
+
+# Return the location of the fragmented copy of an input file
+def make_fragment_filename(filename):
+    """ Returns the location in the output directory of the fragmented
+        sequence file made from the passed input FASTA file.
+
+        - filename is the location of an input FASTA file
+    """
+    ostem = os.path.splitext(os.path.split(filename)[-1])[0]
+    return os.path.join(options.outdirname, ostem) + '.fasta'
+
+# Return the location of the sampled fragments of an input file
+def make_sample_filename(filename):
+    """ Returns the location in the output directory of the random subset
+        of fragments of the passed input FASTA file written with
+        options.sample_fragments. The file has the same name as the full
+        fragment file (see make_fragment_filename), in the sampled/
+        subdirectory, so that comparisons are named as usual.
+
+        - filename is the location of an input FASTA file
+    """
+    return os.path.join(options.outdirname, 'sampled',
+                        os.path.split(make_fragment_filename(filename))[-1])
+
+# Make BLAST databases for each of the fragmented input files
+@timed_stage('make_blast_dbs')
+def make_blast_dbs(infiles):
+    """ Use local makeblastdb to build BLAST a nucleotide database for each
+        input sequence.
+
+        For ANIb, the input sequence has been split into consecutive fragments.
+    """
+    logger.info("Making BLAST databases for fragment files")
+    jobs = []
+    for fn in infiles:
+        jobs.append(Job(make_makeblastdb_cmd(fn), os.path.getsize(fn), None))
+    logger.info("BLAST makeblastdb command lines:\n\t%s" % \
+                    '\n\t'.join([job.cmdline for job in jobs]))
+    run_jobs(jobs)
+
+
+# Make a single BLAST database from all of the input files
+@timed_stage('make_combined_blast_db')
+def make_combined_blast_db(infiles):
+    """ Builds a single BLAST nucleotide database in the output directory
+        from every sequence in the passed FASTA files, for batch_blast.
+        Sequences are renamed g<i>_<j>, where i is the index of the genome
+        and j that of the sequence within it, so that BLASTN hits can be
+        assigned to a genome. The renamed sequences are streamed to
+        makeblastdb's standard input, so no combined FASTA file is written.
+        Sequences are read through the genome cache, if one is used (see
+        genome_source).
+
+        Returns a tuple of (database prefix, dictionary of genome index
+        keyed by organism).
+
+        - infiles is a list of input FASTA files
+    """
+    db_prefix = os.path.join(options.outdirname, 'combined_genomes')
+    cmdline = "%s -out %s -dbtype nucl -in - -title combined_genomes " % \
+        (options.makeblastdb_exe, db_prefix) + "-parse_seqids"
+    logger.info("BLAST makeblastdb command line:\n\t%s" % cmdline)
+    genome_index = {}
+    errfh = tempfile.TemporaryFile()
+    proc = subprocess.Popen(cmdline, shell=sys.platform != "win32",
+                            stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                            stderr=errfh, universal_newlines=True)
+    try:
+        for gidx, fn in enumerate(infiles):
+            genome_index[os.path.splitext(os.path.split(fn)[-1])[0]] = gidx
+            for sidx, (title, seq) in \
+                    enumerate(iter_genome_sequences(genome_source(fn))):
+                proc.stdin.write(">g%d_%d\n%s\n" % (gidx, sidx, seq))
+        proc.stdin.close()
+    except (IOError, OSError):
+        logger.error(last_exception())
+    if proc.wait():
+        errfh.seek(0)
+        logger.error("makeblastdb failed (exiting):\n%s" % \
+                         errfh.read().decode(errors='replace'))
+        sys.exit(1)
+    errfh.close()
+    return db_prefix, genome_index
+
+# Get the list of FASTA files from the input directory
+def get_fasta_files():
+    """ Return a list of FASTA files in the input directory
+    """
+    infiles = get_input_files(options.indirname,# '.fna')
+                              '.fasta', '.fas', '.fa', '.fna')
+    logger.info("Input files:\n\t%s" % '\n\t'.join(infiles))
+    return infiles
+
+# Get lengths of sequence for each organism
+@accepts_config
+@timed_stage('get_org_lengths')
+def get_org_lengths(infiles):
+    """ Returns a dictionary of total input sequence lengths, keyed by
+        organism.
+
+        Biopython's SeqIO module is used to parse all sequences in the FASTA
+        file corresponding to each organism, and the total base count in each
+        is obtained. With options.genome_cache, the lengths are read from the
+        packed genome statistics instead (see read_genome_stats).
+
+        NOTE: ambiguity symbols are not discounted.
+    """
+    logger.info("Processing input organism sequence lengths")
+    tot_lengths = {}
+    for fn in infiles:
+        if options.genome_cache is not None:
+            length = read_genome_stats(fn)['length']
+        else:
+            length = cached_genome_value(fn, 'length', lambda fn: \
+                sum([len(s) for s in SeqIO.parse(fn, 'fasta')]))
+        tot_lengths[os.path.splitext(os.path.split(fn)[-1])[0]] = length
+    return tot_lengths
+
+# Get a content hash of the sequence for each organism
+@accepts_config
+@timed_stage('get_org_hashes')
+def get_org_hashes(infiles):
+    """ Returns a dictionary of SHA-1 hex digests of the input sequences,
+        keyed by organism.
+
+        Only the sequences (uppercased, in file order) contribute to the
+        hash, so that the same genome under a different file name, or with
+        different FASTA headers or line wrapping, has the same hash.
+        Organisms with identical sequence are reported in the log. With
+        options.genome_cache, the hashes are read from the packed genome
+        statistics (see read_genome_stats).
+    """
+    logger.info("Calculating input organism sequence hashes")
+    org_hashes = {}
+    for fn in infiles:
+        if options.genome_cache is not None:
+            org_hash = read_genome_stats(fn)['hash']
+        else:
+            org_hash = cached_genome_value(fn, 'hash', hash_file_sequences)
+        org_hashes[os.path.splitext(os.path.split(fn)[-1])[0]] = org_hash
+    by_hash = collections.defaultdict(list)
+    for org, org_hash in org_hashes.items():
+        by_hash[org_hash].append(org)
+    for orgs in by_hash.values():
+        if len(orgs) > 1:
+            logger.warning("Identical input sequences (compared once): %s" %\
+                               ', '.join(sorted(orgs)))
+    return org_hashes
+
+# Get a content hash of the sequences in one input file
+def hash_file_sequences(fn):
+    """ Returns the SHA-1 hex digest of the sequences in the passed FASTA
+        file (see get_org_hashes).
+
+        - fn is the location of the FASTA file
+    """
+    digest = hashlib.sha1()
+    for s in SeqIO.parse(fn, 'fasta'):
+        digest.update(b'>')
+        digest.update(str(s.seq).upper().encode('ascii'))
+    return digest.hexdigest()
+
+# Pack the input files into the genome cache, and record their statistics
+@timed_stage('pack_input_files')
+def pack_input_files(infiles):
+    """ Packs each input file not already in options.genome_cache (see
+        pack_genome), in parallel, using up to options.threads processes,
+        and writes the statistics of every input genome to genome_stats.tab
+        in the output directory. Does nothing without options.genome_cache.
+
+        - infiles is a list of input FASTA files
+    """
+    if options.genome_cache is None:
+        return
+    os.makedirs(options.genome_cache, exist_ok=True)
+    args = [(fn, make_packed_genome_dirname(fn)) for fn in infiles]
+    args = [arg for arg in args if not os.path.isdir(arg[1])]
+    logger.info("Packing %d of %d input files into %s" % \
+                    (len(args), len(infiles), options.genome_cache))
+    nprocs = min(options.threads, len(args))
+    if nprocs > 1:
+        pool = multiprocessing.Pool(nprocs)
+        pool.starmap(pack_genome, args)
+        pool.close()
+        pool.join()
+    else:
+        for arg in args:
+            pack_genome(*arg)
+    fname = os.path.join(options.outdirname, 'genome_stats.tab')
+    with open(fname, 'w') as fh:
+        print( "# calculate_ani.py %s" % time.asctime(), file=fh)
+        print( "organism\tlength\tgc\tcontigs\tn50\thash", file=fh)
+        for fn in infiles:
+            stats = read_genome_stats(fn)
+            print( "%s\t%d\t%s\t%d\t%d\t%s" % \
+                       (os.path.splitext(os.path.split(fn)[-1])[0],
+                        stats['length'], stats['gc'], stats['contigs'],
+                        stats['n50'], stats['hash']), file=fh)
+    logger.info("Wrote genome statistics to %s" % fname)
+
+# Return the location of an input file's packed copy in the genome cache
+def make_packed_genome_dirname(filename):
+    """ Returns the location in options.genome_cache of the packed copy of
+        the passed input FASTA file, named by the SHA-1 digest of the file's
+        contents and GENOME_CACHE_VERSION, so that a changed file, or the
+        same file under another name or in another run, is found by its
+        contents. The digest is kept for the run (see cached_genome_value).
+
+        - filename is the location of an input FASTA file
+    """
+    def file_digest(filename):
+        digest = hashlib.sha1()
+        with open(filename, 'rb') as fh:
+            for block in iter(lambda: fh.read(1 << 20), b''):
+                digest.update(block)
+        return digest.hexdigest()
+    key = cached_genome_value(filename, 'file_digest', file_digest)
+    return os.path.join(options.genome_cache,
+                        "%s.v%d" % (key, GENOME_CACHE_VERSION))
+
+# Return the source from which to read an input genome's sequences
+def genome_source(filename):
+    """ Returns the location of the packed copy of the passed input FASTA
+        file in options.genome_cache, packing it first if need be (see
+        pack_genome); or the input file itself, without a genome cache.
+        Either can be read with iter_genome_codes and
+        iter_genome_sequences.
+
+        - filename is the location of an input FASTA file
+    """
+    if options.genome_cache is None:
+        return filename
+    dirname = make_packed_genome_dirname(filename)
+    if not os.path.isdir(dirname):
+        os.makedirs(options.genome_cache, exist_ok=True)
+        pack_genome(filename, dirname)
+    return dirname
+
+# Read the statistics of an input genome from the genome cache
+def read_genome_stats(filename):
+    """ Returns the dictionary of statistics recorded when the passed input
+        file was packed into options.genome_cache (see pack_genome).
+
+        - filename is the location of an input FASTA file
+    """
+    def read_stats(filename):
+        with open(os.path.join(genome_source(filename), 'stats.json')) as fh:
+            return json.load(fh)
+    return cached_genome_value(filename, 'stats', read_stats)
+
+# Pack the sequences of one FASTA file into the genome cache
+def pack_genome(filename, dirname):
+    """ Writes a packed copy of the sequences in the passed FASTA file to a
+        new directory, laid out like the UCSC .2bit format as NumPy arrays
+        that can be memory-mapped:
+
+        - packed.npy: the 2-bit codes of all of the sequences, concatenated
+              in file order, four bases to a byte, first base in the high
+              bits (see encode_sequence), with symbols other than ACGT
+              packed as A
+
+        - offsets.npy: the start of each sequence in the concatenated codes,
+              and the total length
+
+        - ambiguous.npy: the start, end and ASCII code of each run of a
+              symbol other than ACGT, such as N, sorted by start
+
+        - stats.json: the sequence names, and statistics of the genome: its
+              total length, GC fraction (of ACGT bases), number of contigs,
+              N50, and sequence hash (as from hash_file_sequences)
+
+        Sequences are uppercased. The directory is written under a
+        temporary name and renamed into place, so that other processes
+        never see a partly written copy; if another process packed the same
+        file first, its copy is kept.
+
+        - filename is the location of the input FASTA file
+
+        - dirname is the location of the packed copy
+    """
+    logger.info("Packing %s into %s" % (filename, dirname))
+    digest = hashlib.sha1()
+    names, lengths, codes, ambiguous = [], [], [], []
+    offset = 0
+    with open(filename, 'r') as fh:
+        for title, seq in SimpleFastaParser(fh):
+            seq = seq.upper().encode('ascii')
+            digest.update(b'>')
+            digest.update(seq)
+            contig = NT_CODES[np.frombuffer(seq, dtype=np.uint8)]
+            # Split ambiguous positions into runs of a single symbol
+            positions = np.flatnonzero(contig == 4)
+            if len(positions):
+                symbols = np.frombuffer(seq, dtype=np.uint8)[positions]
+                breaks = np.flatnonzero((np.diff(positions) != 1) | \
+                                            (symbols[1:] != symbols[:-1])) + 1
+                firsts = np.concatenate(([0], breaks))
+                lasts = np.concatenate((breaks, [len(positions)])) - 1
+                ambiguous.append(np.column_stack(
+                    (positions[firsts] + offset, positions[lasts] + 1 + offset,
+                     symbols[firsts])))
+            names.append(title)
+            lengths.append(len(contig))
+            codes.append(contig)
+            offset += len(contig)
+    codes = np.concatenate(codes or [np.zeros(0, dtype=np.uint8)])
+    counts = np.bincount(codes, minlength=5)
+    codes[codes == 4] = 0
+    codes = np.concatenate((codes, np.zeros(-len(codes) % 4, dtype=np.uint8)))
+    packed = (codes[0::4] << 6) | (codes[1::4] << 4) | (codes[2::4] << 2) | \
+        codes[3::4]
+    sorted_lengths = sorted(lengths, reverse=True)
+    cumulative = np.cumsum(sorted_lengths)
+    n50 = sorted_lengths[int(np.searchsorted(cumulative, offset / 2.))] \
+        if lengths else 0
+    stats = {'names': names, 'length': offset,
+             'gc': float(counts[1] + counts[2]) / max(counts[:4].sum(), 1),
+             'contigs': len(lengths), 'n50': int(n50),
+             'hash': digest.hexdigest(), 'version': GENOME_CACHE_VERSION}
+    tmpdir = tempfile.mkdtemp(dir=os.path.dirname(dirname), prefix='.pack')
+    np.save(os.path.join(tmpdir, 'packed.npy'), packed)
+    np.save(os.path.join(tmpdir, 'offsets.npy'),
+            np.array([0] + lengths, dtype=np.int64).cumsum())
+    np.save(os.path.join(tmpdir, 'ambiguous.npy'),
+            np.concatenate(ambiguous or [np.zeros((0, 3), dtype=np.int64)]
+                           ).astype(np.int64))
+    with open(os.path.join(tmpdir, 'stats.json'), 'w') as fh:
+        json.dump(stats, fh)
+    try:
+        os.rename(tmpdir, dirname)
+    except OSError:
+        logger.info("%s was packed by another process" % filename)
+        shutil.rmtree(tmpdir)
+    return stats
+
+# Read the sequences of a packed genome one at a time, from a memory map
+def iter_packed_genome(dirname, fill=None):
+    """ Yields a uint8 array for each sequence in a packed genome (see
+        pack_genome), in file order. Only the packed bytes of the sequence
+        being read are paged in from the memory-mapped packed.npy.
+
+        - dirname is the location of the packed genome
+
+        - fill, if given, is an array mapping 2-bit codes to the values
+              returned, e.g. ASCII symbols, and ambiguous runs are restored
+              to their symbols; otherwise 2-bit codes are returned, with
+              ambiguous positions coded as 4, as from encode_sequence
+    """
+    packed = np.load(os.path.join(dirname, 'packed.npy'), mmap_mode='r')
+    offsets = np.load(os.path.join(dirname, 'offsets.npy')).tolist()
+    ambiguous = np.load(os.path.join(dirname, 'ambiguous.npy'))
+    shifts = np.array([6, 4, 2, 0], dtype=np.uint8)
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        block = np.asarray(packed[start // 4:(end + 3) // 4])
+        contig = ((block[:, None] >> shifts) & 3).ravel()
+        contig = contig[start % 4:start % 4 + end - start]
+        if fill is not None:
+            contig = fill[contig]
+        lo, hi = np.searchsorted(ambiguous[:, 0], [start, end])
+        for run_start, run_end, symbol in ambiguous[lo:hi].tolist():
+            contig[run_start - start:run_end - start] = \
+                4 if fill is None else symbol
+        yield contig
+
+# Read the 2-bit encoded sequences of an input genome
+def iter_genome_codes(source):
+    """ Yields the 2-bit encoding (see encode_sequence) of each sequence of
+        an input genome, in file order.
+
+        - source is the location of an input FASTA file, or of its packed
+              copy in the genome cache (see genome_source)
+    """
+    if os.path.isdir(source):
+        for contig in iter_packed_genome(source):
+            yield contig
+        return
+    with open(source, 'r') as fh:
+        for title, seq in SimpleFastaParser(fh):
+            yield encode_sequence(seq)
+
+# Read the sequences of an input genome as strings
+def iter_genome_sequences(source):
+    """ Yields a (title, sequence) tuple of strings for each sequence of an
+        input genome, in file order. Sequences read from the genome cache
+        are uppercase.
+
+        - source is the location of an input FASTA file, or of its packed
+              copy in the genome cache (see genome_source)
+    """
+    if os.path.isdir(source):
+        symbols = np.frombuffer(b'ACGT', dtype=np.uint8)
+        with open(os.path.join(source, 'stats.json')) as fh:
+            titles = json.load(fh)['names']
+        for title, contig in zip(titles, iter_packed_genome(source,
+                                                            fill=symbols)):
+            yield title, contig.tobytes().decode('ascii')
+        return
+    with open(source, 'r') as fh:
+        for title, seq in SimpleFastaParser(fh):
+            yield title, seq
+
+# Write a matrix of values to the output directory, in the chosen format
+@timed_stage('write_matrix')
+def write_matrix(name, rows, cols, matrix, comment=''):
+    """ Writes the passed matrix to the output directory in the format
+        chosen with options.matrix_format:
+
+        - tab: as the tab-separated plain text table name.tab (see
+              write_matrix_table)
+
+        - npy: as the NumPy array name.npy, with the row and column names
+              in row_names.npy and col_names.npy (see write_name_arrays)
+
+        - hdf5: as the dataset name in results.h5, with the comment as its
+              'comment' attribute, and the row and column names in the
+              row_names and col_names datasets. This needs h5py.
+
+        In the binary formats, cells comparing an organism with itself hold
+        zero, rather than NA.
+
+        - name is the name of the matrix
+
+        - rows, cols are lists of the row and column names, in matrix order
+
+        - matrix is a 2-D array of values
+
+        - comment is an optional comment string for the output file
+    """
+    if options.matrix_format == 'npy':
+        fname = os.path.join(options.outdirname, name + '.npy')
+        logger.info("Writing %s" % fname)
+        np.save(fname, matrix)
+        write_name_arrays(rows, cols)
+    elif options.matrix_format == 'hdf5':
+        try:
+            import h5py
+        except ImportError:
+            logger.error("HDF5 output requires h5py, but it was not found " +\
+                             "(exiting)")
+            sys.exit(1)
+        fname = os.path.join(options.outdirname, 'results.h5')
+        logger.info("Writing %s to %s" % (name, fname))
+        with h5py.File(fname, 'a') as h5:
+            for key, data in ((name, matrix), ('row_names', rows),
+                              ('col_names', cols)):
+                if key in h5:
+                    del h5[key]
+                if key == name:
+                    h5.create_dataset(key, data=matrix)
+                else:
+                    h5.create_dataset(key, data=data,
+                                      dtype=h5py.string_dtype())
+            h5[name].attrs['comment'] = comment
+    else:
+        write_matrix_table(name + '.tab', rows, cols, matrix, comment)
+
+# Write the row and column names of the output matrices as NumPy arrays
+def write_name_arrays(rows, cols):
+    """ Writes the passed row and column names to row_names.npy and
+        col_names.npy in the output directory, as NumPy string arrays.
+
+        - rows, cols are lists of the row and column names, in matrix order
+    """
+    for filename, names in (('row_names.npy', rows), ('col_names.npy', cols)):
+        np.save(os.path.join(options.outdirname, filename), np.array(names))
+
+# Write a matrix of values to file, with row/col headers, in tab-separated
+# format
+def write_matrix_table(filename, rows, cols, matrix, comment=''):
+    """ Writes a tab-separated plain text matrix file, with row and column
+        headers, describing the passed matrix. Cells where the row and column
+        names are the same are written as NA.
+
+        Values are converted to text a block of rows at a time, with no
+        per-cell lookups, so that a memory-mapped matrix is never loaded in
+        full.
+
+        - filename is the name of the output file in the output directory
+
+        - rows, cols are lists of the row and column names, in matrix order
+
+        - matrix is a 2-D array of values
+
+        - comment is an optional comment string for the output file
+    """
+    fname = os.path.join(options.outdirname, filename)
+    try:
+        logger.info("Opening %s for writing" % fname)
+        fh = open(fname, 'w')
+        print( "# calculate_ani.py %s" % time.asctime(), file=fh)
+        if len(comment):
+            print( "# %s" % comment, file=fh)
+    except:
+        logger.error("Could not open file %s for output (exiting)" % fname)
+        logger.error(last_exception())
+        sys.exit(1)
+    print( '\t'.join([''] + list(cols)), file=fh)
+    col_index = dict((name, idx) for idx, name in enumerate(cols))
+    blocksize = max(1, (1 << 20) // max(len(cols), 1))
+    for start in range(0, len(rows), blocksize):
+        lines = []
+        block = np.asarray(matrix[start:start + blocksize]).tolist()
+        for row_name, values in zip(rows[start:start + blocksize], block):
+            values = list(map(str, values))
+            if row_name in col_index:
+                values[col_index[row_name]] = 'NA'
+            lines.append('\t'.join([row_name] + values))
+        fh.write('\n'.join(lines) + '\n')
+    fh.close()
+    logger.info("Wrote data to %s" % fname)
+
+# Get the organism names to label an alignment export with, if exporting
+def make_export_names(comparison):
+    """ Returns the (query, subject) tuple of organism names passed to the
+        parsers to export the alignments of the passed comparison with
+        options.export_alignments, or None if alignments are not exported.
+
+        - comparison is a Comparison, or a (query, subject) tuple
+    """
+    if not options.export_alignments:
+        return None
+    return tuple(comparison[:2])
+
+# Parse NUCmer delta output to store alignment total length, sim_error,
+# and percentage identity, for each pairwise comparison
+def process_delta(org_lengths, comparisons, results):
+    """ Fills in and returns the passed PairwiseResults, describing results
+        for pairwise comparisons: total aligned lengths; similarity errors in
+        those alignments; the percentage of aligned length that matches
+        (ANIm); and the percentage of the pairwise comparison that is
+        aligned.
+
+        When every organism is compared with every other, the total aligned
+        length, similarity error, and ANIm matrices are symmetrical, but as
+        the percentage aligned measure depends on the sequence we calculate
+        it against, it is not.
+
+        - org_lengths is a dictionary of total sequence lengths for each
+              input sequence
+
+        - comparisons is a list of Comparisons, as returned by
+              pairwise_nucmer
+
+        - results is a PairwiseResults, as returned by new_pairwise_results
+
+        With options.one_to_one, only a one-to-one set of alignments is
+        counted (see parse_delta). Results already parsed as their jobs
+        completed (see stream_results) are not read from file again.
+    """
+    logger.info("Processing .delta files")
+    def parser(comparison):
+        if comparison.outfile in stream_results:
+            return stream_results[comparison.outfile]
+        return parse_delta(comparison.outfile, options.one_to_one,
+                           make_export_names(comparison))
+    return process_comparisons(org_lengths, comparisons, parser, results)
+
+# Parse BLAST tabular output and store total alignment length, similarity
+# counts and percentage identity for each pairwise comparison
+def process_blast(org_lengths, comparisons, results, scales=None):
+    """ Read in the BLASTN comparison output files, and calculate alignment
+        lengths, similarity errors, and percentage identity and alignment
+        coverage for each input sequence comparison, filling in and
+        returning the passed PairwiseResults.
+
+        - org_lengths is a dictionary of total sequence lengths for each
+              input sequence.
+
+        - comparisons is a list of Comparisons, as returned by
+              pairwise_blast. Results already parsed from BLASTN's output
+              stream, or as their jobs completed (see stream_results), are
+              not read from file.
+
+        - results is a PairwiseResults, as returned by new_pairwise_results
+
+        - scales is an optional dictionary of factors by which to scale the
+              totals for each query organism (see make_scaled_parser)
+    """
+    logger.info("Processing .blast_tab files")
+    def parser(comparison):
+        if comparison.outfile in stream_results:
+            return stream_results[comparison.outfile]
+        return parse_blast(comparison.outfile,
+                           export=make_export_names(comparison))
+    if scales is not None:
+        parser = make_scaled_parser(parser, scales)
+    return process_comparisons(org_lengths, comparisons, parser, results)
+
+# Make a parser that scales the totals of sampled comparisons
+def make_scaled_parser(parser, scales):
+    """ Returns a function, for process_comparisons, that returns the
+        (aln_length, sim_errors) totals from the passed parser multiplied by
+        the scale factor of the comparison's query organism, rounded to
+        whole numbers. Used with options.sample_fragments, to estimate
+        whole-genome totals from the sampled fragments.
+
+        - parser is a function returning (aln_length, sim_errors) for a
+              Comparison
+
+        - scales is a dictionary of scale factors, keyed by organism
+    """
+    def scaled(comparison):
+        return tuple(int(round(value * scales[comparison.qname])) for \
+                         value in parser(comparison))
+    return scaled
+
+# Estimate bootstrap confidence intervals for sampled ANIb results
+def bootstrap_ani_intervals(comparisons, sampled, results):
+    """ Returns a tuple of (low, high) arrays, shaped as results.perc_ids,
+        holding the bounds of a BOOTSTRAP_LEVEL bootstrap confidence
+        interval for each ANI value, estimated by resampling the query
+        fragments sampled with options.sample_fragments (see
+        bootstrap_interval), with options.bootstrap replicates.
+
+        Fragment-level results are only available for pairwise BLASTN
+        output files, so the bounds are NaN for comparisons reused from the
+        result store, run with options.blast_batch or options.blast_stream,
+        or skipped by the prefilter.
+
+        - comparisons is a list of Comparisons, as returned by
+              pairwise_blast
+
+        - sampled is a dictionary of the number of fragments sampled from
+              each query organism
+
+        - results is the PairwiseResults of the comparisons
+    """
+    logger.info("Estimating bootstrap confidence intervals for ANI")
+    low = np.full(results.perc_ids.shape, np.nan)
+    high = np.full(results.perc_ids.shape, np.nan)
+    rng = np.random.default_rng(options.sample_seed)
+    intervals = {}
+    for comparison in comparisons:
+        outfile = comparison.outfile
+        if outfile is None or options.blast_batch or \
+                not os.path.exists(outfile):
+            continue
+        if outfile not in intervals:
+            lengths, errors = parse_blast_fragments(outfile)
+            intervals[outfile] = bootstrap_interval(
+                lengths, errors, sampled[comparison.qname], options.bootstrap,
+                rng)
+        idx = results.rows[comparison.qname]
+        jdx = results.cols[comparison.sname]
+        low[idx, jdx], high[idx, jdx] = intervals[outfile]
+        if results.rows is results.cols:
+            low[jdx, idx], high[jdx, idx] = intervals[outfile]
+    return low, high
+
+# Bootstrap a confidence interval for ANI from fragment alignments
+def bootstrap_interval(lengths, errors, nfrags, nboot, rng,
+                       level=BOOTSTRAP_LEVEL):
+    """ Returns a (low, high) tuple of the bounds of a percentile bootstrap
+        confidence interval for the ANI (1 - total errors / total aligned
+        length) of a set of query fragments, or (NaN, NaN) if no fragment
+        aligned. Each replicate draws nfrags fragments, with replacement,
+        from all of the query fragments, of which those that did not align
+        add nothing to either total.
+
+        - lengths, errors are arrays of the aligned length and similarity
+              errors of each aligned fragment
+
+        - nfrags is the number of query fragments, aligned or not
+
+        - nboot is the number of bootstrap replicates
+
+        - rng is a numpy.random.Generator
+
+        - level is the confidence level of the interval
+    """
+    if not len(lengths):
+        return np.nan, np.nan
+    nfrags = max(nfrags, len(lengths))
+    # Only the counts of the aligned fragments in each replicate matter
+    counts = rng.multinomial(nfrags, np.full(nfrags, 1. / nfrags),
+                             size=nboot)[:, :len(lengths)]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        anis = 1 - np.dot(counts, errors) / np.dot(counts, lengths)
+    tail = 50. * (1 - level)
+    return tuple(np.nanpercentile(anis, [tail, 100 - tail]).tolist())
+
+# Make empty result arrays for a set of pairwise comparisons
+def new_pairwise_results(infiles, references=None):
+    """ Returns a PairwiseResults of zeroed arrays, with a row for each
+        input file and, if references is given, a column for each reference
+        file; otherwise, a column for each input file.
+
+        With options.sparse_output, an empty SparseResults is returned
+        instead, so that no NxN array is made.
+
+        - infiles is a list of input (or query) files
+
+        - references is an optional list of reference files
+    """
+    qnames = sorted(set(os.path.splitext(os.path.split(fn)[-1])[0] \
+                            for fn in infiles))
+    rows = dict((name, idx) for idx, name in enumerate(qnames))
+    if references is None:
+        cols = rows
+    else:
+        rnames = sorted(set(os.path.splitext(os.path.split(fn)[-1])[0] \
+                                for fn in references))
+        cols = dict((name, idx) for idx, name in enumerate(rnames))
+    if options.sparse_output is not None:
+        return SparseResults(rows, cols, options.sparse_output, [])
+    shape = (len(rows), len(cols))
+    return PairwiseResults(rows, cols, np.zeros(shape, dtype=np.int64),
+                           np.zeros(shape, dtype=np.int64), np.zeros(shape),
+                           np.zeros(shape))
+
+# Record the result of one pairwise comparison
+def set_pairwise_result(results, org_lengths, qname, sname, aln_length,
+                        sim_errors, perc_id):
+    """ Sets the cells of the passed PairwiseResults for the comparison of
+        query qname with subject sname. When every organism is compared with
+        every other (results.rows is results.cols), the (sname, qname) cells
+        are set too, with the percentage aligned of sname.
+
+        For a SparseResults, the comparison is kept, once, only if perc_id
+        is at least results.min_ani.
+
+        - results is a PairwiseResults or SparseResults
+
+        - org_lengths is a dictionary of total sequence lengths for each
+              input sequence
+
+        - qname, sname are the query and subject organism names
+
+        - aln_length, sim_errors, perc_id are the results of the comparison
+    """
+    idx, jdx = results.rows[qname], results.cols[sname]
+    if isinstance(results, SparseResults):
+        if perc_id >= results.min_ani:
+            results.edges.append((idx, jdx, aln_length, sim_errors, perc_id,
+                                  1. * aln_length / org_lengths[qname],
+                                  1. * aln_length / org_lengths[sname]))
+        return
+    results.lengths[idx, jdx] = aln_length
+    results.sim_errors[idx, jdx] = sim_errors
+    results.perc_ids[idx, jdx] = perc_id
+    results.perc_aln[idx, jdx] = 1. * aln_length / org_lengths[qname]
+    if results.rows is results.cols:
+        results.lengths[jdx, idx] = aln_length
+        results.sim_errors[jdx, idx] = sim_errors
+        results.perc_ids[jdx, idx] = perc_id
+        results.perc_aln[jdx, idx] = 1. * aln_length / org_lengths[sname]
+
+# Collect total alignment length and similarity errors for each pairwise
+# comparison, from the result store or by parsing aligner output
+@timed_stage('process_comparisons')
+def process_comparisons(org_lengths, comparisons, parser, results):
+    """ Fills in and returns the passed PairwiseResults with the total
+        aligned length, similarity errors, percentage identity, and
+        percentage aligned for each comparison (see process_delta).
+
+        Totals are taken from the result store where present; otherwise the
+        comparison's aligner output is parsed, and the totals added to the
+        store. Each output file is parsed only once, however many
+        comparisons share it. With options.export_alignments, a warning
+        lists the comparisons whose alignments were not exported because
+        their totals came from the store.
+
+        - org_lengths is a dictionary of total sequence lengths for each
+              input sequence
+
+        - comparisons is a list of Comparisons
+
+        - parser is a function returning (aln_length, sim_errors) for a
+              Comparison, from its aligner output file
+
+        - results is a PairwiseResults, as returned by new_pairwise_results
+    """
+    # perc_aln is useful, as it is a matrix of the minimum percentage of an
+    # organism's genome involved in a pairwise alignment
+    totals, unexported = {}, []
+    for comparison in comparisons:
+        qname, sname = comparison.qname, comparison.sname
+        logger.info("Query organism: %s; Subject organism: %s" % \
+                        (qname, sname))
+        if comparison.key not in totals:
+            result = fetch_result(comparison.key)
+            if result is None:
+                logger.info("Processing %s" % comparison.outfile)
+                result = parser(comparison)
+                save_result(comparison.key, *result)
+            else:
+                logger.info("Using stored result")
+                if options.export_alignments:
+                    unexported.append("%s_vs_%s" % (qname, sname))
+            totals[comparison.key] = result
+        tot_length, tot_sim_error = totals[comparison.key]
+        if tot_length:
+            perc_id = 1 - 1. * tot_sim_error/tot_length
+        else:
+            perc_id = 0.0
+        set_pairwise_result(results, org_lengths, qname, sname, tot_length,
+                            tot_sim_error, perc_id)
+    if unexported:
+        logger.warning("Alignments not exported for %d comparisons " % \
+                           len(unexported) +\
+                           "with results from --store (run without " +\
+                           "--store to export them): " + \
+                           ', '.join(unexported))
+    if store is not None:
+        store.commit()
+    return results
+
+# Approximate number of bytes of alignment output read into memory at a time
+# by the .delta and .blast_tab parsers
+PARSE_CHUNKSIZE = 4 * 1024 * 1024
+
+# Columns of the BLASTN tabular output used by parse_blast, as a NumPy
+# structured dtype, with their (zero-based) positions in the output
+BLAST_TAB_COLUMNS = (0, 1, 2, 3, 5, 6)
+BLAST_TAB_DTYPE = np.dtype([('qseqid', 'U128'), ('sseqid', 'U128'),
+                            ('length', np.int64), ('mismatch', np.int64),
+                            ('nident', np.int64), ('qlen', np.int64)])
+
+# Further columns read by parse_blast to export each alignment, with the
+# subject length and the coordinates of the alignment
+BLAST_EXPORT_COLUMNS = BLAST_TAB_COLUMNS + (7, 8, 9, 10, 11)
+BLAST_EXPORT_DTYPE = np.dtype(BLAST_TAB_DTYPE.descr + \
+                                  [('slen', np.int64), ('qstart', np.int64),
+                                   ('qend', np.int64), ('sstart', np.int64),
+                                   ('send', np.int64)])
+
+# Read a text file in blocks of whole lines
+def read_line_chunks(fh, chunksize=PARSE_CHUNKSIZE):
+    """ Generator yielding lists of lines from the passed open file, each
+        list holding approximately chunksize bytes of whole lines.
+
+        - fh is an open file handle
+
+        - chunksize is the approximate size in bytes of each block
+    """
+    while True:
+        lines = fh.readlines(chunksize)
+        if not lines:
+            return
+        yield lines
+
+# Read the alignment records from a NUCmer delta file in columnar blocks
+def iter_delta_chunks(filename, chunksize=PARSE_CHUNKSIZE, with_seqs=False,
+                      seqids=None):
+    """ Generator yielding Nx7 integer arrays of the alignment header lines
+        (rstart, rend, qstart, qend, errors, simerrors, stops) from the
+        passed NUCmer .delta file, one array per block of input.
+
+        - filename is the path to the input .delta file
+
+        - chunksize is the approximate size in bytes of each block
+
+        - with_seqs, if True, yields (alignments, seqs) tuples instead, where
+              seqs is an Nx2 integer array identifying the reference and
+              query sequences of each alignment; each sequence name in the
+              file is given its own number
+
+        - seqids is an optional dictionary in which, with with_seqs, the
+              number and length of each sequence are recorded as a tuple,
+              keyed by ('r', name) for reference and ('q', name) for query
+              sequences
+    """
+    seqids, header = {} if seqids is None else seqids, None
+    with open(filename, 'r') as fh:
+        # Skip the input file and program headers
+        fh.readline()
+        fh.readline()
+        for lines in read_line_chunks(fh, chunksize):
+            # We only want lines with seven columns; sequence headers start
+            # with '>' and indel positions are a single column
+            if not with_seqs:
+                alns = [l for l in lines if l.count(' ') == 6 and l[0] != '>']
+                if alns:
+                    yield np.loadtxt(alns, dtype=np.int64, ndmin=2)
+                continue
+            alns, seqs = [], []
+            for l in lines:
+                if l[0] == '>':
+                    rname, qname, rlen, qlen = l[1:].split()[:4]
+                    header = (seqids.setdefault(('r', rname),
+                                                (len(seqids), int(rlen)))[0],
+                              seqids.setdefault(('q', qname),
+                                                (len(seqids), int(qlen)))[0])
+                elif l.count(' ') == 6:
+                    alns.append(l)
+                    seqs.append(header)
+            if alns:
+                yield (np.loadtxt(alns, dtype=np.int64, ndmin=2),
+                       np.array(seqs, dtype=np.int64))
+
+# Read the BLASTN tabular output in columnar blocks
+def iter_blast_chunks(source, chunksize=PARSE_CHUNKSIZE, copy=None,
+                      detail=False):
+    """ Generator yielding structured arrays (see BLAST_TAB_DTYPE) of the
+        query ID, subject ID, alignment length, mismatch, identity and query
+        length columns of the passed BLASTN tabular output, one array per
+        block of input.
+
+        - source is the location of the BLASTN tabular output, or an open
+              text stream of it (such as BLASTN's standard output)
+
+        - chunksize is the approximate size in bytes of each block
+
+        - copy is an optional open file to which the raw lines are written
+              as they are read
+
+        - detail, if True, also reads the subject length and alignment
+              coordinates (see BLAST_EXPORT_DTYPE)
+    """
+    if isinstance(source, str):
+        with open(source, 'r') as fh:
+            for hits in iter_blast_chunks(fh, chunksize, copy, detail):
+                yield hits
+        return
+    for lines in read_line_chunks(source, chunksize):
+        if copy is not None:
+            copy.writelines(lines)
+        hits = [l for l in lines if l.strip() and not l.startswith('#')]
+        if hits:
+            yield np.loadtxt(hits, delimiter='\t',
+                             usecols=BLAST_EXPORT_COLUMNS if detail else \
+                                 BLAST_TAB_COLUMNS,
+                             dtype=BLAST_EXPORT_DTYPE if detail else \
+                                 BLAST_TAB_DTYPE, ndmin=1)
+
+# Parse NUCmer delta file to get total alignment length and total sim_errors
+def parse_delta(filename, one_to_one=False, export=None):
+    """ Reads a NUCmer output .delta file, extracting the aligned length and
+        number of similarity errors for each aligned uniquely-matched region,
+        and returns the cumulative total for each as a tuple.
+
+        The file is read in blocks (see iter_delta_chunks), so memory use
+        does not depend on the size of the file, unless one_to_one is set.
+
+        - filename is the path to the input .delta file
+
+        - one_to_one, if True, counts only the alignments kept by a
+              one-to-one filter (see one_to_one_mask), approximating
+              delta-filter -1. The alignment records (but not their indel
+              positions) are then held in memory until the file is read
+
+        - export, if given, is a (query, subject) tuple of the organism
+              names of the comparison, and each alignment is also written
+              to a columnar export file (see write_alignment_export). The
+              reference sequences are the query side, and the NUCmer query
+              sequences the subject side
+    """
+    aln_length, sim_errors = 0, 0
+    if one_to_one or export is not None:
+        seqids = {}
+        blocks = list(iter_delta_chunks(filename, with_seqs=True,
+                                        seqids=seqids))
+        alns = np.concatenate([alns for alns, seqs in blocks] or \
+                                  [np.zeros((0, 7), dtype=np.int64)])
+        seqs = np.concatenate([seqs for alns, seqs in blocks] or \
+                                  [np.zeros((0, 2), dtype=np.int64)])
+        counted = one_to_one_mask(alns, seqs) if one_to_one else \
+            np.ones(len(alns), dtype=bool)
+        lengths = np.abs(alns[:, 1] - alns[:, 0])
+        if export is not None:
+            # Number the sequences of each side separately
+            sides = {}
+            index = np.zeros(len(seqids), dtype=np.int64)
+            for (side, name), (number, length) in sorted(
+                    seqids.items(), key=lambda item: item[1][0]):
+                names = sides.setdefault(side, ([], []))
+                index[number] = len(names[0])
+                names[0].append(name)
+                names[1].append(length)
+            rnames, rlens = sides.get('r', ([], []))
+            qnames, qlens = sides.get('q', ([], []))
+            write_alignment_export(filename, export, 'delta', {
+                'query_contigs': np.array(rnames, dtype=str),
+                'query_contig_lengths': np.array(rlens, dtype=np.int64),
+                'subject_contigs': np.array(qnames, dtype=str),
+                'subject_contig_lengths': np.array(qlens, dtype=np.int64),
+                'query_contig': index[seqs[:, 0]],
+                'subject_contig': index[seqs[:, 1]],
+                'query_start': alns[:, 0], 'query_end': alns[:, 1],
+                'subject_start': alns[:, 2], 'subject_end': alns[:, 3],
+                'length': lengths, 'sim_errors': alns[:, 4],
+                'counted': counted})
+        return int(lengths[counted].sum()), int(alns[counted, 4].sum())
+    for alns in iter_delta_chunks(filename):
+        aln_length += int(np.abs(alns[:, 1] - alns[:, 0]).sum())
+        sim_errors += int(alns[:, 4].sum())
+    return aln_length, sim_errors
+
+# Choose a one-to-one set of NUCmer alignments
+def one_to_one_mask(alns, seqs):
+    """ Returns a boolean array marking the alignments to keep so that
+        each region of the reference and of the query is covered by only
+        one alignment, dropping overlapping and repeat-induced alignments.
+        This is a greedy approximation to delta-filter -1: unlike it, no
+        longest increasing subset of alignments is sought, and overlapping
+        alignments are dropped rather than trimmed.
+
+        Overlaps are resolved separately along the reference and along the
+        query (see sweep_overlaps), and only alignments kept along both are
+        kept. Each alignment is scored by its aligned length less its
+        similarity errors.
+
+        - alns is an Nx7 array of alignment records, as yielded by
+              iter_delta_chunks
+
+        - seqs is an Nx2 array of reference and query sequence numbers for
+              each alignment, as yielded by iter_delta_chunks
+    """
+    scores = np.abs(alns[:, 1] - alns[:, 0]) - alns[:, 4]
+    qstarts = np.minimum(alns[:, 2], alns[:, 3])
+    qends = np.maximum(alns[:, 2], alns[:, 3])
+    return sweep_overlaps(seqs[:, 0], alns[:, 0], alns[:, 1], scores) & \
+        sweep_overlaps(seqs[:, 1], qstarts, qends, scores)
+
+# Resolve overlapping intervals with a sweep line
+def sweep_overlaps(seqs, starts, ends, scores,
+                   max_overlap=ONE_TO_ONE_MAX_OVERLAP):
+    """ Returns a boolean array marking the intervals kept when overlaps
+        are resolved greedily in favour of the higher-scoring interval, so
+        that no two kept intervals overlap by more than max_overlap of the
+        shorter one's length. Intervals are swept in order of start
+        position on each sequence, and each is compared with every kept
+        interval that reaches past its start: it is dropped if any of those
+        it overlaps too far scores at least as well (the earlier is kept on
+        a tie), and otherwise replaces them all. Dropped intervals are not
+        reconsidered.
+
+        - seqs, starts, ends, scores are integer arrays of the sequence
+              number, start and end position (start <= end), and score of
+              each interval
+    """
+    keep = np.ones(len(starts), dtype=bool)
+    order = np.lexsort((starts, seqs)).tolist()
+    seqs, starts, ends, scores = [arr.tolist() for arr in \
+                                      (seqs, starts, ends, scores)]
+    active = []
+    for idx in order:
+        # Kept intervals on this sequence that reach past this start
+        active = [jdx for jdx in active if seqs[jdx] == seqs[idx] and \
+                      ends[jdx] > starts[idx]]
+        length = ends[idx] - starts[idx]
+        clashes = [jdx for jdx in active if \
+                       min(ends[idx], ends[jdx]) - starts[idx] > \
+                       max_overlap * min(length, ends[jdx] - starts[jdx])]
+        if any(scores[idx] <= scores[jdx] for jdx in clashes):
+            keep[idx] = False
+            continue
+        for jdx in clashes:
+            keep[jdx] = False
+        active = [jdx for jdx in active if keep[jdx]] + [idx]
+    return keep
+
+# Sum the alignment lengths and errors of fragments that pass the Goris et
+# al. (2007) coverage and identity thresholds
+def goris_filter_totals(hits):
+    """ Returns a tuple of the total alignment length and similarity errors
+        for those query fragments whose matches cover more than 70% of the
+        fragment, with more than 30% identity over the fragment length.
+
+        - hits is a structured array (see BLAST_TAB_DTYPE) of BLASTN matches,
+              in which all matches for each query fragment are adjacent
+    """
+    qalnlen, qerr = goris_filter_fragments(hits)
+    return int(qalnlen.sum()), int(qerr.sum())
+
+# Get the alignment length and similarity errors of each query fragment
+# that passes the Goris et al. (2007) thresholds
+def goris_filter_fragments(hits):
+    """ Returns a tuple of integer arrays of the alignment length and
+        similarity errors of each query fragment that passes the thresholds
+        of goris_filter_totals, in the order the fragments are reported.
+
+        - hits is as for goris_filter_totals
+    """
+    starts, qalnlen, qerr, keep = goris_filter_queries(hits)
+    return qalnlen[keep].astype(np.int64), qerr[keep].astype(np.int64)
+
+# Apply the Goris et al. (2007) thresholds to each query fragment
+def goris_filter_queries(hits):
+    """ Returns a tuple of arrays with an entry for each query fragment in
+        the passed matches, in the order reported: the index of its first
+        match, its total alignment length and similarity errors, and whether
+        it passes the thresholds of goris_filter_totals.
+
+        - hits is as for goris_filter_totals
+    """
+    if not len(hits):
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty, np.zeros(0, dtype=bool)
+    # Collate matches by query ID
+    qids = hits['qseqid']
+    starts = np.flatnonzero(np.r_[True, qids[1:] != qids[:-1]])
+    qalnlen = np.add.reduceat(hits['length'], starts)
+    qnumid = np.add.reduceat(hits['nident'], starts)
+    qerr = np.add.reduceat(hits['mismatch'], starts)
+    qlen = hits['qlen'][starts]
+    keep = (qalnlen > 0.7 * qlen) & (qnumid > 0.3 * qlen)
+    return starts, qalnlen, qerr, keep
+
+# Read BLASTN tabular output in blocks that each hold all of the matches
+# for the query fragments they contain
+def iter_complete_queries(source, copy=None, detail=False):
+    """ Generator yielding structured arrays (see BLAST_TAB_DTYPE) of BLASTN
+        matches, as for iter_blast_chunks, except that the matches for any
+        one query fragment are never split between two arrays.
+
+        BLASTN reports all matches for a query together, so only the matches
+        for the last query fragment of a block are held back and added to the
+        next one; memory use does not depend on the size of the file.
+
+        - source, copy, detail are as for iter_blast_chunks
+    """
+    held = None
+    for hits in iter_blast_chunks(source, copy=copy, detail=detail):
+        if held is not None:
+            hits = np.concatenate((held, hits))
+        qids = hits['qseqid']
+        last = np.flatnonzero(qids != qids[-1])
+        last = last[-1] + 1 if len(last) else 0
+        held = hits[last:]
+        if last:
+            yield hits[:last]
+    if held is not None:
+        yield held
+
+# Parse custom BLASTN output to get total alignment length and mismatches
+def parse_blast(filename, copy=None, export=None):
+    """ Calculate the alignment length and total number of similarity errors
+        for the passed BLASTN alignment file generated by comparing fragmented
+        input sequences.
+
+        The file is read in blocks (see iter_complete_queries), so memory use
+        does not depend on the size of the file.
+
+        - filename is the location of the BLASTN output for a pairwise
+              comparison between input sequences, or an open text stream of
+              that output
+
+        - copy is an optional open file to which the raw output is copied
+
+        - export, if given, is a (query, subject) tuple of the organism
+              names of the comparison, and each match is also written to a
+              columnar export file (see write_alignment_export). Query
+              fragments are placed on the query's contigs using the
+              fragment map beside the output file (see fragment_file). The
+              matches are then held in memory until the file is read
+    """
+    # We need to collate matches by query ID, to determine whether the
+    # match has > 30% identity and > 70% coverage.
+    # Following Goris et al (2007) we only use matches that contribute to
+    # a total match identity of at least 30% and a total match coverage
+    # of at least 70% of either query or reference length
+    aln_length, sim_errors = 0, 0
+    blocks = []
+    for hits in iter_complete_queries(filename, copy,
+                                      detail=export is not None):
+        starts, qalnlen, qerr, keep = goris_filter_queries(hits)
+        aln_length += int(qalnlen[keep].sum())
+        sim_errors += int(qerr[keep].sum())
+        if export is not None:
+            blocks.append((hits, np.repeat(keep, np.diff(np.r_[starts,
+                                                               len(hits)]))))
+    if export is not None:
+        export_blast_alignments(filename, export, blocks)
+    return aln_length, sim_errors
+
+# Write the matches parsed from BLASTN output to a columnar export
+def export_blast_alignments(filename, export, blocks):
+    """ Writes the passed BLASTN matches to a columnar export file (see
+        write_alignment_export), with the query fragment coordinates
+        converted to coordinates on the query's contigs.
+
+        - filename is the location of the BLASTN output
+
+        - export is a (query, subject) tuple of the organism names of the
+              comparison; the query's fragment map (see
+              make_fragment_map_filename) is read from the directory of
+              the output
+
+        - blocks is a list of (hits, counted) tuples of structured arrays
+              of matches (see BLAST_EXPORT_DTYPE), and of whether each was
+              counted in the comparison's totals
+    """
+    hits = np.concatenate([hits for hits, counted in blocks] or \
+                              [np.zeros(0, dtype=BLAST_EXPORT_DTYPE)])
+    counted = np.concatenate([counted for hits, counted in blocks] or \
+                                 [np.zeros(0, dtype=bool)])
+    with np.load(os.path.join(os.path.dirname(filename),
+                              export[0] + '.fragments.npz')) as fragments:
+        # Fragments are named fragNNNNN, numbered from one
+        frags = np.char.lstrip(hits['qseqid'], 'frag').astype(np.int64) - 1
+        offsets = fragments['fragment_starts'][frags]
+        query_contig = fragments['fragment_contigs'][frags]
+        query_contigs = fragments['contigs']
+        query_lengths = fragments['lengths']
+    subject_contigs, first, subject_contig = np.unique(
+        hits['sseqid'], return_index=True, return_inverse=True)
+    write_alignment_export(filename, export, 'blast_tab', {
+        'query_contigs': query_contigs,
+        'query_contig_lengths': query_lengths,
+        'subject_contigs': np.array(subject_contigs.tolist(), dtype=str),
+        'subject_contig_lengths': hits['slen'][first],
+        'query_contig': query_contig,
+        'subject_contig': subject_contig.ravel(),
+        'query_start': hits['qstart'] + offsets,
+        'query_end': hits['qend'] + offsets,
+        'subject_start': hits['sstart'], 'subject_end': hits['send'],
+        'length': hits['length'], 'sim_errors': hits['mismatch'],
+        'counted': counted})
+
+# Write a columnar export of the alignments of one pairwise comparison
+def write_alignment_export(filename, export, fmt, columns):
+    """ Writes the alignments parsed from an aligner output file, with
+        the names of the comparison's organisms and the output format, as a
+        compressed NumPy archive beside the output file (see
+        make_alignment_export_filename). The archive is written under a
+        temporary name and renamed when complete (see
+        make_partial_filename).
+
+        Each archive holds query_contigs and subject_contigs, the contig
+        names of each side, with their lengths in query_contig_lengths and
+        subject_contig_lengths, and an array for each alignment field:
+
+        - query_contig, subject_contig: the contig of each side, as an
+              index into the contig names
+
+        - query_start, query_end, subject_start, subject_end: 1-based
+              coordinates on each contig; the end is less than the start on
+              the reverse strand
+
+        - length, sim_errors: the aligned length and similarity errors, as
+              counted in the comparison's totals
+
+        - counted: whether the alignment was counted in the totals (False
+              where removed by the one-to-one filter, or for BLASTN matches
+              of fragments that fail the Goris et al. (2007) thresholds)
+
+        - filename is the location of the aligner output
+
+        - export is a (query, subject) tuple of the organism names
+
+        - fmt is the format of the aligner output ('delta' or 'blast_tab')
+
+        - columns is a dictionary of arrays, keyed by name
+    """
+    outfile = make_alignment_export_filename(filename)
+    partial = make_partial_filename(outfile)
+    with open(partial, 'wb') as fh:
+        np.savez_compressed(fh, query=export[0], subject=export[1],
+                            format=fmt, **columns)
+    os.replace(partial, outfile)
+    return outfile
+
+# Return the location of the columnar export of an aligner output file
+def make_alignment_export_filename(filename):
+    """ Returns the location of the per-alignment export written beside the
+        passed aligner output file with options.export_alignments (see
+        write_alignment_export): the output file name, with the extension
+        .alignments.npz.
+
+        - filename is the location of a .delta or .blast_tab file
+    """
+    return os.path.splitext(filename)[0] + '.alignments.npz'
+
+# Summarise the exported alignments of a comparison by contig
+def contig_ani(filename, side='query', counted=True):
+    """ Returns a structured array with a row for each contig of one side of
+        a pairwise comparison, from the alignment export written with
+        options.export_alignments, so that per-contig results do not need
+        the aligner output to be parsed again. The fields are:
+
+        - contig, length: the contig name and length
+
+        - aln_length, sim_errors: the total aligned length and similarity
+              errors of the alignments on the contig
+
+        - perc_id: the identity of those alignments (NaN if there are none)
+
+        - perc_aln: the aligned length as a fraction of the contig length
+
+        The totals over all contigs are those of the comparison. For ANIb,
+        perc_aln counts each fragment's matches, and may exceed one where
+        matches overlap.
+
+        - filename is the location of the alignment export, or of the
+              aligner output file it was written beside
+
+        - side is 'query' or 'subject', the side whose contigs are
+              summarised (for ANIm, the NUCmer reference and query
+              sequences)
+
+        - counted, if False, also includes the alignments that were not
+              counted in the comparison's totals
+    """
+    if side not in ('query', 'subject'):
+        raise ValueError("side must be 'query' or 'subject', not %r" % side)
+    if not filename.endswith('.alignments.npz'):
+        filename = make_alignment_export_filename(filename)
+    with np.load(filename) as export:
+        names = export[side + '_contigs']
+        lengths = export[side + '_contig_lengths']
+        keep = export['counted'] if counted else \
+            np.ones(len(export['counted']), dtype=bool)
+        contig = export[side + '_contig'][keep]
+        aln_length = np.bincount(contig, weights=export['length'][keep],
+                                 minlength=len(names)).astype(np.int64)
+        sim_errors = np.bincount(contig,
+                                 weights=export['sim_errors'][keep],
+                                 minlength=len(names)).astype(np.int64)
+    summary = np.zeros(len(names), dtype=[
+        ('contig', names.dtype if len(names) else 'U1'),
+        ('length', np.int64), ('aln_length', np.int64),
+        ('sim_errors', np.int64), ('perc_id', float), ('perc_aln', float)])
+    summary['contig'] = names
+    summary['length'] = lengths
+    summary['aln_length'] = aln_length
+    summary['sim_errors'] = sim_errors
+    with np.errstate(invalid='ignore', divide='ignore'):
+        summary['perc_id'] = 1 - sim_errors / aln_length.astype(float)
+        summary['perc_aln'] = aln_length / lengths.astype(float)
+    return summary
+
+# Parse BLASTN output into the totals for each query fragment
+def parse_blast_fragments(filename):
+    """ Returns a tuple of integer arrays of the alignment length and
+        similarity errors of each query fragment in the passed BLASTN output
+        file that passes the Goris et al. (2007) thresholds (see
+        goris_filter_fragments); their sums are the totals returned by
+        parse_blast.
+
+        - filename is the location of the BLASTN output for a pairwise
+              comparison
+    """
+    lengths, errors = [], []
+    for hits in iter_complete_queries(filename):
+        qalnlen, qerr = goris_filter_fragments(hits)
+        lengths.append(qalnlen)
+        errors.append(qerr)
+    if not lengths:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(lengths), np.concatenate(errors)
+
+# Parse BLASTN output against a combined database into per-genome totals
+def parse_blast_batch(filename, ngenomes, copy=None):
+    """ Returns a tuple of (aln_lengths, sim_errors) arrays, giving the total
+        alignment length and similarity errors of the query fragments
+        against each genome in a combined BLAST database (see
+        make_combined_blast_db), indexed by genome.
+
+        This approximates parse_blast on a separate BLASTN run against
+        each genome with -max_target_seqs 1: for each query fragment and
+        subject genome, only the matches to the best (first reported)
+        subject sequence in that genome are used, and the Goris et al.
+        (2007) coverage and identity thresholds are applied per fragment and
+        genome. It is not exact: BLASTN reports at most
+        BATCH_TARGETS_PER_GENOME * ngenomes target sequences for each
+        fragment, a cap shared by all genomes, so a fragment from a repeat
+        that matches many sequences in some genomes may lose its best match
+        in others; and E-values are calculated against the whole combined
+        database, so matches near the E-value cutoff can differ.
+
+        - filename is the location of the BLASTN tabular output, or an open
+              text stream of it
+
+        - ngenomes is the number of genomes in the combined database
+
+        - copy is an optional open file to which the raw output is copied
+    """
+    aln_lengths = np.zeros(ngenomes, dtype=np.int64)
+    sim_errors = np.zeros(ngenomes, dtype=np.int64)
+    for hits in iter_complete_queries(filename, copy):
+        # Subject IDs are g<genome index>_<sequence index>
+        genome = np.char.lstrip(np.char.partition(hits['sseqid'],
+                                                  '_')[:, 0], 'g')
+        genome = genome.astype(np.int64)
+        qids = hits['qseqid']
+        frag = np.cumsum(np.r_[False, qids[1:] != qids[:-1]])
+        groups, first, inverse = np.unique(frag * ngenomes + genome,
+                                           return_index=True,
+                                           return_inverse=True)
+        inverse = inverse.ravel()
+        # Keep only the matches to the first subject sequence reported for
+        # each fragment in each genome
+        keep = hits['sseqid'] == hits['sseqid'][first][inverse]
+        qalnlen = np.bincount(inverse, weights=hits['length'] * keep)
+        qnumid = np.bincount(inverse, weights=hits['nident'] * keep)
+        qerr = np.bincount(inverse, weights=hits['mismatch'] * keep)
+        qlen = hits['qlen'][first]
+        passed = (qalnlen > 0.7 * qlen) & (qnumid > 0.3 * qlen)
+        aln_lengths += np.bincount(groups[passed] % ngenomes,
+                                   weights=qalnlen[passed],
+                                   minlength=ngenomes).astype(np.int64)
+        sim_errors += np.bincount(groups[passed] % ngenomes,
+                                  weights=qerr[passed],
+                                  minlength=ngenomes).astype(np.int64)
+    return aln_lengths, sim_errors
+
+# Make a parser for the output of batch_blast
+def make_batch_blast_parser(genome_index):
+    """ Returns a function, for process_comparisons, that returns the
+        (aln_length, sim_errors) totals for a Comparison made by
+        batch_blast. Each BLASTN output file is parsed once (see
+        parse_blast_batch), and its totals for every subject genome kept.
+
+        - genome_index is a dictionary of the index of each organism in the
+              combined database, as returned by make_combined_blast_db
+    """
+    parsed = stream_results
+    def parser(comparison):
+        if comparison.outfile not in parsed:
+            parsed[comparison.outfile] = \
+                parse_blast_batch(comparison.outfile, len(genome_index))
+        aln_lengths, sim_errors = parsed[comparison.outfile]
+        sidx = genome_index[comparison.sname]
+        return int(aln_lengths[sidx]), int(sim_errors[sidx])
+    return parser
+
+
+# Make a job output consumer that parses BLASTN output as it is produced
+def make_stream_consumer(outfile, parser):
+    """ Returns a function, for the consumer of a Job, that parses BLASTN
+        tabular output from the job's standard output with the passed parser
+        and records the result in stream_results, keyed by outfile. The raw
+        output is not written, unless options.keep_hits is set, in which case
+        a gzip-compressed copy is written to outfile + '.gz'.
+
+        - outfile is the location the BLASTN output would otherwise have
+              been written to
+
+        - parser is a function taking an open text stream and an optional
+              file for a copy of the output, such as parse_blast
+    """
+    def consumer(fh):
+        if options.keep_hits:
+            with gzip.open(outfile + '.gz', 'wt') as copy:
+                stream_results[outfile] = parser(fh, copy)
+        else:
+            stream_results[outfile] = parser(fh)
+    return consumer
+
+# Run BLASTN pairwise on input files, using the job scheduler
+def pairwise_blast(filenames, org_hashes, org_lengths, prog='blastn',
+                   method='ANIb', references=None, exclude=None):
+    """ Run BLASTN for each pairwise comparison of fragmented input sequences,
+        using the job scheduler (run_jobs) to take advantage of multiple
+        cores where possible, and writing results to the nominated output
+        directory. Returns the list of Comparisons (see
+        schedule_comparisons).
+
+        - filenames is an iterable of locations of input FASTA files, from
+              which BLASTN command lines are constructed.
+
+        - org_hashes is a dictionary of sequence hashes for each organism
+
+        - org_lengths is a dictionary of total sequence lengths for each
+              organism
+
+        - references, if given, is a list of fragmented reference FASTA
+              files; only comparisons of each file in filenames against each
+              reference are then made
+
+        - exclude is an optional collection of (query, subject) organism
+              name tuples not to compare (see make_file_pairs)
+
+        We loop over all FASTA files in the input directory, generating
+        BLASTN command line for each pairwise comparison not already in the
+        result store, and then pass those command lines to the scheduler.
+    """
+    logger.info("Running pairwise BLAST to generate *.blast_tab")
+    params = "%s -fragsize %d %s" % (os.path.basename(prog),
+                                     options.fragsize, BLASTN_ARGS)
+    if options.sample_fragments is not None:
+        params += " -sample %d -seed %d" % (options.sample_fragments,
+                                            options.sample_seed)
+    make_consumer = None
+    if options.blast_stream:
+        make_consumer = lambda outfile: make_stream_consumer(outfile,
+                                                             parse_blast)
+    comparisons, jobs = schedule_comparisons(
+        make_file_pairs(filenames, references, exclude), org_hashes,
+        org_lengths, method, params,
+        lambda f1, f2: make_blast_cmd(f1, f2, prog=prog,
+                                      stream=options.blast_stream),
+        '.blast_tab', BLASTN_THREADS_ARG, make_consumer,
+        (parse_blast, (None,)))
+    logger.info("BLASTN command lines:\n\t%s" % \
+                    '\n\t'.join([job.cmdline for job in jobs]))
+    if not options.skip_blast:
+        run_jobs(jobs)
+    else:
+        logger.warning("BLASTN run skipped!")
+    return comparisons
+
+# Run BLASTN once for each fragmented input file against a combined database
+def batch_blast(filenames, org_hashes, org_lengths, blastdb, ngenomes,
+                prog='blastn', method='ANIb', references=None,
+                exclude=None):
+    """ Run BLASTN once for each fragmented input file, against the combined
+        database of all (reference) genomes made by make_combined_blast_db,
+        rather than once for each pairwise comparison. Returns the list of
+        Comparisons, as for pairwise_blast, except that the outfile of each
+        Comparison holds the hits of the query against all genomes (see
+        make_batch_blast_parser).
+
+        As the database is larger, BLAST's statistics differ slightly from
+        those of separate pairwise runs, so results are stored under
+        different parameters from those of pairwise_blast.
+
+        - filenames, org_hashes, org_lengths, references and exclude are as
+              for pairwise_blast. A query is BLASTed only if at least one of
+              its comparisons is not excluded
+
+        - blastdb is the combined database prefix, as returned by
+              make_combined_blast_db
+
+        - ngenomes is the number of genomes in the combined database
+    """
+    logger.info("Running batched BLAST to generate *_vs_all.blast_tab")
+    params = "%s -fragsize %d -batch %s" % (os.path.basename(prog),
+                                            options.fragsize, BLASTN_ARGS)
+    if options.sample_fragments is not None:
+        params += " -sample %d -seed %d" % (options.sample_fragments,
+                                            options.sample_seed)
+    comparisons, jobs, outfiles = [], [], {}
+    completed = read_completed_outputs() if options.resume else {}
+    reused = 0
+    for f1, f2 in make_file_pairs(filenames, references, exclude):
+        qname = os.path.splitext(os.path.split(f1)[-1])[0]
+        sname = os.path.splitext(os.path.split(f2)[-1])[0]
+        key = make_result_key(org_hashes[qname], org_hashes[sname],
+                              method, params)
+        outfile = None
+        if fetch_result(key) is None:
+            # Identical query sequences under different names share one run
+            if org_hashes[qname] not in outfiles:
+                prefix = os.path.join(options.outdirname,
+                                      "%s_vs_all" % qname)
+                outfile = prefix + '.blast_tab'
+                outfiles[org_hashes[qname]] = outfile
+                consumer = None
+                if options.blast_stream:
+                    consumer = make_stream_consumer(
+                        outfile,
+                        lambda fh, copy=None: parse_blast_batch(fh, ngenomes,
+                                                                copy))
+                cmdline = make_blast_batch_cmd(f1, blastdb, prefix, ngenomes,
+                                               prog=prog,
+                                               stream=options.blast_stream)
+                if is_complete_output(outfile, completed):
+                    reused += 1
+                else:
+                    jobs.append(Job(cmdline, org_lengths[qname],
+                                    BLASTN_THREADS_ARG, consumer,
+                                    None if options.blast_stream else \
+                                        outfile,
+                                    (parse_blast_batch, (ngenomes,)) if \
+                                        options.pipeline and \
+                                        not options.blast_stream else None))
+            outfile = outfiles[org_hashes[qname]]
+        comparisons.append(Comparison(qname, sname, key, outfile))
+    logger.info("%d comparisons, %d BLASTN runs" % (len(comparisons),
+                                                    len(jobs)))
+    if options.resume:
+        logger.info("%d BLASTN outputs reused from earlier run" % reused)
+    logger.info("BLASTN command lines:\n\t%s" % \
+                    '\n\t'.join([job.cmdline for job in jobs]))
+    if not options.skip_blast:
+        run_jobs(jobs)
+    else:
+        logger.warning("BLASTN run skipped!")
+    return comparisons
+
+# Run NUCmer pairwise on the input files, using the job scheduler
+def pairwise_nucmer(filenames, org_hashes, org_lengths, prog='nucmer',
+                    method='ANIm', references=None, exclude=None):
+    """ Run NUCmer to generate pairwise alignment data for each of the
+        input FASTA files. Returns the list of Comparisons (see
+        schedule_comparisons).
+
+        - filenames is a list of input FASTA filenames, from which NUCmer
+              command lines are constructed
+
+        - org_hashes is a dictionary of sequence hashes for each organism
+
+        - org_lengths is a dictionary of total sequence lengths for each
+              organism
+
+        - references, if given, is a list of reference FASTA files; only
+              comparisons of each file in filenames against each reference
+              are then made
+
+        - exclude is an optional collection of (query, subject) organism
+              name tuples not to compare (see make_file_pairs)
+
+        We loop over all FASTA files in the input directory, generating NUCmer
+        command lines for each pairwise comparison not already in the result
+        store, and then pass those command lines to the scheduler.
+
+        If options.nucmer_chunk is set, comparisons with a long query genome
+        are run as several jobs, one for each chunk of the query, and the
+        chunk outputs merged (see chunk_nucmer_jobs).
+    """
+    logger.info("Running pairwise mumer comparison to generate *.delta")
+    params = "%s %s" % (os.path.basename(prog), NUCMER_ARGS)
+    if options.one_to_one:
+        params += " one-to-one"
+    # Chunked -mum alignments can differ from unsplit ones
+    if options.nucmer_chunk is not None:
+        params += " chunk=%d" % options.nucmer_chunk
+    pairs = make_file_pairs(filenames, references, exclude)
+    comparisons, jobs = schedule_comparisons(
+        pairs, org_hashes, org_lengths,
+        method, params, lambda f1, f2: make_nucmer_cmd(f1, f2, prog=prog),
+        '.delta', NUCMER_THREADS_ARG if options.nucmer_threads else None,
+        parser=(parse_delta, (options.one_to_one,)))
+    merges = {}
+    if options.nucmer_chunk is not None:
+        jobs, merges = chunk_nucmer_jobs(pairs, jobs, org_lengths, prog)
+    logger.info("mummer command lines:\n\t%s" % \
+                    '\n\t'.join([job.cmdline for job in jobs]))
+    if not options.skip_nucmer:
+        run_jobs(jobs)
+        merge_chunk_deltas(merges)
+    else:
+        logger.warning("mummer run skipped!")
+    return comparisons
+
+# Split the NUCmer jobs of comparisons with long query genomes into chunks
+def chunk_nucmer_jobs(pairs, jobs, org_lengths, prog='nucmer'):
+    """ Returns a tuple of (jobs, merges). In jobs, each of the passed
+        NUCmer Jobs whose query genome (the second input file) is longer
+        than options.nucmer_chunk is replaced by one Job for each chunk of
+        the query genome (see split_fasta_file), each aligned against the
+        whole reference genome; other Jobs are unchanged. merges is a
+        dictionary, keyed by the output file of each replaced Job, of
+        (reference file, query file, list of chunk output files, list of
+        chunk FASTA files) tuples, for merge_chunk_deltas.
+
+        Chunks are made of whole contigs, so no alignment is cut at a chunk
+        boundary, and the merged totals match those of the unsplit
+        comparison. The exception is query sequence repeated in different
+        chunks: NUCmer's -mum uniqueness is judged within each chunk, so
+        such repeats may align where they would not without chunking.
+
+        With --resume, chunk outputs already completed are not run again.
+
+        - pairs is the list of (f1, f2) input file tuples, as passed to
+              schedule_comparisons
+
+        - jobs is the list of NUCmer Jobs returned by schedule_comparisons
+
+        - org_lengths is a dictionary of total sequence lengths for each
+              organism
+
+        - prog is the NUCmer (or PROmer) executable
+    """
+    pair_files = dict((make_output_prefix(f1, f2) + '.delta', (f1, f2)) \
+                          for f1, f2 in pairs)
+    completed = read_completed_outputs() if options.resume else {}
+    chunked, merges, chunks = [], collections.OrderedDict(), {}
+    for job in jobs:
+        f1, f2 = pair_files[job.outfile]
+        rname = os.path.splitext(os.path.split(f1)[-1])[0]
+        qname = os.path.splitext(os.path.split(f2)[-1])[0]
+        if org_lengths[qname] <= options.nucmer_chunk:
+            chunked.append(job)
+            continue
+        # Each query genome is split once, however many pairs it is in
+        if f2 not in chunks:
+            chunks[f2] = split_fasta_file(f2, options.nucmer_chunk)
+            logger.info("Split %s into %d chunks" % (f2, len(chunks[f2])))
+        merges[job.outfile] = (f1, f2, [],
+                               [chunkfile for chunkfile, length in chunks[f2]])
+        for chunkfile, length in chunks[f2]:
+            outfile = make_output_prefix(f1, chunkfile) + '.delta'
+            merges[job.outfile][2].append(outfile)
+            if not is_complete_output(outfile, completed):
+                chunked.append(Job(make_nucmer_cmd(f1, chunkfile, prog=prog),
+                                   org_lengths[rname] + length,
+                                   job.threads_arg, None, outfile))
+    logger.info("%d comparisons split into chunks, %d jobs to run" % \
+                    (len(merges), len(chunked)))
+    return chunked, merges
+
+# Split a FASTA file into chunks of whole sequences
+def split_fasta_file(filename, chunksize):
+    """ Writes the sequences of the passed FASTA file, in order, to a set
+        of chunk FASTA files in the output directory, named <stem>.chunkNNN
+        .fna, and returns a list of (chunk file, total sequence length)
+        tuples. Sequences are added to a chunk until the next would take it
+        past chunksize bases; sequences are never split, so a sequence
+        longer than chunksize has a chunk to itself. Only one input sequence
+        is held in memory at a time.
+
+        - filename is the location of the input FASTA file
+
+        - chunksize is the target chunk length, in bases
+    """
+    stem = os.path.splitext(os.path.split(filename)[-1])[0]
+    chunks, outfh = [], None
+    with open(filename, 'r') as infh:
+        for title, seq in SimpleFastaParser(infh):
+            if outfh is None or \
+                    (chunks[-1][1] and chunks[-1][1] + len(seq) > chunksize):
+                if outfh is not None:
+                    outfh.close()
+                chunkfile = os.path.join(options.outdirname, "%s.chunk%03d" %\
+                                             (stem, len(chunks) + 1)) + '.fna'
+                outfh = open(chunkfile, 'w')
+                chunks.append([chunkfile, 0])
+            outfh.write(">%s\n%s\n" % (title, seq))
+            chunks[-1][1] += len(seq)
+    if outfh is not None:
+        outfh.close()
+    return [tuple(chunk) for chunk in chunks]
+
+# Merge the NUCmer output for the chunks of a query genome
+@timed_stage('merge_chunk_deltas')
+def merge_chunk_deltas(merges):
+    """ Writes, for each comparison that was split into chunks (see
+        chunk_nucmer_jobs), a single .delta file holding the alignments of
+        every chunk, in chunk order, under a header naming the unsplit input
+        files, as if NUCmer had been run on the whole query genome. The
+        merged file is written under a temporary name and renamed when
+        complete (see finish_output), and the chunk outputs are then
+        removed. The chunk FASTA files of each query genome are removed
+        once every comparison using them has been merged.
+
+        - merges is a dictionary of (reference file, query file, chunk
+              output files, chunk FASTA files) tuples, keyed by merged output
+              file, as returned by chunk_nucmer_jobs
+    """
+    users = collections.Counter(f2 for f1, f2, chunkfiles, seqfiles in \
+                                    merges.values())
+    for outfile, (f1, f2, chunkfiles, seqfiles) in merges.items():
+        logger.info("Merging %d chunk outputs into %s" % (len(chunkfiles),
+                                                          outfile))
+        with open(make_partial_filename(outfile), 'w') as outfh:
+            for idx, chunkfile in enumerate(chunkfiles):
+                with open(chunkfile, 'r') as infh:
+                    infh.readline()
+                    program = infh.readline()
+                    if not idx:
+                        outfh.write("%s %s\n%s" % (f1, f2, program))
+                    shutil.copyfileobj(infh, outfh)
+        finish_output(outfile)
+        for chunkfile in chunkfiles:
+            os.remove(chunkfile)
+        users[f2] -= 1
+        if not users[f2]:
+            for seqfile in seqfiles:
+                os.remove(seqfile)
+
+# List the pairs of input files to be compared
+def make_file_pairs(filenames, references=None, exclude=None):
+    """ Returns a list of (f1, f2) tuples of files to be compared. Without
+        references, this is each unique pair of filenames (the upper
+        triangle of the comparison matrix). With references, this is each
+        file in filenames against each reference, skipping any file paired
+        with itself.
+
+        - filenames is a list of input (or query) files
+
+        - references is an optional list of reference files
+
+        - exclude is an optional collection of (query, subject) organism
+              name tuples not to compare, in the orientation of the pairs
+              returned (see prefilter_pairs); as comparisons may be
+              directional, the reverse pair is still compared
+    """
+    if references is None:
+        pairs = [(f1, f2) for idx, f1 in enumerate(filenames[:-1]) \
+                     for f2 in filenames[idx+1:]]
+    else:
+        pairs = [(f1, f2) for f1 in filenames for f2 in references \
+                     if os.path.split(f1)[-1] != os.path.split(f2)[-1]]
+    if not exclude:
+        return pairs
+    names = lambda fn: os.path.splitext(os.path.split(fn)[-1])[0]
+    return [(f1, f2) for f1, f2 in pairs \
+                if (names(f1), names(f2)) not in exclude]
+
+# Build the list of pairwise comparisons, and the command lines needed to
+# produce the results that are not already stored
+def schedule_comparisons(pairs, org_hashes, org_lengths, method, params,
+                         make_cmd, suffix, threads_arg=None,
+                         make_consumer=None, parser=None):
+    """ Returns a tuple of (comparisons, jobs). comparisons is a list of
+        Comparisons, one for each pair of input files; jobs is the list of
+        aligner Jobs still to be run, sized by the summed length of the two
+        sequences.
+
+        A command line is generated only for the first comparison with a
+        given result store key, and only if that key is not already stored,
+        so comparisons involving identical sequences under different names
+        are run once. With --resume, no command line is generated for a
+        comparison whose output is already complete in the output directory
+        (see is_complete_output).
+
+        - pairs is a list of (f1, f2) input FASTA file tuples, as returned
+              by make_file_pairs
+
+        - org_hashes is a dictionary of sequence hashes for each organism
+
+        - org_lengths is a dictionary of total sequence lengths for each
+              organism
+
+        - method, params describe the ANI method and aligner options, and
+              form part of the result store key
+
+        - make_cmd is a function taking two filenames and returning a
+              command line
+
+        - suffix is the extension of the aligner output file
+
+        - threads_arg is the aligner's thread count option format string, or
+              None if the aligner should always run single-threaded
+
+        - make_consumer is an optional function taking the output file name
+              and returning a consumer for the job's standard output (see
+              make_stream_consumer)
+
+        - parser is an optional (function, arguments) tuple with which to
+              parse each job's output file as soon as the job completes,
+              used with options.pipeline (see parse_job_output)
+    """
+    comparisons, jobs, outfiles = [], [], {}
+    completed = read_completed_outputs() if options.resume else {}
+    reused = 0
+    for f1, f2 in pairs:
+        qname = os.path.splitext(os.path.split(f1)[-1])[0]
+        sname = os.path.splitext(os.path.split(f2)[-1])[0]
+        key = make_result_key(org_hashes[qname], org_hashes[sname],
+                              method, params)
+        if key not in outfiles:
+            if fetch_result(key) is None:
+                outfiles[key] = make_output_prefix(f1, f2) + suffix
+                consumer = None
+                if make_consumer is not None:
+                    consumer = make_consumer(outfiles[key])
+                if is_complete_output(outfiles[key], completed):
+                    reused += 1
+                else:
+                    jobs.append(Job(make_cmd(f1, f2),
+                                    org_lengths[qname] + org_lengths[sname],
+                                    threads_arg, consumer,
+                                    None if consumer else outfiles[key],
+                                    make_job_parser(parser, qname, sname) \
+                                        if options.pipeline and \
+                                        not consumer else None))
+            else:
+                outfiles[key] = None
+        comparisons.append(Comparison(qname, sname, key, outfiles[key]))
+    logger.info("%d comparisons, %d to run" % (len(comparisons), len(jobs)))
+    if options.resume:
+        logger.info("%d aligner outputs reused from earlier run" % reused)
+    return comparisons, jobs
+
+# Add the export names of a comparison to a job's parser arguments
+def make_job_parser(parser, qname, sname):
+    """ Returns the (function, arguments) tuple with which to parse a job's
+        output file (see parse_job_output): the passed parser, with the
+        comparison's organism names added as the final argument if
+        alignments are exported (see make_export_names).
+
+        - parser is a (function, arguments) tuple, or None
+
+        - qname, sname are the organism names of the job's comparison
+    """
+    if parser is None or not options.export_alignments:
+        return parser
+    func, args = parser
+    return func, tuple(args) + (make_export_names((qname, sname)),)
+
+# Run a set of external jobs within a thread budget, largest first
+@timed_stage('run_jobs')
+def run_jobs(jobs):
+    """ Runs the passed Jobs as subprocesses, using at most options.threads
+        cores at a time, and exits with an error if any job fails.
+
+        Jobs are started in order of decreasing size, so that the largest
+        comparisons do not hold up the end of the run. Each job normally
+        gets one core; once fewer jobs are waiting than there are free
+        cores, the spare cores are shared between the remaining jobs that
+        accept a thread count option.
+
+        A job that exits with a non-zero status, or that runs for longer
+        than options.timeout seconds (and is killed), is retried up to
+        options.retries times. Jobs that still fail are written to
+        failed_jobs.tab in the output directory.
+
+        If a Job has a consumer, the job's standard output is passed to it
+        as a text stream, in a separate thread, while the job runs; an
+        exception raised by the consumer fails the job.
+
+        If a Job has a parser, its output is parsed as soon as it succeeds,
+        while other jobs run (see start_parse_pool), and run_jobs returns
+        when the last of the output has been parsed.
+
+        If options.queue is set, the jobs are instead passed to worker
+        processes through the shared-filesystem queue (see run_queued_jobs).
+
+        - jobs is an iterable of Jobs
+    """
+    if options.queue is not None:
+        return run_queued_jobs(jobs)
+    queue = collections.deque(sorted(jobs, key=lambda job: job.size,
+                                     reverse=True))
+    pool = start_parse_pool(queue)
+    try:
+        logger.info("Running %d jobs on %d threads" % (len(queue),
+                                                       options.threads))
+        attempts = collections.Counter()
+        running, failures = {}, []
+        free = options.threads
+        while queue or running:
+            # Start as many jobs as the thread budget allows
+            while queue and free > 0:
+                job = queue.popleft()
+                threads = 1
+                if job.threads_arg is not None and len(queue) < free - 1:
+                    threads = free // (len(queue) + 1)
+                cmdline = add_threads_arg(job.cmdline, job.threads_arg,
+                                          threads)
+                errfh = tempfile.TemporaryFile()
+                stdout = subprocess.DEVNULL
+                if job.consumer is not None:
+                    stdout = subprocess.PIPE
+                proc = subprocess.Popen(cmdline, shell=sys.platform != "win32",
+                                        stdout=stdout, stderr=errfh,
+                                        start_new_session=True,
+                                        universal_newlines=True)
+                reader = None
+                if job.consumer is not None:
+                    reader = start_consumer(job.consumer, proc.stdout)
+                attempts[job] += 1
+                running[proc] = (job, threads, time.time(), errfh, reader)
+                free -= threads
+                logger.info("Started (%d threads): %s" % (threads, cmdline))
+            time.sleep(0.05)
+            # Collect finished jobs, and kill any that have run out of time
+            for proc, (job, threads, started, errfh, reader) in \
+                    list(running.items()):
+                finished = poll_job(proc)
+                if finished is None:
+                    if options.timeout is None or \
+                            time.time() - started < options.timeout:
+                        continue
+                    finished = ('timeout after %ds' % options.timeout,
+                                kill_job(proc))
+                status, usage = finished
+                record_job(job, threads, attempts[job], status,
+                           time.time() - started, usage)
+                if reader is not None:
+                    reader.join()
+                    proc.stdout.close()
+                    if reader.error is not None and status == 0:
+                        status = 'output error: %s' % reader.error
+                del running[proc]
+                free += threads
+                if status == 0:
+                    status = finish_output(job.outfile) or 0
+                if status == 0:
+                    logger.info("Job completed: %s" % job.cmdline)
+                    parse_job_output(pool, job)
+                elif attempts[job] <= options.retries:
+                    logger.warning("Job failed (%s), retrying: %s" % \
+                                       (status, job.cmdline))
+                    queue.appendleft(job)
+                else:
+                    errfh.seek(0)
+                    failures.append((job, status,
+                                     errfh.read().decode(errors='replace')))
+                errfh.close()
+        if failures:
+            write_failed_jobs('failed_jobs.tab', failures, attempts)
+            logger.error("%d jobs failed (exiting)" % len(failures))
+            sys.exit(1)
+    except BaseException:
+        # Do not leave the parsing processes behind on an error
+        stop_parse_pool(pool)
+        raise
+    logger.info("All jobs completed")
+    finish_parse_pool(pool)
+
+# Start processes to parse job output while other jobs run
+def start_parse_pool(jobs):
+    """ Returns a multiprocessing.Pool in which to parse the output of the
+        passed Jobs as each completes (see parse_job_output), or None if
+        none of them has a parser. Parsing takes much less time than
+        alignment, so the pool has one process for every four cores of
+        options.threads, leaving most cores to the aligners.
+
+        - jobs is an iterable of Jobs
+    """
+    if not any(job.parser is not None for job in jobs):
+        return None
+    return multiprocessing.Pool(max(1, options.threads // 4))
+
+# Parse the output of a completed job in the background
+def parse_job_output(pool, job):
+    """ Starts parsing the output file of a completed Job with its parser,
+        in the passed pool, recording the result in stream_results, keyed by
+        the output file, when it is ready. If parsing fails, the error is
+        logged, and the file is left to be parsed again by
+        process_comparisons, which then reports the error as usual.
+
+        - pool is a pool returned by start_parse_pool, or None
+
+        - job is the completed Job
+    """
+    if pool is None or job.parser is None:
+        return
+    func, args = job.parser
+    def failed(exc):
+        logger.warning("Could not parse %s while jobs ran: %s" % \
+                           (job.outfile, exc))
+    pool.apply_async(func, (job.outfile,) + tuple(args),
+                     callback=lambda result: \
+                         stream_results.__setitem__(job.outfile, result),
+                     error_callback=failed)
+
+# Wait for the parsing of job output to finish
+def finish_parse_pool(pool):
+    """ Waits for all output queued in the passed pool to be parsed (see
+        parse_job_output), then shuts the pool down. The wait is recorded as
+        its own stage of the run report, as the time by which parsing
+        lagged behind the last job.
+
+        - pool is a pool returned by start_parse_pool, or None
+    """
+    if pool is None:
+        return
+    with timed_stage('wait_for_parsing'):
+        pool.close()
+        pool.join()
+
+# Stop parsing job output after an error
+def stop_parse_pool(pool):
+    """ Shuts down the passed pool without waiting for queued output to be
+        parsed, for when the run stops early (see finish_parse_pool).
+
+        - pool is a pool returned by start_parse_pool, or None
+    """
+    if pool is None:
+        return
+    pool.terminate()
+    pool.join()
 
-        Note that we report a correlation by this method, rather than a
-        percentage identity.
+# Add a thread count option to a job's command line
+def add_threads_arg(cmdline, threads_arg, threads):
+    """ Returns the passed command line with the thread count option
+        inserted straight after the program name, or unchanged if threads is
+        1 or the program takes no thread count option.
 
-        - tetra_z is a dictionary of tetranucleotide Z-scores, for each
-              input sequence
+        - cmdline is the job's command line
+
+        - threads_arg is the program's thread count option format string,
+              or None
+
+        - threads is the number of threads the job may use
     """
-    corrs = {}
-    orgs = sorted(tetra_z.keys())
-    for idx, o1 in enumerate(orgs[:-1]):
-        for o2 in orgs[idx+1:]:
-            assert sorted(tetra_z[o1].keys()) == sorted(tetra_z[o2].keys())
-            tets = sorted(tetra_z[o1].keys())
-            z1 = [tetra_z[o1][t] for t in tets]
-            z2 = [tetra_z[o2][t] for t in tets]
-            z1_mean = sum(z1) / len(z1)
-            z2_mean = sum(z2) / len(z2)
-            z1diffs = [z - z1_mean for z in z1]
-            z2diffs = [z - z2_mean for z in z2]
-            diffprods = sum([z1diffs[i] * z2diffs[i] for i in \
-                                 range(len(z1diffs))])
-            z1diffs2 = sum([z * z for z in z1diffs])
-            z2diffs2 = sum([z * z for z in z2diffs])
-            corrs[(o1, o2)] = diffprods/math.sqrt(z1diffs2 * z2diffs2)
-    return corrs
+    if threads_arg is None or threads <= 1:
+        return cmdline
+    prog, args = cmdline.split(' ', 1)
+    return "%s %s %s" % (prog, threads_arg % threads, args)
 
-# Calculate tetranucleotide values for each input sequence
-def calc_org_tetra(infiles):
-    """ We calculate the mono-, di-, tri- and tetranucleotide frequencies
-        for each sequence, on each strand, and follow Teeling et al. (2004)
-        in calculating a corresponding Z-score for each observed
-        tetranucleotide frequency, dependent on the mono-, di- and tri-
-        nucleotide frequencies for that input sequence.
+# Run a set of external jobs through the shared-filesystem queue
+def run_queued_jobs(jobs):
+    """ Writes a descriptor for each of the passed Jobs to the queue
+        directory options.queue, waits for worker processes (see run_worker)
+        to run them, and exits with an error if any job fails, as run_jobs
+        does.
+
+        The queue directory holds pending/, running/ and done/
+        subdirectories. Each descriptor is a JSON file in pending/, named
+        with the zero-padded job size first so that workers take the largest
+        jobs first, and holding the command line, thread count option,
+        working directory and time limit. A worker claims a job by renaming
+        its descriptor into running/, which succeeds for only one worker,
+        and writes the job's exit status and stderr output to done/.
+
+        A failed job is put back in pending/ up to options.retries times. A
+        job whose running/ descriptor has not been touched by its worker
+        for QUEUE_STALE seconds is assumed lost, and put back in pending/.
+        If that worker reports back after all, its result is used: the
+        requeued copy is taken back from pending/ or, if another worker has
+        claimed it, that copy's result is discarded when it arrives (see
+        discard_queued_copy).
+
+        Command lines are run from the coordinator's working directory, so
+        the queue, input and output directories must be on storage mounted
+        at the same path on every node. Jobs with output consumers
+        (--blast_stream) cannot be queued. Job output is parsed as each job
+        completes, as in run_jobs.
+
+        - jobs is an iterable of Jobs
     """
-    org_tetraz = {}
-    for fn in infiles:
-        org = os.path.splitext(os.path.split(fn)[-1])[0]
-        logger.info("Calculating tetranucleotide frequencies for %s" % fn)
-        # For the Teeling et al. method, the Z-scores require us to count
-        # mono, di, tri and tetranucleotide sequences
-        monocnt, dicnt, tricnt, tetracnt = (collections.defaultdict(int),
-                                            collections.defaultdict(int),
-                                            collections.defaultdict(int),
-                                            collections.defaultdict(int))
-        for rec in SeqIO.parse(fn, 'fasta'):
-            for s in [str(rec.seq).upper(),
-                      str(rec.seq.reverse_complement()).upper()]:
-                # Since the Teeling et al. algorithm requires us to consider
-                # both strand orientations, monocounts are easy
-                monocnt['G'] += s.count('G')
-                monocnt['C'] += s.count('C')
-                monocnt['T'] += s.count('T')
-                monocnt['A'] += s.count('A')
-                # For di, tri and tetranucleotide counts, we loop over the
-                # sequence and its reverse complement, until we're near the end:
-                for i in range(len(s[:-4])):
-                    di, tri, tetra = s[i:i+2], s[i:i+3], s[i:i+4]
-                    dicnt[str(di)] += 1
-                    tricnt[str(tri)] += 1
-                    tetracnt[str(tetra)] += 1
-                # We clean up the straggling bit at the end:
-                tricnt[str(s[-4:-1])] += 1
-                tricnt[str(s[-3:])] += 1
-                dicnt[str(s[-4:-2])] += 1
-                dicnt[str(s[-3:-1])] += 1
-                dicnt[str(s[-2:])] += 1
-        logger.info("%d mono, %d di, %d tri, %d tetranucleotides found" %\
-                        (len(monocnt), len(dicnt), len(tricnt), len(tetracnt)))
-        # Following Teeling (2004), we calculate expected frequencies for each
-        # tetranucleotide; we ignore ambiguity symbols
-        tetra_exp = {}
-        for t in [tet for tet in tetracnt if tet_clean(tet)]:
-            tetra_exp[t] = 1.*tricnt[t[:3]]*tricnt[t[1:]]/dicnt[t[1:3]]
-        logger.info("%d non-ambiguous tetranucleotides" % len(tetra_exp))
-        # Following Teeling (2004) we approximate the std dev of each
-        # tetranucleotide
-        tetra_sd = {}
-        for t, exp in tetra_exp.items():
-            den = dicnt[t[1:3]]
-            tetra_sd[t] = math.sqrt(exp * (den - tricnt[t[:3]]) * \
-                                        (den - tricnt[t[1:]]) / (den * den))
-        # Following Teeling (2004) we calculate the Z-score for each
-        # tetranucleotide
-        tetra_z = {}
-        for t, exp in tetra_exp.items():
+    dirs = dict((name, os.path.join(options.queue, name)) \
+                    for name in ('pending', 'running', 'done'))
+    for dirname in dirs.values():
+        os.makedirs(dirname, exist_ok=True)
+    prefix = "%s_%d_%d" % (socket.gethostname(), os.getpid(),
+                           int(time.time()))
+    outstanding, attempts, failures = {}, collections.Counter(), []
+    for idx, job in enumerate(jobs):
+        if job.consumer is not None:
+            logger.error("Jobs with output consumers cannot be queued " +\
+                             "(exiting)")
+            sys.exit(1)
+        name = "%015d_%s_%06d.json" % (job.size, prefix, idx)
+        outstanding[name] = job
+    logger.info("Queueing %d jobs in %s" % (len(outstanding), options.queue))
+    pool = start_parse_pool(outstanding.values())
+    try:
+        for name, job in outstanding.items():
+            write_queue_file(os.path.join(dirs['pending'], name),
+                             {'cmdline': job.cmdline,
+                              'threads_arg': job.threads_arg,
+                              'cwd': os.getcwd(),
+                              'timeout': options.timeout})
+            attempts[job] += 1
+        # Jobs put back in pending/ as stale, whose first worker may yet
+        # report; and completed jobs of which such a copy may still be run
+        requeued, abandoned = set(), {}
+        while outstanding:
+            time.sleep(QUEUE_POLL)
+            for name, job in list(abandoned.items()):
+                if os.path.exists(os.path.join(dirs['done'], name)):
+                    discard_queued_copy(dirs, name, job)
+            for name, job in list(outstanding.items()):
+                donefile = os.path.join(dirs['done'], name)
+                runfile = os.path.join(dirs['running'], name)
+                pendfile = os.path.join(dirs['pending'], name)
+                if os.path.exists(donefile):
+                    with open(donefile) as fh:
+                        result = json.load(fh)
+                    os.remove(donefile)
+                    status = result['status']
+                    if status == 0:
+                        status = finish_output(job.outfile) or 0
+                    usage = dict(result['usage'])
+                    record_job(job, result['threads'], attempts[job], status,
+                               usage.pop('wall'), usage, result['worker'])
+                    if status != 0 and attempts[job] <= options.retries:
+                        logger.warning("Job failed on %s (%s), " % \
+                                           (result['worker'], status) +\
+                                           "retrying: " + job.cmdline)
+                        attempts[job] += 1
+                        # A requeued copy is already the retry
+                        if name in requeued:
+                            requeued.discard(name)
+                        else:
+                            os.rename(runfile, pendfile)
+                        continue
+                    del outstanding[name]
+                    if name in requeued:
+                        # Take back the requeued copy, or, if another
+                        # worker has claimed it, discard its result later
+                        requeued.discard(name)
+                        abandoned[name] = job
+                        try:
+                            os.remove(pendfile)
+                        except OSError:
+                            pass
+                    else:
+                        try:
+                            os.remove(runfile)
+                        except OSError:
+                            pass
+                    if status == 0:
+                        logger.info("Job completed on %s: %s" % \
+                                        (result['worker'], job.cmdline))
+                        parse_job_output(pool, job)
+                    else:
+                        failures.append((job, status, result['stderr']))
+                    continue
+                try:
+                    age = time.time() - os.path.getmtime(runfile)
+                except OSError:
+                    continue
+                if age > QUEUE_STALE:
+                    # The worker may have finished just now
+                    if os.path.exists(donefile):
+                        continue
+                    logger.warning("No word from worker for %ds, " % age +\
+                                       "requeueing: " + job.cmdline)
+                    try:
+                        os.rename(runfile, pendfile)
+                    except OSError:
+                        pass
+                    else:
+                        requeued.add(name)
+        # Copies still running are left to finish, unwatched
+        for name, job in abandoned.items():
             try:
-                tetra_z[t] = (tetracnt[t] - exp)/tetra_sd[t]
-            except ZeroDivisionError:
-                # We hit a zero in the estimation of variance
-                zeroes = [k for k,v in tetra_sd.items() if v == 0]
-                logger.warning("Zero variance for tetranucleotides %s" %\
-                                   zeroes)
-                tetra_z[t] = 1 / (dicnt[t[1:3]] * dicnt[t[1:3]])
-        #print len(tetra_z), sorted(tetra_z.items())
-        #for tet in sorted(tetra_exp.keys()):
-        #    print tet, tetracnt[tet], tetra_exp[tet], tetra_sd[tet], \
-        #        tetra_z[tet]
-        org_tetraz[org] = tetra_z
-    return org_tetraz
+                os.remove(os.path.join(dirs['running'], name))
+            except OSError:
+                pass
+        if failures:
+            write_failed_jobs('failed_jobs.tab', failures, attempts)
+            logger.error("%d jobs failed (exiting)" % len(failures))
+            sys.exit(1)
+    except BaseException:
+        # Do not leave the parsing processes behind on an error
+        stop_parse_pool(pool)
+        raise
+    logger.info("All queued jobs completed")
+    finish_parse_pool(pool)
 
-# Returns true if the passed string contains only A, C, G or T
-def tet_clean(s):
-    """ Checks that a passed string contains only unambiguous IUPAC nucleotide
-        symbols. We are assuming that a low frequency of IUPAC ambiguity symbols
-        doesn't affect our calculation.
-    """
-    if not len(set(s) - set('ACGT')):
-        return True
-    return False
+# Clear up after a superfluous copy of a completed queued job
+def discard_queued_copy(dirs, name, job):
+    """ Removes the done/ and running/ descriptors of a copy of a queued job
+        that was run again after being assumed lost (see run_queued_jobs),
+        but whose first run has since completed, with any output the copy
+        left under its temporary name (see make_partial_filename).
 
+        - dirs is a dictionary of the pending, running and done queue
+              subdirectories
 
-# Divide the input FASTA sequences into fragments, and place multiple sequence
-# FASTA files into the output directory
-def fragment_input_files(infiles):
-    """ Takes every sequence from every FASTA file in the input directory,
-        splits them into consecutive fragments of length options.fragsize,
-        (with any trailing sequences being included, even if shorter), and
-        writes the resulting set of sequences to a file with the same name
-        in the output directory. All fragments are named consecutively and
-        uniquely as fragNNNNN.
+        - name is the job's descriptor name
+
+        - job is the Job
     """
-    logger.info("Fragmenting input FASTA files")
-    for fn in infiles:
-        logger.info("Processing %s" % fn)
-        ostem = os.path.splitext(os.path.split(fn)[-1])[0]
-        ofn = os.path.join(options.outdirname, ostem) + '.fasta'
-        logger.info("Writing fragments to %s" % ofn)
-        outseqs = []
-        i, count = 0, 0
-        for s in SeqIO.parse(fn, 'fasta'):
-            while i < len(s):
-                count += 1
-                newseq = s[i:i+options.fragsize]
-                newseq.id = "frag%05d" % count
-                outseqs.append(newseq)
-                i += options.fragsize
-        SeqIO.write(outseqs, ofn, 'fasta')
+    filenames = [os.path.join(dirs['done'], name),
+                 os.path.join(dirs['running'], name)]
+    if job.outfile is not None:
+        filenames.append(make_partial_filename(job.outfile))
+    for filename in filenames:
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+    logger.info("Discarded a repeated run of completed job: %s" % \
+                    job.cmdline)
 
-# Make BLAST databases for each of the fragmented input files
-def make_blast_dbs(infiles):
-    """ Use local makeblastdb to build BLAST a nucleotide database for each
-        input sequence.
+# Write a queue file so that it appears complete, or not at all
+def write_queue_file(filename, data):
+    """ Writes the passed data as JSON to a hidden temporary file in the
+        same directory, then renames it into place, so that readers never
+        see a partly written file.
 
-        For ANIb, the input sequence has been split into consecutive fragments.
+        - filename is the location of the queue file
+
+        - data is a JSON-serialisable object
     """
-    logger.info("Making BLAST databases for fragment files")
-    cmdlines = []
-    for fn in infiles:
-        cmdlines.append(make_makeblastdb_cmd(fn))
-    logger.info("BLAST makeblastdb command lines:\n\t%s" % \
-                    '\n\t'.join(cmdlines))
-    multiprocessing_run(cmdlines)
+    dirname, basename = os.path.split(filename)
+    tmpname = os.path.join(dirname, ".%s.%s.%d" % (basename,
+                                                   socket.gethostname(),
+                                                   os.getpid()))
+    with open(tmpname, 'w') as fh:
+        json.dump(data, fh)
+    os.rename(tmpname, filename)
 
+# Claim the largest pending job in the shared-filesystem queue
+def claim_queued_job(queue):
+    """ Returns the name of a job descriptor that this process has moved
+        from the queue's pending/ to its running/ directory, or None if
+        there are no pending jobs. Largest jobs are claimed first. When
+        several workers try to claim the same job, the rename succeeds for
+        only one of them, and the others try the next job.
 
-# Get the list of FASTA files from the input directory
-def get_fasta_files():
-    """ Return a list of FASTA files in the input directory
+        - queue is the queue directory
     """
-    infiles = get_input_files(options.indirname,# '.fna')
-                              '.fasta', '.fas', '.fa', '.fna')
-    logger.info("Input files:\n\t%s" % '\n\t'.join(infiles))
-    return infiles
+    pending = os.path.join(queue, 'pending')
+    for name in sorted([fn for fn in os.listdir(pending) \
+                            if fn.endswith('.json') and \
+                            not fn.startswith('.')], reverse=True):
+        runfile = os.path.join(queue, 'running', name)
+        try:
+            os.rename(os.path.join(pending, name), runfile)
+            # Renaming keeps the time the job was queued; the coordinator
+            # needs the time it was claimed (see run_queued_jobs)
+            os.utime(runfile)
+        except OSError:
+            continue
+        return name
+    return None
 
-# Get lengths of sequence for each organism
-def get_org_lengths(infiles):
-    """ Returns a dictionary of total input sequence lengths, keyed by
-        organism.
+# Run jobs from the shared-filesystem queue until told to stop
+def run_worker(queue):
+    """ Claims and runs jobs from the queue directory written by
+        run_queued_jobs, one at a time, until a file named STOP appears in
+        the queue directory or, if options.worker_idle is set, no job has
+        been found for that many seconds. Any number of workers, on any
+        number of machines sharing the queue directory, may run at once.
 
-        Biopython's SeqIO module is used to parse all sequences in the FASTA
-        file corresponding to each organism, and the total base count in each
-        is obtained.
+        A job that takes a thread count option is given options.threads
+        threads. While a job runs, its running/ descriptor is touched every
+        QUEUE_HEARTBEAT seconds to show that the worker is alive. A job
+        running for longer than its time limit is killed. The exit status
+        (or 'timeout after Ns') and stderr output are written to done/ for
+        the coordinator.
 
-        NOTE: ambiguity symbols are not discounted.
+        - queue is the queue directory
     """
-    logger.info("Processing input organism sequence lengths")
-    tot_lengths = {}
-    for fn in infiles:
-        tot_lengths[os.path.splitext(os.path.split(fn)[-1])[0]] = \
-            sum([len(s) for s in SeqIO.parse(fn, 'fasta')])
-    return tot_lengths
+    for dirname in ('pending', 'running', 'done'):
+        os.makedirs(os.path.join(queue, dirname), exist_ok=True)
+    worker = "%s:%d" % (socket.gethostname(), os.getpid())
+    logger.info("Worker %s watching %s" % (worker, queue))
+    idle_since = time.time()
+    while not os.path.exists(os.path.join(queue, 'STOP')):
+        name = claim_queued_job(queue)
+        if name is None:
+            if options.worker_idle is not None and \
+                    time.time() - idle_since > options.worker_idle:
+                logger.info("No jobs for %ds, stopping" % \
+                                options.worker_idle)
+                break
+            time.sleep(QUEUE_POLL)
+            continue
+        runfile = os.path.join(queue, 'running', name)
+        try:
+            with open(runfile) as fh:
+                desc = json.load(fh)
+        except OSError:
+            # Requeued by the coordinator before we could read it
+            continue
+        cmdline = add_threads_arg(desc['cmdline'], desc['threads_arg'],
+                                  options.threads)
+        logger.info("Running: %s" % cmdline)
+        errfh = tempfile.TemporaryFile()
+        proc = subprocess.Popen(cmdline, shell=sys.platform != "win32",
+                                cwd=desc['cwd'], stdout=subprocess.DEVNULL,
+                                stderr=errfh, start_new_session=True)
+        started = beat = time.time()
+        finished = None
+        while finished is None:
+            time.sleep(0.05)
+            finished = poll_job(proc)
+            if finished is None and desc['timeout'] is not None and \
+                    time.time() - started > desc['timeout']:
+                finished = ('timeout after %ds' % desc['timeout'],
+                            kill_job(proc))
+            if time.time() - beat > QUEUE_HEARTBEAT:
+                try:
+                    os.utime(runfile)
+                except OSError:
+                    pass
+                beat = time.time()
+        status, usage = finished
+        usage['wall'] = time.time() - started
+        errfh.seek(0)
+        write_queue_file(os.path.join(queue, 'done', name),
+                         {'status': status, 'worker': worker,
+                          'threads': max(1, options.threads) \
+                              if desc['threads_arg'] else 1,
+                          'usage': usage,
+                          'stderr': errfh.read().decode(errors='replace')})
+        errfh.close()
+        logger.info("Finished (%s): %s" % (status, cmdline))
+        idle_since = time.time()
+
+# Start a thread that passes a job's output stream to its consumer
+def start_consumer(consumer, stream):
+    """ Starts and returns a thread calling consumer(stream). Any exception
+        raised by the consumer is kept in the thread's error attribute
+        (None if there was none), and the rest of the stream is discarded so
+        that the job is not blocked writing to it.
 
-# Write a table of values to file, organised as a square matrix with row/col
-# headers, in tab-separated format
-def write_table(filename, org_names, values, comment=''):
-    """ Writes a tab-separated plain text square matrix file, with row and
-        column headers, describing the passed data.
+        - consumer is a function taking an open text stream
 
-        - filename is the full path for the output file
+        - stream is the job's standard output
+    """
+    def target():
+        try:
+            consumer(stream)
+        except Exception:
+            reader.error = sys.exc_info()[1]
+            logger.error(last_exception())
+            for line in stream:
+                pass
+    reader = threading.Thread(target=target)
+    reader.error = None
+    reader.daemon = True
+    reader.start()
+    return reader
 
-        - org_names describes the row and column headers, as a list of strings
+# Kill a running job and all of its child processes
+def kill_job(proc):
+    """ Kills the process group of the passed job, which was started in its
+        own session, so that aligners started through a shell (and their
+        own subprocesses) are killed too.
 
-        - values describes the values in each cell, as a dictionary keyed by
-             (row, col) tuple, with identifiers from org_names
+        Returns the job's resource use, as for poll_job.
 
-        - comment is an optional comment string for the output file
+        - proc is the subprocess.Popen object for the job
     """
-    # Open file and write file header
-    fname = os.path.join(options.outdirname, filename)
     try:
-        logger.info("Opening %s for writing" % fname)
-        fh = open(fname, 'w')
-        print( "# calculate_ani.py %s" % time.asctime(), file=fh)
-        if len(comment):
-            print( "# %s" % comment, file=fh)
-    except:
-        logger.error("Could not open file %s for output (exiting)" % fname)
-        logger.error(last_exception())
-        sys.exit(1)
-    names = sorted(list(set(org_names))) # Set name order
-    matrix = []
-    print( '\t'.join([''] + names),file=fh)
-    for n1 in names:
-        outrow = [n1]
-        matrix_row = []
-        for n2 in names:
-            if n1 == n2:
-                outrow.append('NA')
-                matrix_row.append(0.0)
-                continue
-            try:
-                val = values[(n1, n2)]
-            except KeyError: # This error is not thrown for a square matrix
-                val = values[(n2, n1)]
-
-            matrix_row.append(val)
-            outrow.append(str(val))
-        print( '\t'.join(outrow), file=fh)
-        matrix.append(matrix_row)
-    logger.info("Wrote data to %s" % fname)
-    return np.array(matrix), names
+        os.killpg(proc.pid, 9)
+    except OSError:
+        pass
+    pid, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return rusage_dict(rusage)
 
-# Parse NUCmer delta output to store alignment total length, sim_error,
-# and percentage identity, for each pairwise comparison
-def process_delta(org_lengths):
-    """ Returns a tuple containing a list and four dictionaries. The list
-        describes the names of all organisms (derived from their filenames).
-        The dictionaries describe results for pairwise comparisons: total
-        aligned lengths; similarity errors in those alignments; the percentage
-        of aligned length that matches (ANIm); and the percentage of the
-        pairwise comparison that is aligned.
-
-        For the total aligned length, similarity error, and ANIm dictionaries,
-        as these are triangular/symmetrical matrices we only key them by
-        (query, subject), but as the percentage aligned measure depends on the
-        sequence we calculate it against, we report (query, subject) and
-        (subject, query) values.
+# Check whether a job has finished, collecting its resource use
+def poll_job(proc):
+    """ Returns None if the passed job is still running; otherwise reaps it
+        with os.wait4 and returns a tuple of (exit status, usage), where
+        usage is a dictionary of the job's CPU time and peak memory use (see
+        rusage_dict). This takes the place of Popen.poll, which discards
+        the resource use.
 
-        - org_lengths is a dictionary of total sequence lengths for each
-              input sequence
+        - proc is the subprocess.Popen object for the job
     """
-    infiles = get_input_files(options.outdirname, '.delta')
-    logger.info("Delta files:\n\t%s" % '\n\t'.join(infiles))
-    logger.info("Processing .delta files")
-    # We store pairwise comparison lengths in dictionaries, keyed by organism
-    # ID pair tuples:
-    # perc_aln is useful, as it is a matrix of the minimum percentage of an
-    # organism's genome involved in a pairwise alignment
-    lengths, sim_errors, perc_ids, perc_aln = {}, {}, {}, {}
-    for dname in infiles:
-        logger.info("Processing %s" % dname)
-        qname, sname = \
-            os.path.splitext(os.path.split(dname)[-1])[0].split('_vs_')
-        logger.info("Query organism: %s; Subject organism: %s" % \
-                        (qname, sname))
-        tot_length, tot_sim_error = parse_delta(dname)
-        try:
-            perc_id = 1 - 1. * tot_sim_error/tot_length
-        except ZeroDivisionError:
-            perc_id = 0.0
-        lengths[(qname, sname)] = tot_length
-        sim_errors[(qname, sname)] = tot_sim_error
-        perc_ids[(qname, sname)] = perc_id
-        perc_aln[(qname, sname)] = 1.*tot_length/org_lengths[qname]
-        perc_aln[(sname, qname)] = 1.*tot_length/org_lengths[sname]
-    return lengths, sim_errors, perc_ids, perc_aln
+    pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+    if pid == 0:
+        return None
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return proc.returncode, rusage_dict(rusage)
 
-# Parse BLAST tabular output and store total alignment length, similarity
-# counts and percentage identity for each pairwise comparison
-def process_blast(org_lengths):
-    """ Read in the BLASTN comparison output files, and calculate alignment
-        lengths, similarity errors, and percentage identity and alignment
-        coverage for each input sequence comparison.
+# Convert a resource usage record to a dictionary
+def rusage_dict(rusage):
+    """ Returns a dictionary of the user and system CPU time in seconds,
+        and peak resident set size in kilobytes, from the passed
+        resource.struct_rusage. For a job run through a shell, this covers
+        the shell and the programs it ran.
 
-        - org_lengths is a dictionary of total sequence lengths for each
-              input sequence.
+        - rusage is a resource.struct_rusage
     """
-    infiles = get_input_files(options.outdirname, '.blast_tab')
-    logger.info("BLAST files:\n\t%s" % '\n\t'.join(infiles))
-    logger.info("Processing .blast_tab files")
-    lengths, sim_errors, perc_ids, perc_aln = {}, {}, {}, {}
-    org_names = set()
-    for tname in infiles:
-        logger.info("Processing %s" % tname)
-        qname, sname = \
-            os.path.splitext(os.path.split(tname)[-1])[0].split('_vs_')
-        org_names.add(qname)
-        org_names.add(sname)
-        logger.info("Query organism: %s; Subject organism: %s" % \
-                        (qname, sname))
-        tot_length, tot_sim_error = parse_blast(tname)
-        if tot_length:
-            perc_id = 1 - 1. * tot_sim_error/tot_length
-        else:
-            perc_id = 0
-        lengths[(qname, sname)] = tot_length
-        sim_errors[(qname, sname)] = tot_sim_error
-        perc_ids[(qname, sname)] = perc_id
-        perc_aln[(qname, sname)] = 1.*tot_length/org_lengths[qname]
-        perc_aln[(sname, qname)] = 1.*tot_length/org_lengths[sname]
-    return lengths, sim_errors, perc_ids, perc_aln
+    return {'user': rusage.ru_utime, 'sys': rusage.ru_stime,
+            'maxrss': rusage.ru_maxrss}
 
+# Record the resource use of an external job attempt for the run report
+def record_job(job, threads, attempt, status, wall, usage, worker=None):
+    """ Adds a record of one attempt at running the passed Job to the run
+        report, and logs its resource use.
 
-# Parse NUCmer delta file to get total alignment length and total sim_errors
-def parse_delta(filename):
-    """ Reads a NUCmer output .delta file, extracting the aligned length and
-        number of similarity errors for each aligned uniquely-matched region,
-        and returns the cumulative total for each as a tuple.
+        - job is the Job
 
-        - filename is the path to the input .delta file
-    """
-    aln_length, sim_errors = 0, 0
-    for line in [l.strip().split() for l in open(filename, 'rU').readlines()]:
-        if line[0] == 'NUCMER' or line[0].startswith('>'): # Skip headers
-            continue
-        # We only want lines with seven columns:
-        if len(line) == 7:
-            aln_length += abs(int(line[1]) - int(line[0]))
-            sim_errors += int(line[4])
-    return aln_length, sim_errors
+        - threads is the number of threads the job was given
 
-# Parse custom BLASTN output to get total alignment length and mismatches
-def parse_blast(filename):
-    """ Calculate the alignment length and total number of similarity errors
-        for the passed BLASTN alignment file generated by comparing fragmented
-        input sequences.
+        - attempt is the number of this attempt, from 1
 
-        - filename is the location of the BLASTN output for a pairwise
-              comparison between input sequences
-    """
-    aln_length, sim_errors = 0, 0,
-    qname, sname = \
-        os.path.splitext(os.path.split(filename)[-1])[0].split('_vs_')
-    qalnlen, qnumid, qlen, qerr = (collections.defaultdict(float),
-                                   collections.defaultdict(float),
-                                   collections.defaultdict(float),
-                                   collections.defaultdict(float))
-    for line in [l.strip().split() for l in open(filename, 'rU').readlines() \
-                     if len(l) and not l.startswith('#')]:
-        # We need to collate matches by query ID, to determine whether the
-        # match has > 30% identity and > 70% coverage.
-        # Following Goris et al (2007) we only use matches that contribute to
-        # a total match identity of at least 30% and a total match coverage
-        # of at least 70% of either query or reference length
-        qid = line[0]
-        qalnlen[qid] += int(line[2])
-        qnumid[qid] += int(line[5])
-        qlen[qid] = int(line[6])
-        qerr[qid] += int(line[3])
-    for qid, ql in qlen.items():
-        if qalnlen[qid]/ql > 0.7 and qnumid[qid]/ql > 0.3:
-            aln_length += int(qalnlen[qid])
-            sim_errors += int(qerr[qid])
-    return aln_length, sim_errors
+        - status is the exit status, or a description of the failure
 
+        - wall is the elapsed time in seconds
 
-# Run BLASTN pairwise on input files, using multiprocessing
-def pairwise_blast(filenames, prog='blastn'):
-    """ Run BLASTN for each pairwise comparison of fragmented input sequences,
-        using multiprocessing to take advantage of multiple cores where
-        possible, and writing results to the nominated output directory.
+        - usage is a dictionary of CPU time and peak memory, as returned by
+              rusage_dict
 
-        - filenames is an iterable of locations of input FASTA files, from
-              which BLASTN command lines are constructed.
+        - worker identifies the --worker process that ran the job, if any
+    """
+    logger.info("Job used %.1fs wall, %.1fs user, %.1fs sys, %d kB: %s" % \
+                    (wall, usage['user'], usage['sys'], usage['maxrss'],
+                     job.cmdline))
+    run_report['jobs'].append(collections.OrderedDict([
+        ('cmdline', job.cmdline), ('size', job.size), ('threads', threads),
+        ('attempt', attempt), ('status', status), ('worker', worker),
+        ('wall', wall), ('user', usage['user']), ('sys', usage['sys']),
+        ('maxrss_kb', usage['maxrss'])]))
 
-        We loop over all FASTA files in the input directory, generating
-        BLASTN command line for each pairwise comparison, and then pass those
-        command lines to be run using multiprocessing.
+# Write the run report to the output directory
+def write_run_report():
+    """ Writes run_report.json to the output directory, describing the
+        command line, total elapsed time, CPU time and peak memory of this
+        process and of its external jobs, the time spent in each timed
+        stage (see timed_stage), and the resource use of each external job
+        attempt (see record_job). The job records are also written as a
+        table to run_jobs.csv.
+
+        This is registered to run at exit, so a report is written for
+        failed runs too.
     """
-    logger.info("Running pairwise BLAST to generate *.blast_tab")
-    cmdlines = []
-    for idx, f1 in enumerate(filenames[:-1]):
-        cmdlines.extend([make_blast_cmd(f1, f2, prog=prog) \
-                            for f2 in filenames[idx+1:]])
-    logger.info("BLASTN command lines:\n\t%s" % '\n\t'.join(cmdlines))
-    if not options.skip_blast:
-        multiprocessing_run(cmdlines)
-    else:
-        logger.warning("BLASTN run skipped!")
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    report = collections.OrderedDict([
+        ('argv', sys.argv),
+        ('started', time.asctime(time.localtime(run_report['started']))),
+        ('wall', time.time() - run_report['started']),
+        ('process', rusage_dict(own)),
+        ('children', rusage_dict(children)),
+        ('stages', run_report['stages']),
+        ('jobs', run_report['jobs'])])
+    fname = os.path.join(options.outdirname, 'run_report.json')
+    with open(fname, 'w') as fh:
+        json.dump(report, fh, indent=1)
+    fname = os.path.join(options.outdirname, 'run_jobs.csv')
+    with open(fname, 'w', newline='') as fh:
+        writer = csv.writer(fh)
+        writer.writerow(['cmdline', 'size', 'threads', 'attempt', 'status',
+                         'worker', 'wall', 'user', 'sys', 'maxrss_kb'])
+        for record in run_report['jobs']:
+            writer.writerow(list(record.values()))
+    logger.info("Wrote run report to %s" % fname)
 
-# Run NUCmer pairwise on the input files, using multiprocessing
-def pairwise_nucmer(filenames, prog='nucmer'):
-    """ Run NUCmer to generate pairwise alignment data for each of the
-        input FASTA files.
+# Record failed jobs in the output directory
+def write_failed_jobs(filename, failures, attempts):
+    """ Writes a tab-separated table of the failed jobs, with the final exit
+        status, number of attempts, last line of stderr output, and command
+        line for each, and logs each failure.
 
-        - filenames is a list of input FASTA filenames, from which NUCmer
-              command lines are constructed
+        - filename is the name of the output file in the output directory
 
-        We loop over all FASTA files in the input directory, generating NUCmer
-        command lines for each pairwise comparison, and then pass those
-        command lines to be run using multiprocessing.
+        - failures is a list of (Job, status, stderr) tuples
+
+        - attempts is a dictionary of the number of attempts for each Job
     """
-    logger.info("Running pairwise mumer comparison to generate *.delta")
-    cmdlines = []
-    for idx, f1 in enumerate(filenames[:-1]):
-        cmdlines.extend([make_nucmer_cmd(f1, f2, prog=prog) \
-                            for f2 in filenames[idx+1:]])
-    logger.info("mummer command lines:\n\t%s" % '\n\t'.join(cmdlines))
-    if not options.skip_nucmer:
-        multiprocessing_run(cmdlines)
-    else:
-        logger.warning("mummer run skipped!")
+    fname = os.path.join(options.outdirname, filename)
+    with open(fname, 'w') as fh:
+        print( "# calculate_ani.py %s" % time.asctime(), file=fh)
+        print( '\t'.join(['status', 'attempts', 'stderr', 'cmdline']),
+               file=fh)
+        for job, status, stderr in failures:
+            lines = stderr.strip().splitlines()
+            lastline = lines[-1] if lines else ''
+            logger.error("Job failed (%s) after %d attempts: %s\n%s" % \
+                             (status, attempts[job], job.cmdline, stderr))
+            print( '\t'.join([str(status), str(attempts[job]), lastline,
+                              job.cmdline]), file=fh)
+    logger.info("Wrote failed jobs to %s" % fname)
 
 
-# Run a set of command lines using multiprocessing
-def multiprocessing_run(cmdlines):
-    """ Distributes the passed command-line jobs using multiprocessing.
+# Construct the output file prefix for a pairwise comparison
+def make_output_prefix(f1, f2):
+    """ Returns the path, without extension, of the aligner output for the
+        comparison of the two passed input files, in the output directory.
 
-        - cmdlines is an iterable of command line strings
+        - f1, f2 are the locations of two input FASTA files for analysis
     """
-    logger.info("Running %d jobs with multiprocessing" % len(cmdlines))
-    pool = multiprocessing.Pool()
-    completed = []
-    if options.verbose:
-        callback_fn = logger_callback
-    else:
-        callback_fn = completed.append
-    pool_outputs = [pool.apply_async(subprocess.call,
-                                     (str(cline), ),
-                                     {'stderr': subprocess.PIPE,
-                                      'shell': sys.platform != "win32"},
-                                     callback = callback_fn) \
-                        for cline in cmdlines]
-    pool.close()        # Run jobs
-    pool.join()         # Collect output
-    logger.info("Multiprocessing jobs completed:\n%s" % completed)
+    return os.path.join(options.outdirname, "%s_vs_%s" % \
+                            (os.path.splitext(os.path.split(f1)[-1])[0],
+                             os.path.splitext(os.path.split(f2)[-1])[0]))
+
+# Get the temporary name under which a job writes its output file
+def make_partial_filename(outfile):
+    """ Returns the name under which an aligner writes the passed output
+        file until its job completes, when it is renamed (see
+        finish_output), so that an interrupted job never leaves a file
+        that looks complete. The extension is kept, e.g. A_vs_B.delta is
+        written as A_vs_B.partial.delta.
+
+        - outfile is the location of the output file
+    """
+    stem, ext = os.path.splitext(outfile)
+    return stem + '.partial' + ext
+
+# Move a completed output file into place, and record its completion
+def finish_output(outfile):
+    """ Renames the passed output file, written by a successful Job or
+        merge, from its temporary name to its final name, and then appends
+        the final name and size to the record of completed outputs in the
+        output directory (see COMPLETED_OUTPUTS). Returns None, or a
+        description of the problem if no output was written. If outfile is
+        None (a Job with no output file), nothing is done.
 
-# Multiprocessing callback to logger
-def logger_callback(val):
-    """ Basic callback for multiprocessing just to log status of each job
+        - outfile is the final location of the output file
+    """
+    if outfile is None:
+        return None
+    try:
+        os.replace(make_partial_filename(outfile), outfile)
+    except OSError:
+        return 'no output %s' % make_partial_filename(outfile)
+    fname = os.path.join(options.outdirname, COMPLETED_OUTPUTS)
+    with open(fname, 'a') as fh:
+        print('%s\t%d' % (os.path.basename(outfile),
+                          os.path.getsize(outfile)), file=fh)
+        fh.flush()
+        os.fsync(fh.fileno())
+    return None
 
-        - val is an integer returned by multiprocessing, describing the run
-             status
+# Read the record of completed outputs in the output directory
+def read_completed_outputs():
+    """ Returns a dictionary of the sizes of the completed aligner output
+        files recorded in the output directory (see finish_output),
+        keyed by file name. Lines that are incomplete, as the last line may
+        be if the run was interrupted, are ignored.
     """
-    logger.info("Multiprocessing run completed with status: %s" % val)
+    completed = {}
+    fname = os.path.join(options.outdirname, COMPLETED_OUTPUTS)
+    if not os.path.exists(fname):
+        return completed
+    with open(fname) as fh:
+        for line in fh:
+            fields = line.rstrip('\n').split('\t')
+            if line.endswith('\n') and len(fields) == 2 and \
+                    fields[1].isdigit():
+                completed[fields[0]] = int(fields[1])
+    return completed
+
+# Check that an aligner output file from an earlier run is complete
+def is_complete_output(outfile, completed):
+    """ Returns True if the passed aligner output file was recorded as
+        completed, still has its recorded size, and is intact: empty (a
+        BLASTN run with no hits) or ending in a newline and, for a .delta
+        file, starting with the two NUCmer header lines. An output file that
+        fails these checks is removed, so that it is run again.
 
+        - outfile is the location of the output file
+
+        - completed is a dictionary of completed output sizes, as returned
+              by read_completed_outputs
+    """
+    name = os.path.basename(outfile)
+    if name not in completed or not os.path.exists(outfile):
+        return False
+    size = os.path.getsize(outfile)
+    intact = size == completed[name]
+    if intact and size:
+        with open(outfile, 'rb') as fh:
+            head = [fh.readline() for idx in range(2)]
+            fh.seek(-1, os.SEEK_END)
+            intact = fh.read(1) == b'\n'
+    if intact and outfile.endswith('.delta'):
+        intact = size > 0 and len(head[0].split()) == 2 and \
+            head[1].strip() in (b'NUCMER', b'PROMER')
+    if not intact:
+        logger.warning("Output %s is incomplete or corrupt; rerunning" % \
+                           outfile)
+        os.remove(outfile)
+    return intact
 
 # Construct a command-line for NUCmer
 def make_nucmer_cmd(f1, f2, prog='nucmer'):
@@ -764,33 +4538,59 @@ def make_nucmer_cmd(f1, f2, prog='nucmer'):
         both the reference and the query. -mumreference gives us matches
         unique only in the reference and -maxmatch gives us matches to all
         regions, regardless of uniqueness. We may want to make this an option.
+
+        The .delta file is written under its temporary name (see
+        make_partial_filename).
     """
-    prefix = os.path.join(options.outdirname, "%s_vs_%s" % \
-                              (os.path.splitext(os.path.split(f1)[-1])[0],
-                               os.path.splitext(os.path.split(f2)[-1])[0]))
-    cmd = "%s -mum -p %s %s %s" % (prog, prefix, f1, f2)
+    prefix = os.path.splitext(make_partial_filename(
+        make_output_prefix(f1, f2) + '.delta'))[0]
+    cmd = "%s %s -p %s %s %s" % (prog, NUCMER_ARGS, prefix, f1, f2)
     return cmd
 
 # Construct a command-line for BLASTN
-def make_blast_cmd(f1, f2, prog='blastn'):
+def make_blast_cmd(f1, f2, prog='blastn', stream=False):
     """ Construct a BLASTN command line to conduct sequence comparison between
         two fragmented input sequences, for ANIb.
 
         - f1, f2 are the locations of two input FASTA files for analysis
+
+        - stream, if True, leaves BLASTN to write to standard output rather
+              than to a .blast_tab file, which is otherwise written under its
+              temporary name (see make_partial_filename)
     """
-    prefix = os.path.join(options.outdirname, "%s_vs_%s" % \
-                              (os.path.splitext(os.path.split(f1)[-1])[0],
-                               os.path.splitext(os.path.split(f2)[-1])[0]))
-    blastdb = os.path.splitext(f2)[0]
-    cmd = "%s -out %s.blast_tab -query %s -db %s " % \
-        (prog, prefix, f1, blastdb) + \
-        "-xdrop_gap_final 150 -penalty -1 -dust no " +\
-        "-max_target_seqs 1 -outfmt '6 qseqid sseqid length mismatch " +\
-        "pident nident qlen slen qstart qend sstart send positive " +\
-        "ppos gaps' " +\
-        "-gapopen 0 -gapextend 2"
+    prefix = make_output_prefix(f1, f2)
+    blastdb = os.path.join(options.outdirname,
+                           os.path.splitext(os.path.split(f2)[-1])[0])
+    out = "" if stream else \
+        "-out %s " % make_partial_filename(prefix + '.blast_tab')
+    cmd = "%s %s-query %s -db %s %s" % (prog, out, f1, blastdb, BLASTN_ARGS)
     return cmd
 
+# Construct a BLASTN command line against the combined database
+def make_blast_batch_cmd(filename, blastdb, prefix, ngenomes, prog='blastn',
+                         stream=False):
+    """ Construct a BLASTN command line comparing one fragmented input
+        sequence file against the combined database of all genomes, for
+        batch_blast. As for make_blast_cmd, but BLASTN may report up to
+        BATCH_TARGETS_PER_GENOME * ngenomes target sequences, shared
+        between all of the genomes (see parse_blast_batch).
+
+        - filename is the location of the fragmented input FASTA file
+
+        - blastdb is the combined database prefix
+
+        - prefix is the output file location, without extension
+
+        - ngenomes is the number of genomes in the database
+
+        - stream is as for make_blast_cmd
+    """
+    args = BLASTN_ARGS.replace("-max_target_seqs 1", "-max_target_seqs %d" %\
+                                   (BATCH_TARGETS_PER_GENOME * ngenomes))
+    out = "" if stream else \
+        "-out %s " % make_partial_filename(prefix + '.blast_tab')
+    return "%s %s-query %s -db %s %s" % (prog, out, filename, blastdb, args)
+
 # Construct a command line for BLAST makeblastdb
 def make_makeblastdb_cmd(filename, dbtype='nucl'):
     """ Construct a makeblastdb command line to make a BLAST nucleotide database
@@ -820,6 +4620,77 @@ def get_input_files(dir, *ext):
     return [os.path.join(dir, f) for f in filelist]
 
 
+# Open the persistent pairwise result store
+def open_result_store(filename):
+    """ Opens (creating if necessary) the SQLite database of pairwise
+        comparison results at the passed location, and returns the
+        connection.
+
+        Results are keyed by the sequence hashes of both organisms, the ANI
+        method, and the aligner parameters, so they can be reused between
+        runs and output directories.
+
+        - filename is the location of the SQLite database
+    """
+    logger.info("Opening pairwise result store %s" % filename)
+    conn = sqlite3.connect(filename)
+    conn.execute("CREATE TABLE IF NOT EXISTS pairwise (" +\
+                     "hash1 TEXT, hash2 TEXT, method TEXT, params TEXT, " +\
+                     "aln_length INTEGER, sim_errors INTEGER, " +\
+                     "PRIMARY KEY (hash1, hash2, method, params))")
+    conn.commit()
+    return conn
+
+# Make the result store key for a pairwise comparison
+def make_result_key(hash1, hash2, method, params):
+    """ Returns a (hash1, hash2, method, params) tuple identifying a pairwise
+        comparison.
+
+        NUCmer alignments (the methods in SYMMETRIC_METHODS) are treated as
+        symmetrical, so the sequence hashes are placed in sorted order and
+        either order of the organisms finds the result. Other methods count
+        only the query's fragments, so their keys keep the (query, subject)
+        order, and ' directional' is added to params so that results
+        stored under sorted keys by earlier versions are not mistaken for
+        one direction.
+
+        - hash1, hash2 are the sequence hashes of the query and subject
+              organisms
+
+        - method, params describe the ANI method and aligner options
+    """
+    if method in SYMMETRIC_METHODS:
+        hash1, hash2 = sorted((hash1, hash2))
+        return (hash1, hash2, method, params)
+    return (hash1, hash2, method, params + ' directional')
+
+# Look up a pairwise result in the result store
+def fetch_result(key):
+    """ Returns a tuple of (aln_length, sim_errors) for the passed result
+        key, or None if there is no result store or the key is not in it.
+
+        - key is a result key, as returned by make_result_key
+    """
+    if store is None:
+        return None
+    row = store.execute("SELECT aln_length, sim_errors FROM pairwise " +\
+                            "WHERE hash1=? AND hash2=? AND method=? " +\
+                            "AND params=?", key).fetchone()
+    return None if row is None else tuple(row)
+
+# Add a pairwise result to the result store
+def save_result(key, aln_length, sim_errors):
+    """ Records the total alignment length and similarity errors for the
+        passed result key, if there is a result store. The caller is
+        responsible for committing.
+
+        - key is a result key, as returned by make_result_key
+    """
+    if store is None:
+        return
+    store.execute("INSERT OR REPLACE INTO pairwise VALUES (?, ?, ?, ?, ?, ?)",
+                  key + (aln_length, sim_errors))
+
 # Create output directory if it doesn't exist
 def make_outdir():
     """ Make the output directory, if required.
@@ -833,8 +4704,14 @@ def make_outdir():
         DEFAULT: stop
         FORCE: continue, and remove the existing output directory
         NOCLOBBER+FORCE: continue, but do not remove the existing output
+        RESUME: continue in the existing output directory, reusing the
+            aligner output that was completed (see is_complete_output)
     """
     if os.path.exists(options.outdirname):
+        if options.resume:
+            logger.info("RESUME: continuing in existing directory %s" % \
+                            options.outdirname)
+            return
         if not options.force:
             logger.error("Output directory %s would " % options.outdirname +\
                              "overwrite existing files (exiting)")
@@ -859,6 +4736,7 @@ def make_outdir():
             sys.exit(1)
 
 
+@timed_stage('make_heatmap')
 def make_heatmap(perc_ids, perc_aln, names, outfile='test.png', tree_file=None):
     ''' Make a single heatmap using the percentage alignment and identity
 
@@ -868,10 +4746,10 @@ def make_heatmap(perc_ids, perc_aln, names, outfile='test.png', tree_file=None):
         upper triangles of this merged matrix will then be colored with
         separate colormaps to make things look pretty.
 
-        perc_ids:   2-D numpy matrix containing the values from the write_table
-                    method
-        perc_aln:   2-D numpy matrix containing the values from the write_table
-                    method
+        perc_ids:   2-D numpy matrix of percentage identities, as returned
+                    by write_pairwise_tables
+        perc_aln:   2-D numpy matrix of percentage aligned, as returned by
+                    write_pairwise_tables
         names:      list of the names for each row and column in the matrix
         outfile:    path to write output image to
         tree_file:  file containing a newick tree used for ordering the rows
@@ -934,10 +4812,12 @@ def make_heatmap(perc_ids, perc_aln, names, outfile='test.png', tree_file=None):
     merged_lower = np.ma.masked_array(merged, mask=mask_lower)
     merged_upper = np.ma.masked_array(merged, mask=mask_upper)
 
-    pa      = ax.pcolormesh(merged_lower, cmap=b2mpl.get_map('Blues',
-                    'sequential', 9).mpl_colormap)
-    pb      = ax.pcolormesh(merged_upper, cmap=b2mpl.get_map('Purples',
-                    'sequential', 9).mpl_colormap)
+    # merged_lower masks the lower triangle, so shows perc_aln; and
+    # merged_upper shows perc_ids
+    pa      = ax.pcolormesh(merged_lower, cmap=b2mpl.get_map(
+                    HEATMAP_ALIGNMENT_CMAP, 'sequential', 9).mpl_colormap)
+    pb      = ax.pcolormesh(merged_upper, cmap=b2mpl.get_map(
+                    HEATMAP_IDENTITY_CMAP, 'sequential', 9).mpl_colormap)
 
     xticks = np.arange(0.5, merged.shape[1] + 0.5)
     ax.set_xticks(xticks)
@@ -1008,19 +4888,189 @@ def make_heatmap(perc_ids, perc_aln, names, outfile='test.png', tree_file=None):
     fig.savefig(outfile)
 
 
+# Choose the order of rows and columns for a large heatmap
+def heatmap_order(perc_ids, names, tree_file=None):
+    """ Returns an array of row (and column) indices of the passed matrix, in
+        the order they should be drawn.
+
+        If a Newick tree file is given, the order of its leaves is used
+        (leaves not among names are ignored, and names not in the tree are
+        placed last). Otherwise, if SciPy is available, rows are ordered by
+        average linkage hierarchical clustering on 1 - perc_ids, so that
+        similar organisms are drawn together. Failing both, the input order
+        is kept.
+
+        - perc_ids is a square matrix of percentage identities
+
+        - names is a list of the row and column names, in matrix order
+
+        - tree_file is the location of an optional Newick tree
+    """
+    if tree_file is not None:
+        try:
+            from Bio import Phylo
+        except ImportError:
+            logger.warning("Bio.Phylo not available; not ordering " +\
+                               "heatmap by tree file")
+        else:
+            index = dict((name, idx) for idx, name in enumerate(names))
+            leaves = [str(leaf) for leaf in reversed(
+                Phylo.read(tree_file, 'newick').get_terminals())]
+            order = [index[leaf] for leaf in leaves if leaf in index]
+            placed = set(order)
+            return np.array(order + [idx for idx in range(len(names)) \
+                                         if idx not in placed], dtype=np.intp)
+    try:
+        from scipy.cluster import hierarchy
+        from scipy.spatial import distance
+    except ImportError:
+        logger.warning("SciPy not available; heatmap rows are not " +\
+                           "clustered")
+        return np.arange(len(names))
+    if len(names) < 3:
+        return np.arange(len(names))
+    dist = 1 - (np.asarray(perc_ids) + np.asarray(perc_ids).T) / 2
+    np.fill_diagonal(dist, 0)
+    linkage = hierarchy.linkage(distance.squareform(np.clip(dist, 0, None),
+                                                    checks=False),
+                                method='average')
+    return hierarchy.leaves_list(linkage)
+
+# Make heatmaps of large percentage identity and alignment matrices
+@timed_stage('make_large_heatmap')
+def make_large_heatmap(perc_ids, perc_aln, names, outfile, tree_file=None,
+                       tilesize=None):
+    """ Draws the same merged heatmap as make_heatmap (identity below the
+        diagonal, alignment fraction above it), in a form that scales to
+        thousands of organisms, and writes the row order used to a text
+        file alongside (outfile with its extension replaced by
+        _order.txt).
+
+        The matrix is drawn as a single raster image with one pixel per
+        cell, rather than as a mesh of vector cells, so that drawing time
+        and file size grow only with the number of cells. Rows and columns
+        are ordered by heatmap_order. At most HEATMAP_MAX_LABELS names are
+        labelled on each axis; when there are more rows, only every nth row
+        is labelled, and when more than ten rows would share each label,
+        the labels are dropped.
+
+        If tilesize is given and the matrix has more rows than that, it is
+        split into tiles of tilesize rows and columns, each drawn to its own
+        file (outfile with _<row>_<col> added before the extension, counting
+        tiles from zero).
+
+        Only Matplotlib is required; SciPy is used for ordering if present.
+
+        - perc_ids, perc_aln are square matrices, as returned by
+              write_pairwise_tables
+
+        - names is a list of the row and column names, in matrix order
+
+        - outfile is the location of the output image
+
+        - tree_file is the location of an optional Newick tree
+
+        - tilesize is the optional maximum number of rows and columns in
+              each image
+    """
+    try:
+        import matplotlib as mpl
+        mpl.use('Agg')
+        import matplotlib.pyplot as plt
+        import matplotlib.colors as colors
+        import matplotlib.gridspec as gridspec
+    except ImportError:
+        logger.warning("Matplotlib not available; not making heatmap")
+        return
+    order = heatmap_order(perc_ids, names, tree_file)
+    names = [names[idx] for idx in order]
+    stem, ext = os.path.splitext(outfile)
+    with open(stem + '_order.txt', 'w') as fh:
+        print('\n'.join(names), file=fh)
+    # Normalise each triangle over its own range, as the separate
+    # pcolormesh layers of make_heatmap do
+    lower = np.tri(len(names), k=-1, dtype=bool)
+    maps = []
+    for matrix, mask, cmap, label in \
+            ((perc_ids, lower, HEATMAP_IDENTITY_CMAP, 'Identity Fraction'),
+             (perc_aln, lower.T, HEATMAP_ALIGNMENT_CMAP,
+              'Alignment Fraction')):
+        values = np.asarray(matrix)[np.ix_(order, order)]
+        vrange = values[mask] if mask.any() else np.zeros(1)
+        maps.append((values, mask, plt.cm.ScalarMappable(
+            norm=colors.Normalize(vrange.min(), vrange.max()),
+            cmap=plt.get_cmap(cmap)), label))
+    tilesize = tilesize or len(names)
+    ntiles = -(-len(names) // tilesize)
+    for row in range(ntiles):
+        for col in range(ntiles):
+            rows = slice(row * tilesize, (row + 1) * tilesize)
+            cols = slice(col * tilesize, (col + 1) * tilesize)
+            # Diagonal cells are left white
+            image = np.full(maps[0][0][rows, cols].shape + (4,), 255,
+                            dtype=np.uint8)
+            for values, mask, mappable, label in maps:
+                tile_mask = mask[rows, cols]
+                image[tile_mask] = mappable.to_rgba(
+                    values[rows, cols][tile_mask], bytes=True)
+            fig = plt.figure(figsize=(10, 11))
+            gs = gridspec.GridSpec(2, 2, height_ratios=[40, 1])
+            ax = fig.add_subplot(gs[0, :])
+            ax.imshow(image, origin='lower', interpolation='none',
+                      aspect='auto')
+            for axis, labels in ((ax.xaxis, names[cols]),
+                                 (ax.yaxis, names[rows])):
+                step = -(-len(labels) // HEATMAP_MAX_LABELS)
+                if step > 10:
+                    axis.set_ticks([])
+                    continue
+                axis.set_ticks(range(0, len(labels), step))
+                axis.set_ticklabels(labels[::step],
+                                    fontsize=8 if step == 1 else 6)
+            ax.tick_params(axis='x', labelrotation=90)
+            ax.tick_params(length=0)
+            for spine in ax.spines.values():
+                spine.set_visible(False)
+            for idx, (values, mask, mappable, label) in enumerate(maps):
+                cbar = fig.colorbar(mappable, orientation='horizontal',
+                                    cax=fig.add_subplot(gs[1, idx]))
+                cbar.ax.tick_params(labelsize=8)
+                cbar.set_label(label, fontsize=10)
+            fig.tight_layout()
+            if ntiles > 1:
+                filename = "%s_%d_%d%s" % (stem, row, col, ext)
+            else:
+                filename = outfile
+            logger.info("Writing heatmap to %s" % filename)
+            fig.savefig(filename, dpi=300)
+            plt.close(fig)
+
+
 #=============
 # SCRIPT
 
-if __name__ == '__main__':
-
+# Build the command-line parser
+def make_parser():
+    """ Returns the argparse.ArgumentParser for the command line. Its option
+        destinations and defaults also define the configuration used when
+        the module is called as a library (see make_config).
+    """
     parser = argparse.ArgumentParser(\
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
     parser.add_argument("-o", "--outdir", dest="outdirname",
-                      action="store", default='./', required=True,
-                      help="Output directory")
-    parser.add_argument("infiles", nargs="+",
+                      action="store", default=None,
+                      help="Output directory (required unless --worker)")
+    parser.add_argument("infiles", nargs="*",
                       help="input fasta files")
+    parser.add_argument("--queries", dest="queries", nargs="+",
+                      default=None,
+                      help="Query fasta files, compared only against " +\
+                          "--references (use instead of infiles)")
+    parser.add_argument("--references", dest="references", nargs="+",
+                      default=None,
+                      help="Reference fasta files, compared only against " +\
+                          "--queries (use instead of infiles)")
     parser.add_argument("-v", "--verbose", dest="verbose",
                       action="store_true", default=False,
                       help="Give verbose output")
@@ -1028,7 +5078,7 @@ if __name__ == '__main__':
                       action="store_true", default=False,
                       help="Force file overwriting")
     parser.add_argument("-s", "--fragsize", dest="fragsize",
-                      default=1020,
+                      type=int, default=1020,
                       help="Sequence fragment size for ANIb")
     parser.add_argument("-l", "--logfile", dest="logfile",
                       action="store", default=None,
@@ -1036,6 +5086,15 @@ if __name__ == '__main__':
     parser.add_argument('-t', '--tree', dest='tree', default=None,
                       help='External phylogenetic tree that can be used to '\
                            'order the rows and columns of the matrix')
+    parser.add_argument("--heatmap_mode", dest="heatmap_mode",
+                      choices=['auto', 'standard', 'large'], default='auto',
+                      help="Heatmap drawing: 'large' draws a rasterized, " +\
+                          "clustered image with thinned labels; 'auto' " +\
+                          "uses it above %d organisms" % HEATMAP_LARGE_SIZE)
+    parser.add_argument("--heatmap_tile", dest="heatmap_tile",
+                      type=int, default=None,
+                      help="With the large heatmap, split matrices with " +\
+                          "more rows than this into several images")
     parser.add_argument("--skip_nucmer", dest="skip_nucmer",
                       action="store_true", default=False,
                       help="Skip NUCmer runs, for testing " +\
@@ -1047,8 +5106,14 @@ if __name__ == '__main__':
     parser.add_argument("--noclobber", dest="noclobber",
                       action="store_true", default=False,
                       help="Don't nuke existing files")
+    parser.add_argument("--resume", dest="resume",
+                      action="store_true", default=False,
+                      help="Continue an interrupted run in its output " +\
+                          "directory, rerunning only comparisons whose " +\
+                          "aligner output is missing or incomplete")
     parser.add_argument("-m", "--method", dest="method",
-                      choices=['ANIm', 'ANIb', 'AAIm'], default="ANIm",
+                      choices=['ANIm', 'ANIb', 'AAIm', 'ANIk', 'TETRA'],
+                      default="ANIm",
                       help="ANI method")
     parser.add_argument("--nucmer_exe", dest="nucmer_exe",
                       action="store", default="nucmer",
@@ -1062,11 +5127,156 @@ if __name__ == '__main__':
     parser.add_argument("--makeblastdb_exe", dest="makeblastdb_exe",
                       action="store", default="makeblastdb",
                       help="Path to BLAST+ makeblastdb executable")
+    parser.add_argument("--sample_fragments", dest="sample_fragments",
+                      type=int, default=None,
+                      help="ANIb: BLAST only this many randomly chosen " +\
+                          "fragments of each query genome, and report " +\
+                          "bootstrap confidence intervals for ANI")
+    parser.add_argument("--sample_seed", dest="sample_seed",
+                      type=int, default=1,
+                      help="Random number seed for --sample_fragments")
+    parser.add_argument("--bootstrap", dest="bootstrap",
+                      type=int, default=1000,
+                      help="Number of bootstrap replicates for the " +\
+                          "--sample_fragments confidence intervals")
+    parser.add_argument("--blast_batch", dest="blast_batch",
+                      action="store_true", default=False,
+                      help="ANIb: run BLASTN once per genome against a " +\
+                          "single database of all genomes (an " +\
+                          "approximation: repeat-rich genomes and " +\
+                          "database-wide E-values can change results)")
+    parser.add_argument("--blast_stream", dest="blast_stream",
+                      action="store_true", default=False,
+                      help="ANIb: parse BLASTN output as it is produced, " +\
+                          "without writing .blast_tab files")
+    parser.add_argument("--keep_hits", dest="keep_hits",
+                      action="store_true", default=False,
+                      help="With --blast_stream, keep a gzip-compressed " +\
+                          "copy of the BLASTN output")
+    parser.add_argument("--threads", dest="threads",
+                      type=int, default=os.cpu_count() or 1,
+                      help="Number of cores to use for external jobs")
+    parser.add_argument("--timeout", dest="timeout",
+                      type=int, default=None,
+                      help="Time limit in seconds for each external job")
+    parser.add_argument("--retries", dest="retries",
+                      type=int, default=1,
+                      help="Number of times to retry a failed external job")
+    parser.add_argument("--one_to_one", dest="one_to_one",
+                      action="store_true", default=False,
+                      help="ANIm: count only a one-to-one set of " +\
+                          "alignments, dropping overlapping and repeat " +\
+                          "alignments (a greedy approximation to " +\
+                          "delta-filter -1, without its trimming)")
+    parser.add_argument("--nucmer_chunk", dest="nucmer_chunk",
+                      type=int, default=None,
+                      help="ANIm: split query genomes longer than this " +\
+                          "many bases into chunks of whole contigs, " +\
+                          "aligned as separate jobs and merged")
+    parser.add_argument("--nucmer_threads", dest="nucmer_threads",
+                      action="store_true", default=False,
+                      help="Give NUCmer/PROmer spare cores with --threads " +\
+                          "(requires MUMmer 4)")
+    parser.add_argument("--pipeline", dest="pipeline",
+                      action="store_true", default=False,
+                      help="ANIm/ANIb: parse each aligner output as soon " +\
+                          "as its job completes, while other jobs run")
+    parser.add_argument("--matrix_format", dest="matrix_format",
+                      choices=['tab', 'npy', 'hdf5'], default='tab',
+                      help="Output format for result matrices: " +\
+                          "tab-separated text, NumPy .npy arrays, or " +\
+                          "an HDF5 file (requires h5py)")
+    parser.add_argument("--export_alignments", dest="export_alignments",
+                      action="store_true", default=False,
+                      help="ANIm/ANIb: also write each pairwise " +\
+                          "comparison's alignments to a compressed " +\
+                          "columnar .alignments.npz file, for " +\
+                          "per-contig summaries (see contig_ani)")
+    parser.add_argument("--genome_cache", dest="genome_cache",
+                      action="store", default=None,
+                      help="Directory of packed 2-bit copies of the input " +\
+                          "genomes, keyed by file contents and shared " +\
+                          "between runs, read in place of the FASTA files")
+    parser.add_argument("--sparse_output", dest="sparse_output",
+                      type=float, default=None,
+                      help="Keep only pairs with ANI of at least this " +\
+                          "value (e.g. 0.9), written as a graph " +\
+                          "(ani_edges.tab, or CSR arrays with " +\
+                          "--matrix_format npy/hdf5) in place of the " +\
+                          "NxN matrices, and cluster organisms into " +\
+                          "species (species_clusters.tab)")
+    parser.add_argument("--species_threshold", dest="species_threshold",
+                      type=float, default=0.95,
+                      help="ANI threshold for --sparse_output species " +\
+                          "clusters")
+    parser.add_argument("--species_linkage", dest="species_linkage",
+                      choices=['single', 'average'], default='single',
+                      help="Linkage for --sparse_output species clusters")
+    parser.add_argument("--prefilter", dest="prefilter",
+                      type=float, default=None,
+                      help="ANIm/ANIb/ANIk: skip comparing pairs whose " +\
+                          "MinHash-estimated ANI is below this value " +\
+                          "(e.g. 0.8), reporting the estimate instead")
+    parser.add_argument("--sketch_size", dest="sketch_size",
+                      type=int, default=1000,
+                      help="Number of hashes in each --prefilter sketch")
+    parser.add_argument("--queue", dest="queue",
+                      action="store", default=None,
+                      help="Shared directory through which to pass " +\
+                          "external jobs to --worker processes, instead " +\
+                          "of running them locally")
+    parser.add_argument("--worker", dest="worker",
+                      action="store_true", default=False,
+                      help="Run jobs from the --queue directory, rather " +\
+                          "than running a comparison")
+    parser.add_argument("--worker_idle", dest="worker_idle",
+                      type=int, default=None,
+                      help="Stop a --worker after this many seconds " +\
+                          "without jobs (default: wait for a STOP file " +\
+                          "in the queue directory)")
+    parser.add_argument("--store", dest="store",
+                      action="store", default=None,
+                      help="SQLite database of pairwise results to reuse " +\
+                          "and add to between runs (keep this outside " +\
+                          "the output directory)")
+    return parser
+
+
+if __name__ == '__main__':
+
+    parser = make_parser()
     options = parser.parse_args()
+    if options.worker:
+        if options.queue is None:
+            parser.error("--worker requires --queue")
+    elif options.outdirname is None:
+        parser.error("the following arguments are required: -o/--outdir")
+    elif options.queries is None and options.references is None:
+        if not options.infiles:
+            parser.error("no input fasta files given")
+    elif options.queries is None or options.references is None:
+        parser.error("--queries and --references must be given together")
+    elif options.infiles:
+        parser.error("infiles cannot be used with --queries/--references")
+    elif options.method == 'TETRA':
+        parser.error("--queries/--references are not supported for TETRA")
+    if options.queue is not None and options.blast_stream:
+        parser.error("--blast_stream cannot be used with --queue")
+    if options.export_alignments and \
+            (options.blast_stream or options.blast_batch):
+        parser.error("--export_alignments cannot be used with " +\
+                         "--blast_stream or --blast_batch")
+    if options.resume and options.force:
+        parser.error("--resume cannot be used with --force")
+    if options.sparse_output is not None:
+        if options.method == 'TETRA':
+            parser.error("--sparse_output is not supported for TETRA")
+        if options.sparse_output > options.species_threshold:
+            parser.error("--sparse_output must not be above " +\
+                             "--species_threshold")
 
     # We set up logging, and modify loglevel according to whether we need
     # verbosity or not
-    logger = logging.getLogger('calculate_ani.py')
     logger.setLevel(logging.DEBUG)
     if options.logfile is None:
         err_handler = logging.StreamHandler(sys.stderr)
@@ -1090,17 +5300,27 @@ if __name__ == '__main__':
     # Report arguments, if verbose
     logger.info(options)
 
+    # Worker processes only run jobs from the queue
+    if options.worker:
+        run_worker(options.queue)
+        sys.exit(0)
+
     # Have we got an input and output directory? If not, exit.
 
     make_outdir()
     logger.info("Output directory: %s" % options.outdirname)
+    atexit.register(write_run_report)
+
+    if options.store is not None:
+        store = open_result_store(options.store)
 
 
     # Have we got a valid method choice?
     methods = {"ANIm": calculate_anim,
                "ANIb": calculate_anib,
                "AAIm": calculate_aaim,
-               #"TETRA": calculate_tetra
+               "ANIk": calculate_anik,
+               "TETRA": calculate_tetra
                }
     if options.method not in methods:
         logger.error("ANI method %s not recognised (exiting)" % options.method)
@@ -1110,9 +5330,27 @@ if __name__ == '__main__':
 
     # Run method on the contents of the input directory, writing out
     # to the named output directory
-    perc_id, perc_aln, names = methods[options.method](options.infiles)
+    if options.queries is None and options.references is None:
+        perc_id, perc_aln, names = methods[options.method](options.infiles)
+    else:
+        perc_id, perc_aln, names = methods[options.method](options.queries,
+            references=options.references)
 
     # If graphics have been selected, use R to generate a heatmap of the ANI
     # scores from the perc_id.tab output
-    make_heatmap(perc_id, perc_aln, names, os.path.join(options.outdirname,
-        'heatmap.eps'), tree_file=options.tree)
+    if options.sparse_output is not None:
+        logger.info("No matrices with --sparse_output, skipping heatmap")
+    elif perc_aln is not None:
+        heatmap_file = os.path.join(options.outdirname, 'heatmap.eps')
+        if options.heatmap_mode == 'large' or \
+                (options.heatmap_mode == 'auto' and \
+                     len(names) > HEATMAP_LARGE_SIZE):
+            make_large_heatmap(perc_id, perc_aln, names, heatmap_file,
+                               tree_file=options.tree,
+                               tilesize=options.heatmap_tile)
+        else:
+            make_heatmap(perc_id, perc_aln, names, heatmap_file,
+                         tree_file=options.tree)
+    else:
+        logger.info("No alignment coverage for %s, skipping heatmap" % \
+                        options.method)